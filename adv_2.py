@@ -1,15 +1,18 @@
 import streamlit as st
 from PIL import Image
-import google.generativeai as genai
+from image_loader import load_image
+from clients import configure_genai, generative_model
 import base64
 from dotenv import load_dotenv
 import os
 from io import BytesIO
+from prompt_cache import default_memo, prompt_key
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 # Use a supported image-generation model
 VISION_MODEL = "gemini-2.5-flash-image"  # for multi-image grounding + image output
@@ -39,12 +42,20 @@ Output only one line: starting with “Generate a 2048x2048 photorealistic image
     if blouse_img:
         inputs.append(blouse_img)
 
-    model = genai.GenerativeModel(VISION_MODEL)
+    memo = default_memo()
+    memo_key = prompt_key([lehenga_img, closeup_img, blouse_img], PROMPT_TEMPLATE, VISION_MODEL)
+    cached = memo.get(memo_key)
+    if cached:
+        return cached
+
+    model = generative_model(VISION_MODEL)
     result = model.generate_content(inputs)
-    return result.text.strip()
+    instruction = result.text.strip()
+    memo.put(memo_key, instruction)
+    return instruction
 
 def generate_image_from_prompt(prompt_instruction: str):
-    model = genai.GenerativeModel(VISION_MODEL)
+    model = generative_model(VISION_MODEL)
     result = model.generate_content(prompt_instruction, stream=False, response_modalities=['Image'])
     try:
         b64 = result.candidates[0].content.parts[0].inline_data.data
@@ -54,25 +65,26 @@ def generate_image_from_prompt(prompt_instruction: str):
     return base64.b64decode(b64)
 
 st.title("👗 Lehenga Try-On — High Detail 2K")
+track_usage("adv_2")
 
 lehenga_file = st.file_uploader("Upload Lehenga Image (full view)", type=["jpg","jpeg","png"])
 closeup_file = st.file_uploader("Upload Design Close-up (embroidery/stones) — optional", type=["jpg","jpeg","png"])
 blouse_file  = st.file_uploader("Upload Blouse Reference — optional", type=["jpg","jpeg","png"])
 
 if lehenga_file:
-    lehenga_img = Image.open(lehenga_file).convert("RGB")
+    lehenga_img = load_image(lehenga_file)
     st.image(lehenga_img, caption="Lehenga (full view)", width=360)
 else:
     lehenga_img = None
 
 closeup_img = None
 if closeup_file:
-    closeup_img = Image.open(closeup_file).convert("RGB")
+    closeup_img = load_image(closeup_file)
     st.image(closeup_img, caption="Design Close-up", width=240)
 
 blouse_img = None
 if blouse_file:
-    blouse_img = Image.open(blouse_file).convert("RGB")
+    blouse_img = load_image(blouse_file)
     st.image(blouse_img, caption="Blouse Reference", width=240)
 
 if st.button("Generate 2K Try-On"):
@@ -95,3 +107,5 @@ if st.button("Generate 2K Try-On"):
                 st.download_button("📥 Download", data=buf, file_name="lehenga_tryon.jpg", mime="image/jpeg")
             else:
                 st.error("Image generation failed — check model availability or quota.")
+
+usage_sidebar()
@@ -1,15 +1,21 @@
 import streamlit as st
 from PIL import Image
-import google.generativeai as genai
-import base64
+from image_loader import load_image
+from clients import configure_genai, generative_model
 from dotenv import load_dotenv
 import os
 from io import BytesIO
+from prompt_cache import default_memo, prompt_key
+from prompt_stream import TextStream
+from image_output import extension
+from pipeline import PIPELINE_LABELS, PIPELINE_MODE, PIPELINE_MODES, describe, ledger_rows, run_pipeline
+from session_results import request_key, session_results
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 
 VISION_MODEL = "models/gemini-1.0-basic"
@@ -22,10 +28,11 @@ def pil_to_bytes(img: Image.Image, fmt="PNG"):
     buf.seek(0)
     return buf.read()
 
-def generate_prompt(lehenga_img: Image.Image, closeup_img: Image.Image | None, blouse_img: Image.Image | None):
+def generate_prompt(lehenga_img: Image.Image, closeup_img: Image.Image | None, blouse_img: Image.Image | None) -> TextStream:
     """
     Create a strict, multi-image grounded prompt that instructs Gemini
     to produce a 2K realistic image of a model wearing the exact same lehenga.
+    Streamed: render with st.write_stream(), then read .text.
     """
  
     PROMPT_TEMPLATE = """
@@ -61,30 +68,27 @@ Now produce a single concise generation instruction (one line) that a generative
     if blouse_img:
         inputs.append(blouse_img)
 
-    model = genai.GenerativeModel(VISION_MODEL)
+    memo = default_memo()
+    memo_key = prompt_key([lehenga_img, closeup_img, blouse_img], PROMPT_TEMPLATE, VISION_MODEL)
+    cached = memo.get(memo_key)
+    if cached:
+        return TextStream.of(cached)
 
-    result = model.generate_content(inputs)
-  
-    return result.text.strip()
+    model = generative_model(VISION_MODEL)
 
-def generate_image_from_prompt(prompt_instruction: str):
-    """
-    Call the image model with the single-line instruction and request 2048x2048 output.
-    """
-    model = genai.GenerativeModel(IMAGE_MODEL)
+    return TextStream(
+        lambda: model.generate_content(inputs, stream=True),
+        on_complete=lambda instruction: memo.put(memo_key, instruction)
+    )
 
-    result = model.generate_content(prompt_instruction, stream=False)
-
-    try:
-        image_base64 = result.candidates[0].content.parts[0].inline_data.data
-    except Exception as e:
-        st.error(f"Image generation response parsing failed: {e}")
-        return None
-    image_bytes = base64.b64decode(image_base64)
-    return image_bytes
+def show_instruction(stream: TextStream):
+    st.subheader("Generation Instruction Prompt")
+    st.write_stream(stream)
+    st.caption(stream.summary())
 
 
 st.title("👗 Lehenga Try-On — High-Detail 2K Generator")
+track_usage("adv_app")
 
 st.markdown(
     """
@@ -101,7 +105,7 @@ blouse_file  = st.file_uploader("Upload Blouse Reference — B", type=["jpg","jp
 
 if lehenga_file:
     try:
-        lehenga_img = Image.open(lehenga_file).convert("RGB")
+        lehenga_img = load_image(lehenga_file)
         st.image(lehenga_img, caption="Lehenga (full view)", width=360)
     except Exception as e:
         st.error(f"Failed to open lehenga image: {e}")
@@ -111,7 +115,7 @@ else:
 
 if closeup_file:
     try:
-        closeup_img = Image.open(closeup_file).convert("RGB")
+        closeup_img = load_image(closeup_file)
         st.image(closeup_img, caption="Design Close-up (A)", width=240)
     except Exception as e:
         st.error(f"Failed to open close-up image: {e}")
@@ -121,7 +125,7 @@ else:
 
 if blouse_file:
     try:
-        blouse_img = Image.open(blouse_file).convert("RGB")
+        blouse_img = load_image(blouse_file)
         st.image(blouse_img, caption="Blouse Reference (B)", width=240)
     except Exception as e:
         st.error(f"Failed to open blouse image: {e}")
@@ -134,46 +138,82 @@ with col1:
     quality_mode = st.radio("Quality mode", ["A — Ultra Accuracy (slower)", "B — Balanced", "C — Fast"], index=0)
 with col2:
     do_upscale = st.checkbox("Apply additional upscale (if available)", value=False)
+    pipeline_mode = st.radio(
+        "Pipeline", PIPELINE_MODES, index=PIPELINE_MODES.index(PIPELINE_MODE), format_func=PIPELINE_LABELS.get
+    )
+
+# Results survive reruns (e.g. the download click) for this session
+results = session_results(st.session_state)
+result_key = request_key(
+    *(getattr(f, "file_id", None) for f in (lehenga_file, closeup_file, blouse_file)),
+    quality_mode, pipeline_mode, VISION_MODEL, IMAGE_MODEL
+)
+result = results.get(result_key)
+prompt_shown = False
 
-if st.button("Generate 2K Try-On"):
+# Relabelled once a result exists, so a queued double-click can't re-fire it
+if st.button("Generate 2K Try-On" if result is None else "Regenerate", disabled=results.in_flight(result_key)):
 
     if not lehenga_img:
         st.error("Please upload the full-view lehenga image (required).")
     else:
-        with st.spinner("Generating strict prompt from provided images..."):
-          
-            try:
-                instruction_prompt = generate_prompt(lehenga_img, closeup_img, blouse_img)
-                st.subheader("Generation Instruction Prompt")
-                st.write(instruction_prompt)
-            except Exception as e:
-                st.error(f"Prompt generation failed: {e}")
-                instruction_prompt = None
-
-        if instruction_prompt:
-            with st.spinner("Generating 2K model image — this may take a while..."):
-                image_bytes = generate_image_from_prompt(instruction_prompt)
-                if not image_bytes:
-                    st.error("Image generation failed. Check API key, model availability, and quota.")
-                else:
-                    try:
-                        out_img = Image.open(BytesIO(image_bytes)).convert("RGB")
-                        st.subheader("Final Generated Image (2048×2048)")
-                        st.image(out_img, use_column_width=True)
-
-                   
-                        buf = BytesIO()
-                        out_img.save(buf, format="JPEG", quality=95)
-                        buf.seek(0)
-                        st.download_button(
-                            label="📥 Download Image (JPEG)",
-                            data=buf,
-                            file_name="model_lehenga_2k.jpg",
-                            mime="image/jpeg"
+        with results.generating(result_key) as claimed:
+            if not claimed:
+                st.info("A generation for these uploads is already running.")
+            else:
+                try:
+                    with st.spinner("Generating 2K model image — this may take a while..."):
+                        # Two-stage: the instruction is rendered token by token and the image
+                        # stage starts as soon as it ends. Fused: one call with the references.
+                        run = run_pipeline(
+                            pipeline_mode,
+                            [lehenga_img, closeup_img, blouse_img],
+                            IMAGE_MODEL,
+                            instruction=generate_prompt,
+                            show_instruction=show_instruction
                         )
-                    except Exception as e:
-                        st.error(f"Failed to display or save generated image: {e}")
+                    prompt_shown = run["instruction"] is not None
+                except Exception as e:
+                    st.error(f"Generation failed: {e}")
+                    run = None
+
+                if run and not run["image"]:
+                    st.caption(describe(run))
+                    st.error("Image generation failed. Check API key, model availability, and quota.")
+                elif run:
+                    results.put(
+                        result_key, run["image"], run["mime"],
+                        prompt=run["instruction"], quality_mode=quality_mode,
+                        pipeline=describe(run)
+                    )
+                    result = results.get(result_key)
 
         if do_upscale:
             st.info("Upscale requested. If you have an external upscaler (Real-ESRGAN) or a Gemini upscaler model,"
                     "we can add a secondary upscaling pass. Tell me if you want that integrated.")
+
+if result:
+    try:
+        if result["prompt"] and not prompt_shown:
+            st.subheader("Generation Instruction Prompt")
+            st.write(result["prompt"])
+        st.caption(result["meta"]["pipeline"])
+
+        # Serve the model's own encoded bytes; no decode / re-encode
+        mime = result["mime"]
+        st.subheader("Final Generated Image (2048×2048)")
+        st.image(result["image"], use_column_width=True)
+
+        st.download_button(
+            label=f"📥 Download Image ({extension(mime).upper()})",
+            data=result["image"],
+            file_name=f"model_lehenga_2k.{extension(mime)}",
+            mime=mime
+        )
+    except Exception as e:
+        st.error(f"Failed to display or save generated image: {e}")
+
+with st.expander("📊 Pipeline comparison (this server process)"):
+    st.table(ledger_rows())
+
+usage_sidebar()
@@ -1,6 +1,7 @@
-import google.generativeai as genai
+import sys
 from dotenv import load_dotenv
 import os
+from model_registry import default_registry
 
 # Load API key from .env
 load_dotenv()
@@ -10,15 +11,24 @@ if not GEMINI_API_KEY:
     print("Google API key not found in .env")
     exit()
 
-genai.configure(api_key=GEMINI_API_KEY)
+# Shared, on-disk model registry (same one the apps read)
+registry = default_registry()
+if "--refresh" in sys.argv:
+    # Live probes are billed calls (image generations included), so only on request
+    print("Listing and probing models...")
+    registry.refresh(probe=True)
+elif registry.is_stale():
+    print("Listing models...")
+    registry.refresh()
 
-# List all models
-models = genai.list_models()
+models = registry.models()
 print(f"Found {len(models)} models:\n")
 
-for m in models:
-    print("Name:", m.name)
-    print("Display Name:", getattr(m, "display_name", "N/A"))
-    print("Type:", getattr(m, "model_type", "N/A"))
-    print("Supports Image Generation:", "image" in m.name.lower() or "flash" in m.name.lower())
+for name, info in sorted(models.items()):
+    print("Name:", name)
+    print("Display Name:", info.get("display_name", "N/A"))
+    print("Input:", ", ".join(info.get("input", [])) or "unknown")
+    print("Output:", ", ".join(info.get("output", [])) or "unknown")
+    print("Capabilities:", "probed" if info.get("probed_at") else "from listing")
+    print("Supports Image Generation:", "image" in info.get("output", []))
     print("-" * 50)
@@ -1,49 +1,39 @@
 import streamlit as st
 from PIL import Image
-import google.generativeai as genai
+from image_loader import load_image
+from clients import configure_genai, generative_model
+from model_registry import default_registry
 import base64
 from dotenv import load_dotenv
 import os
+from rate_limiter import IMAGE_OUTPUT_TOKENS, acquire, estimate_tokens
+from call_policy import call_with_policy
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY= os.getenv("GOOGLE_API_KEY")
 
 
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
+
+# Used whenever the model registry has no match (first run, partial listing)
+FALLBACK_TEXT_MODEL = "models/gemini-2.5-flash"
+FALLBACK_IMAGE_MODEL = "models/gemini-2.5-flash-image"
 
 def pick_models():
-    models = genai.list_models()
-    # flatten to names
-    names = [m.name for m in models]
+    # cached, classified capabilities — never waits on a network listing
+    registry = default_registry()
     # candidate for text/prompt generation
     # prefer a multimodal text model that supports images+text → text
-    text_model = None
-    for nm in names:
-        if nm.startswith("models/gemini-2.5-flash") or nm.startswith("models/gemini-2.0-flash"):
-            text_model = nm
-            break
-    if text_model is None:
-        # fallback to generic text-only
-        text_model = names[0] if names else None
-
-    # candidate for image generation
-    image_model = None
-    for nm in names:
-        # pick a model that supports image output
-        if "image" in nm.lower() or nm.endswith("-image-preview") or nm.endswith("-image"):
-            image_model = nm
-            break
-    return text_model, image_model
+    text_model = registry.pick("image", "text", prefer=("models/gemini-2.5-flash", "models/gemini-2.0-flash"))
+    # candidate for image generation: a model that really returns images
+    image_model = registry.pick("text", "image", prefer=("models/gemini-2.5-flash-image",))
+    return text_model or FALLBACK_TEXT_MODEL, image_model or FALLBACK_IMAGE_MODEL
 
 TEXT_MODEL, IMAGE_MODEL = pick_models()
-if not TEXT_MODEL:
-    raise RuntimeError("No valid Gemini model found for text generation — check your API access.")
 st.write("Using prompt‑generation model:", TEXT_MODEL)
-if IMAGE_MODEL:
-    st.write("Using image‑generation model:", IMAGE_MODEL)
-else:
-    st.write("⚠️ No image‑generation model available — image output will be skipped.")
+st.write("Using image‑generation model:", IMAGE_MODEL)
 
 # ====== Functions ======
 def generate_prompt(img: Image.Image) -> str:
@@ -63,25 +53,36 @@ def generate_prompt(img: Image.Image) -> str:
 
     Output should be ONLY the final instruction prompt (no explanation).
     """
-    model = genai.GenerativeModel(TEXT_MODEL)
-    result = model.generate_content([PROMPT_TEMPLATE, img])
+    inputs = [PROMPT_TEMPLATE, img]
+
+    def generate(name: str):
+        acquire(name, estimate_tokens(inputs))
+        return generative_model(name).generate_content(inputs)
+
+    result = call_with_policy(TEXT_MODEL, generate)
     return result.text
 
 def generate_image_from_prompt(prompt: str) -> bytes | None:
     if not IMAGE_MODEL:
         return None
-    model = genai.GenerativeModel(IMAGE_MODEL)
-    result = model.generate_content(prompt, stream=False)
+
+    # Falls back down MODEL_FALLBACKS while IMAGE_MODEL's circuit is open
+    def generate(name: str):
+        acquire(name, estimate_tokens(prompt, IMAGE_OUTPUT_TOKENS))
+        return generative_model(name).generate_content(prompt, stream=False)
+
+    result = call_with_policy(IMAGE_MODEL, generate)
     # first candidate, inline_data assumed
     b64 = result.candidates[0].content.parts[0].inline_data.data
     return base64.b64decode(b64)
 
 # ====== Streamlit UI ======
 st.title("👗 Lehenga Try‑On Generator (Gemini — dynamic model select)")
+track_usage("app")
 
 uploaded_file = st.file_uploader("Upload Lehenga Image", type=["jpg", "jpeg", "png"])
 if uploaded_file:
-    input_img = Image.open(uploaded_file)
+    input_img = load_image(uploaded_file)
     st.image(input_img, caption="Uploaded Lehenga", width=350)
 
     if st.button("Generate Model Image"):
@@ -106,3 +107,5 @@ if uploaded_file:
                 st.error("Image generation failed — model returned no data.")
         else:
             st.info("No image‑generation model available — only prompt generated.")
+
+usage_sidebar()
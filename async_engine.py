@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from google import genai
+
+from clients import genai_client
+from rate_limiter import current_tally, limiter_for
+from tracing import current_span, record_span
+from usage_ledger import asks_for_image, current_tags, record_call
+
+# -------------------------
+# Settings
+# -------------------------
+MAX_IN_FLIGHT = int(os.getenv("GENAI_MAX_IN_FLIGHT", "32"))
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "120"))
+
+
+# -------------------------
+# Engine
+# -------------------------
+class GenerationEngine:
+    """
+    Runs google.genai async calls on one event loop in a daemon thread, so a
+    process can keep many generations in flight without a thread per call.
+
+    - agenerate(): awaitable from any event loop
+    - submit():    returns a concurrent.futures.Future
+    - generate():  blocking, for Streamlit scripts and worker threads
+
+    Every call has a deadline covering queueing, rate limiting and the API
+    call itself; cancelling the future or the awaiting task cancels the call.
+    """
+
+    def __init__(self, client: genai.Client, max_in_flight: int = MAX_IN_FLIGHT):
+        self.client = client
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="genai-engine", daemon=True)
+        self._thread.start()
+
+    async def _call(self, model: str, contents, config, deadline: float, tokens: int, tags: dict, parent, tally):
+        queued = time.perf_counter()
+        # Waiting for a slot and the rate limit is not API latency
+        if tally is not None:
+            tally.begin()
+        async with self._slots:
+            try:
+                await limiter_for(model).acquire_async(tokens, deadline - time.monotonic())
+            finally:
+                if tally is not None:
+                    tally.end()
+            started = time.perf_counter()
+            image_output = asks_for_image(model, config)
+            record_span("rate_limit", started - queued, parent, model=model, tokens=tokens)
+            try:
+                response = await self.client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=config,
+                )
+            except (Exception, asyncio.CancelledError) as e:
+                record_call(model, None, time.perf_counter() - started, e, tags, parent, image_output)
+                raise
+            record_call(model, response.usage_metadata, time.perf_counter() - started, None, tags, parent, image_output)
+            return response
+
+    def submit(self, model: str, contents, config=None, timeout: float | None = None, tokens: int = 0) -> Future:
+        timeout = timeout or GENERATION_TIMEOUT
+        # Usage tags (session, page), the trace span and the caller's rate limit
+        # wait tally are read here, on the caller's thread
+        call = self._call(
+            model, contents, config, time.monotonic() + timeout, tokens, current_tags(), current_span(), current_tally()
+        )
+        return asyncio.run_coroutine_threadsafe(asyncio.wait_for(call, timeout), self._loop)
+
+    async def agenerate(self, model: str, contents, config=None, timeout: float | None = None, tokens: int = 0):
+        return await asyncio.wrap_future(self.submit(model, contents, config, timeout, tokens))
+
+    def generate(self, model: str, contents, config=None, timeout: float | None = None, tokens: int = 0):
+        """
+        Blocks until the response arrives. Raises TimeoutError past the deadline.
+        """
+        future = self.submit(model, contents, config, timeout, tokens)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+
+_default_engine: GenerationEngine | None = None
+_default_lock = threading.Lock()
+
+
+def default_engine() -> GenerationEngine:
+    """
+    Process-wide engine on the shared GOOGLE_API_KEY client, used by every
+    session and rerun.
+    """
+    global _default_engine
+    with _default_lock:
+        if _default_engine is None:
+            _default_engine = GenerationEngine(genai_client())
+        return _default_engine
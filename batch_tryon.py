@@ -0,0 +1,194 @@
+"""
+Headless catalog runner for the v3cpy.py try-on path.
+
+    python batch_tryon.py catalog/ --output-dir out/ --workers 8
+    python batch_tryon.py pieces.csv --model-cap gemini-3-pro-image-preview=4
+
+INPUT is either a directory or a manifest (.csv or .jsonl).
+
+Directory: image files whose names end in "lehenga", "closeup" or "blouse"
+are grouped into one piece by folder and prefix, e.g. "red01/lehenga.jpg"
+or "red01_closeup.png". Manifest: one row per piece with columns
+id, lehenga, closeup, blouse and optionally model; paths are relative to
+the manifest file.
+
+Every generation is recorded in the history store (history_store.py) under
+its piece id, so re-running an interrupted batch resumes it: pieces that
+already finished are served from the store without another API call.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PIL import Image
+
+from image_loader import load_image
+from tryon import VISION_MODEL, generate_try_on
+from image_output import extension
+
+ROLES = ("lehenga", "closeup", "blouse")
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+_ROLE_RE = re.compile(r"^(?P<prefix>.*?)[ _-]*(?P<role>lehenga|closeup|close-up|blouse)$", re.IGNORECASE)
+
+
+# -------------------------
+# Input discovery
+# -------------------------
+def scan_directory(root: str) -> list[dict]:
+    pieces: dict[str, dict] = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            stem, ext = os.path.splitext(name)
+            match = _ROLE_RE.match(stem)
+            if ext.lower() not in IMAGE_EXTS or not match:
+                continue
+            role = match["role"].lower().replace("-", "")
+            folder = os.path.relpath(dirpath, root)
+            parts = [p for p in (folder if folder != "." else "", match["prefix"]) if p]
+            piece_id = "_".join(parts).replace(os.sep, "_") or "piece"
+            pieces.setdefault(piece_id, {"id": piece_id})[role] = os.path.join(dirpath, name)
+    return [p for _, p in sorted(pieces.items()) if "lehenga" in p]
+
+
+def read_manifest(path: str) -> list[dict]:
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    pieces = []
+    for i, row in enumerate(rows):
+        piece = {"id": row.get("id") or f"piece_{i + 1:04d}"}
+        for role in ROLES:
+            if row.get(role):
+                piece[role] = os.path.join(base, row[role])
+        if row.get("model"):
+            piece["model"] = row["model"]
+        if "lehenga" not in piece:
+            print(f"Skipping {piece['id']}: no lehenga image")
+            continue
+        pieces.append(piece)
+    return pieces
+
+
+# -------------------------
+# Runner
+# -------------------------
+def _model_key(model: str) -> str:
+    return model.strip().removeprefix("models/")
+
+
+def _open(path: str | None) -> Image.Image | None:
+    return load_image(path) if path else None
+
+
+def run_piece(piece: dict, output_dir: str, caps: dict[str, threading.Semaphore], default_model: str) -> dict:
+    model = piece.get("model", default_model)
+    result = {"id": piece["id"], "model": model, **{r: piece.get(r) for r in ROLES}}
+    started = time.perf_counter()
+    try:
+        images = [_open(piece.get(r)) for r in ROLES]
+        with caps[_model_key(model)]:
+            data, info = generate_try_on(
+                *images, model=model,
+                source_bytes=[os.path.getsize(piece[r]) if piece.get(r) else None for r in ROLES],
+                garment_id=piece["id"], source="batch"
+            )
+        output = os.path.join(output_dir, f"{piece['id']}.{extension(info['mime'])}")
+        with open(output, "wb") as f:
+            f.write(data)
+        result.update(
+            status="ok", output=output, cached=info["cached"], history_id=info["history_id"],
+            input_bytes=sum(s["bytes"] for s in info["prep"]),
+            input_tokens=sum(s["tokens"] for s in info["prep"]),
+            tokens_saved=sum(s["source_tokens"] - s["tokens"] for s in info["prep"]),
+        )
+    except Exception as e:
+        result.update(status="error", error=str(e))
+    result["seconds"] = round(time.perf_counter() - started, 2)
+    return result
+
+
+def run_batch(
+    pieces: list[dict],
+    output_dir: str,
+    workers: int = 4,
+    model_caps: dict[str, int] | None = None,
+    default_model: str = VISION_MODEL
+) -> list[dict]:
+    """
+    Runs every piece through a thread pool of `workers` threads. Calls to a
+    model never exceed its entry in model_caps (default: `workers`).
+    Results are appended to <output_dir>/results.jsonl as they finish.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # "models/x" and "x" are the same model, in caps and in manifest rows
+    model_caps = {_model_key(m): n for m, n in (model_caps or {}).items()}
+    models = {_model_key(p.get("model", default_model)) for p in pieces}
+    caps = {m: threading.BoundedSemaphore(model_caps.get(m, workers)) for m in models}
+
+    results = []
+    with open(os.path.join(output_dir, "results.jsonl"), "a", encoding="utf-8") as manifest, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_piece, p, output_dir, caps, default_model) for p in pieces]
+        for n, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            manifest.write(json.dumps(result) + "\n")
+            manifest.flush()
+            detail = "cached" if result.get("cached") else result.get("error", f"{result['seconds']}s")
+            print(f"[{n}/{len(pieces)}] {result['id']}: {result['status']} ({detail})")
+    return results
+
+
+def _parse_caps(parser: argparse.ArgumentParser, values: list[str]) -> dict[str, int]:
+    caps = {}
+    for value in values:
+        name, _, limit = value.partition("=")
+        if not name or not limit.isdigit() or int(limit) < 1:
+            parser.error(f"Invalid --model-cap {value!r}, expected MODEL=N with N >= 1")
+        caps[_model_key(name)] = int(limit)
+    return caps
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Batch lehenga try-on generation.")
+    parser.add_argument("input", help="directory of pieces or a .csv / .jsonl manifest")
+    parser.add_argument("--output-dir", default="batch_output")
+    parser.add_argument("--workers", type=int, default=4, help="thread pool size (default 4)")
+    parser.add_argument("--model", default=VISION_MODEL, help="model for rows without a model column")
+    parser.add_argument("--model-cap", action="append", default=[], metavar="MODEL=N",
+                        help="max concurrent calls to MODEL (repeatable)")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    caps = _parse_caps(parser, args.model_cap)
+
+    if os.path.isdir(args.input):
+        pieces = scan_directory(args.input)
+    else:
+        pieces = read_manifest(args.input)
+    if not pieces:
+        parser.error(f"No lehenga images found in {args.input}")
+
+    started = time.perf_counter()
+    results = run_batch(pieces, args.output_dir, args.workers, caps, args.model)
+    minutes = (time.perf_counter() - started) / 60
+
+    done = [r for r in results if r["status"] == "ok"]
+    cached = sum(1 for r in done if r.get("cached"))
+    print("-" * 50)
+    print(f"Generated {len(done)}/{len(results)} images ({cached} from cache) in {minutes * 60:.1f}s")
+    print(f"Throughput: {len(done) / minutes if minutes else 0:.1f} images/min")
+    print(f"Results manifest: {os.path.join(args.output_dir, 'results.jsonl')}")
+
+
+if __name__ == "__main__":
+    main()
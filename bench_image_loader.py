@@ -0,0 +1,93 @@
+"""
+Decode time and peak RSS per upload size: full decode vs image_loader's
+reduced-scale (DCT) decode for a model input and a 360 px preview.
+
+    python bench_image_loader.py > bench_output.txt
+
+Each case runs in a fresh process so peak RSS is not polluted by earlier runs.
+"""
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from image_loader import INPUT_DECODE_MAX_SIDE, load_image
+
+SIZES_MP = (12, 24, 45)
+REPEATS = 3
+CASES = (
+    ("full decode", None),
+    ("model input", INPUT_DECODE_MAX_SIDE),
+    ("preview 360px", 720),
+)
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the peak (VmHWM) to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _make_jpeg(path: str, megapixels: int):
+    import numpy as np
+
+    height = int((megapixels * 1e6 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    rng = np.random.default_rng(megapixels)
+    base = rng.integers(0, 255, (height // 64 + 1, width // 64 + 1, 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((width, height), Image.Resampling.BICUBIC)
+    img.save(path, "JPEG", quality=92)
+
+
+def _run_case(path: str, target_side: int | None, queue):
+    _reset_peak_rss()
+    baseline = _peak_rss_mb()
+    times = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        img = load_image(path, target_side)
+        times.append(time.perf_counter() - started)
+        del img
+    img = load_image(path, target_side)
+    queue.put((min(times) * 1000, _peak_rss_mb() - baseline, img.size))
+
+
+def main():
+    ctx = mp.get_context("spawn")
+    print(f"{'upload':>8} {'file MB':>8} {'case':>14} {'decoded':>11} {'ms':>8} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for megapixels in SIZES_MP:
+            path = os.path.join(tmp, f"{megapixels}mp.jpg")
+            _make_jpeg(path, megapixels)
+            file_mb = os.path.getsize(path) / 1e6
+            for label, target_side in CASES:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=_run_case, args=(path, target_side, queue))
+                proc.start()
+                ms, rss, size = queue.get()
+                proc.join()
+                print(f"{megapixels:>6}MP {file_mb:>8.1f} {label:>14} {size[0]:>5}x{size[1]:<5} {ms:>8.1f} {rss:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
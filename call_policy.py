@@ -0,0 +1,465 @@
+import contextvars
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from rate_limiter import RateLimitTimeout, WaitTally, counting_waits
+from tracing import record_span
+from usage_ledger import outcome
+
+log = logging.getLogger(__name__)
+
+# -------------------------
+# Settings
+# -------------------------
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+# Give up retrying once this much time has passed since the first attempt
+RETRY_DEADLINE = float(os.getenv("RETRY_DEADLINE", "240"))
+# Each call earns this fraction of a retry; retries and hedges spend one
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "10"))
+RETRY_AFTER_MODE = os.getenv("RETRY_AFTER_MODE", "honor")  # honor | ignore
+# Hedging: a second request once the first is slower than the model's p95
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "5"))
+# Circuit breaker: opens when BREAKER_ERROR_RATE of the last BREAKER_WINDOW
+# calls failed or took longer than BREAKER_SLOW_SECONDS
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_SECONDS = float(os.getenv("BREAKER_SLOW_SECONDS", "90"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "60"))
+# Where calls go while a model's breaker is open, in order, e.g.
+# MODEL_FALLBACKS="gemini-3-pro-image-preview=gemini-2.5-flash-image|other-model"
+DEFAULT_FALLBACKS = {
+    "gemini-3-pro-image-preview": ("gemini-2.5-flash-image",),
+}
+
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+LATENCY_SAMPLES = 200
+
+
+def _model_key(model: str) -> str:
+    return model.strip().removeprefix("models/")
+
+
+def _parse_fallbacks(spec: str) -> dict[str, tuple[str, ...]]:
+    fallbacks = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, chain = item.partition("=")
+        fallbacks[_model_key(name)] = tuple(_model_key(m) for m in chain.split("|") if m.strip())
+    return fallbacks
+
+
+MODEL_FALLBACKS = {**DEFAULT_FALLBACKS, **_parse_fallbacks(os.getenv("MODEL_FALLBACKS", ""))}
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    The model and every fallback in its chain have an open breaker.
+    """
+
+
+# -------------------------
+# Error classification
+# -------------------------
+def retryable(error: BaseException) -> bool:
+    """
+    Rate limits, overload, server errors, timeouts and dropped connections.
+    Bad requests and safety blocks are not worth a second attempt.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_CODES
+    # httpx transport errors (connect / read failures) raised by google.genai
+    return type(error).__module__.startswith("httpx")
+
+
+def _seconds(value) -> float | None:
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"\s*([\d.]+)s?\s*", str(value))
+    return float(match.group(1)) if match else None
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Server-requested delay: the Retry-After header, or the RetryInfo detail
+    the Gemini API attaches to 429s (google.genai JSON or api_core protos).
+    """
+    response = getattr(error, "response", None)
+    header = getattr(response, "headers", None) or {}
+    if "retry-after" in header:
+        return _seconds(header["retry-after"])
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        details = details.get("error", {}).get("details", [])
+    for detail in details or []:
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            return _seconds(detail["retryDelay"])
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+# -------------------------
+# Per-model state
+# -------------------------
+class RetryBudget:
+    """
+    Token bucket that caps retries (and hedges) at RETRY_BUDGET_RATIO of
+    the calls made, so a failing model isn't hit with a retry storm.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, maximum: float = RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self._tokens = maximum
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.maximum, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class LatencyWindow:
+    """
+    The last LATENCY_SAMPLES successful call latencies of one model.
+    """
+
+    def __init__(self, size: int = LATENCY_SAMPLES):
+        self._samples: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int = HEDGE_MIN_SAMPLES) -> float | None:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class CircuitBreaker:
+    """
+    Health of one model over its last BREAKER_WINDOW calls. closed: calls
+    flow. open: calls are refused for BREAKER_OPEN_SECONDS. half-open: one
+    probe call is let through; its outcome closes or re-opens the breaker.
+    Only server-side trouble counts (retryable errors, slow calls); a 400
+    means the model answered.
+
+    allow() hands out a ticket that goes back with record(). Tickets from
+    before the breaker last opened are stale and ignored, so a call that
+    started before an outage can't close the breaker (or re-open it) while
+    the real probe is still running.
+    """
+
+    def __init__(
+        self,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        error_rate: float = BREAKER_ERROR_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS
+    ):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._outcomes: deque = deque(maxlen=window)
+        self._opened_at = 0.0
+        # Bumped each time the breaker opens; tickets carry the one they were issued in
+        self._epoch = 0
+        self._probe: tuple[int, bool] | None = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> tuple[int, bool] | None:
+        """
+        A ticket for one call, or None when the call must not go to this model.
+        """
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+                self.state = "half-open"
+            if self.state == "closed":
+                return (self._epoch, False)
+            if self.state == "half-open" and self._probe is None:
+                self._probe = (self._epoch, True)
+                return self._probe
+            return None
+
+    def release(self, ticket: tuple[int, bool] | None):
+        """
+        Returns a ticket whose call ended without saying anything about the
+        model (e.g. it never left the local rate limiter).
+        """
+        with self._lock:
+            if ticket is not None and ticket == self._probe:
+                self._probe = None
+
+    def record(self, ok: bool, ticket: tuple[int, bool] | None) -> str:
+        """
+        Adds the outcome of the call allow() issued ticket for; returns the
+        new state. Only the probe's outcome counts while half-open.
+        """
+        with self._lock:
+            if ticket is None or ticket[0] != self._epoch:
+                return self.state
+            if self.state == "half-open":
+                if ticket != self._probe:
+                    return self.state
+                self._probe = None
+                self._outcomes.clear()
+                self._set("closed" if ok else "open")
+            elif self.state == "open":
+                return self.state
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if (self.state == "closed" and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.error_rate):
+                self._set("open")
+            return self.state
+
+    def _set(self, state: str):
+        if state == "open":
+            self._opened_at = time.monotonic()
+            self._epoch += 1
+        self.state = state
+
+    def error_rate_now(self) -> float:
+        with self._lock:
+            return self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0
+
+
+# -------------------------
+# Policy
+# -------------------------
+class CallPolicy:
+    """
+    Wraps one model call in retries with full-jitter exponential backoff
+    (or the server's Retry-After), bounded by attempts, RETRY_DEADLINE and
+    a per-model retry budget. With hedging on, a second identical request
+    is sent when the first outlives the model's p95 latency and the first
+    response wins; the other request still runs to completion (and is
+    billed), so hedges spend from the retry budget too.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+        deadline: float = RETRY_DEADLINE,
+        honor_retry_after: bool = RETRY_AFTER_MODE == "honor",
+        hedge: bool = HEDGE_ENABLED,
+        fallbacks: dict[str, tuple[str, ...]] | None = None
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.honor_retry_after = honor_retry_after
+        self.hedge = hedge
+        self.fallbacks = MODEL_FALLBACKS if fallbacks is None else fallbacks
+        self._lock = threading.Lock()
+        self._budgets: dict[str, RetryBudget] = {}
+        self._latencies: dict[str, LatencyWindow] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+    def _state(self, model: str) -> tuple[RetryBudget, LatencyWindow]:
+        key = _model_key(model)
+        with self._lock:
+            if key not in self._budgets:
+                self._budgets[key] = RetryBudget()
+                self._latencies[key] = LatencyWindow()
+            return self._budgets[key], self._latencies[key]
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        key = _model_key(model)
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker()
+            return self._breakers[key]
+
+    def route(self, model: str) -> tuple[str, tuple[int, bool]]:
+        """
+        (name, breaker ticket) for the model itself while its breaker lets
+        calls through, else for the first fallback in MODEL_FALLBACKS whose
+        breaker does. Raises CircuitOpenError when the whole chain is open.
+        """
+        chain = (model, *self.fallbacks.get(_model_key(model), ()))
+        for name in chain:
+            ticket = self.breaker(name).allow()
+            if ticket is not None:
+                if name != model:
+                    log.warning("%s circuit open; routing to %s", model, name)
+                return name, ticket
+        if len(chain) == 1:
+            raise CircuitOpenError(f"{model} is failing (circuit open) and has no fallback in MODEL_FALLBACKS")
+        raise CircuitOpenError(f"{model} and its fallbacks ({', '.join(chain[1:])}) are all failing (circuits open)")
+
+    def health(self) -> list[dict]:
+        """
+        Breaker state, recent error rate and p50 / p95 latency per model called.
+        """
+        with self._lock:
+            names = sorted(self._breakers)
+        rows = []
+        for name in names:
+            _, latencies = self._state(name)
+            p50, p95 = latencies.quantile(0.5, 1), latencies.quantile(0.95, 1)
+            rows.append({
+                "model": name,
+                "breaker": self.breaker(name).state,
+                "error rate": round(self.breaker(name).error_rate_now(), 2),
+                "p50 s": round(p50, 1) if p50 is not None else None,
+                "p95 s": round(p95, 1) if p95 is not None else None,
+            })
+        return rows
+
+    def backoff(self, attempt: int, error: BaseException | None = None) -> float:
+        """
+        Delay before retry number attempt + 1: Retry-After when honored,
+        else uniform in [0, min(max_delay, base_delay * 2**attempt)].
+        """
+        if self.honor_retry_after and error is not None:
+            requested = retry_after(error)
+            if requested is not None:
+                return min(requested, self.max_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, model: str, fn):
+        """
+        Returns fn(name), where name is model or, while its breaker is open,
+        a fallback; retries retryable failures. The last error is raised
+        once attempts, the deadline or the retry budget run out.
+        """
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_attempts):
+            # Re-routed every attempt: a retry after the breaker opened goes to the fallback
+            name, ticket = self.route(model)
+            budget, latencies = self._state(name)
+            if attempt == 0:
+                budget.deposit()
+            try:
+                return self._attempt(name, fn, budget, latencies, ticket)
+            except Exception as e:
+                if not retryable(e) or attempt + 1 >= self.max_attempts:
+                    raise
+                delay = self.backoff(attempt, e)
+                if time.monotonic() + delay > deadline or not budget.withdraw():
+                    raise
+                log.warning("%s call failed (%s); retry %d in %.1f s", name, outcome(e), attempt + 1, delay)
+                time.sleep(delay)
+                record_span("backoff", delay, attempt=attempt + 1, reason=outcome(e))
+
+    def _timed(self, model: str, fn, latencies: LatencyWindow, ticket, tally: WaitTally | None = None):
+        """
+        fn(model), sampling its latency minus any rate limit wait inside it:
+        a congested local limiter must not look like a slow model (hedges,
+        slow-call breaker trips). A limiter timeout says nothing about the
+        model, so it only hands the breaker ticket back.
+        """
+        breaker = self.breaker(model)
+        started = time.perf_counter()
+        try:
+            with counting_waits(tally) as tally:
+                result = fn(model)
+        except RateLimitTimeout:
+            breaker.release(ticket)
+            raise
+        except Exception as e:
+            self._record(model, breaker, not retryable(e), ticket)
+            raise
+        elapsed = max(0.0, time.perf_counter() - started - tally.seconds())
+        latencies.add(elapsed)
+        self._record(model, breaker, elapsed <= BREAKER_SLOW_SECONDS, ticket)
+        return result
+
+    def _record(self, model: str, breaker: CircuitBreaker, ok: bool, ticket):
+        before = breaker.state
+        after = breaker.record(ok, ticket)
+        if after != before:
+            log.warning("%s circuit %s -> %s", model, before, after)
+
+    def _attempt(self, model: str, fn, budget: RetryBudget, latencies: LatencyWindow, ticket):
+        hedge_after = latencies.quantile(HEDGE_QUANTILE) if self.hedge else None
+        if hedge_after is None:
+            return self._timed(model, fn, latencies, ticket)
+
+        # Both legs run on pool threads in the caller's context (usage tags,
+        # trace) and share the ticket; when it is a probe, the first to finish decides
+        def leg(tally: WaitTally):
+            return self._hedge_pool.submit(
+                contextvars.copy_context().run, self._timed, model, fn, latencies, ticket, tally
+            )
+
+        # The hedge clock only runs once the first leg is past the rate limiter
+        tally = WaitTally()
+        legs = [leg(tally)]
+        started = time.monotonic()
+        delay = max(HEDGE_MIN_DELAY, hedge_after)
+        while not legs[0].done():
+            remaining = started + delay + tally.seconds() - time.monotonic()
+            if remaining > 0:
+                wait(legs, timeout=remaining)
+                continue
+            if budget.withdraw():
+                log.info("%s call slower than p%d (%.1f s); sending a hedge", model, HEDGE_QUANTILE * 100, hedge_after)
+                legs.append(leg(WaitTally()))
+            break
+        # Legs can finish in the same wait; any success wins over a failure,
+        # which is only raised once every leg has failed
+        pending = set(legs)
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+            if not pending:
+                return next(iter(done)).result()
+
+
+_default_policy: CallPolicy | None = None
+_default_lock = threading.Lock()
+
+
+def default_policy() -> CallPolicy:
+    """
+    Process-wide policy, so retry budgets and latency windows are shared
+    by every session.
+    """
+    global _default_policy
+    with _default_lock:
+        if _default_policy is None:
+            _default_policy = CallPolicy()
+        return _default_policy
+
+
+def call_with_policy(model: str, fn):
+    """
+    default_policy().call(model, fn): fn(model) with retries (and hedging
+    when HEDGE_ENABLED=1).
+    """
+    return default_policy().call(model, fn)
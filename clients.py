@@ -0,0 +1,90 @@
+import os
+import threading
+
+import httpx
+import google.generativeai as legacy_genai
+from dotenv import load_dotenv
+from google import genai
+from google.genai import types
+
+from usage_ledger import MeteredModel
+
+# -------------------------
+# Settings
+# -------------------------
+POOL_MAX_CONNECTIONS = int(os.getenv("GENAI_POOL_MAX_CONNECTIONS", "64"))
+POOL_MAX_KEEPALIVE = int(os.getenv("GENAI_POOL_MAX_KEEPALIVE", "32"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("GENAI_POOL_KEEPALIVE_EXPIRY", "120"))
+HTTP_TIMEOUT = float(os.getenv("GENAI_HTTP_TIMEOUT", "300"))
+
+_lock = threading.RLock()
+_configured_key: str | None = None
+_models: dict[str, MeteredModel] = {}
+_clients: dict[str, genai.Client] = {}
+
+
+def _api_key(api_key: str | None) -> str | None:
+    if api_key:
+        return api_key
+    load_dotenv()
+    return os.getenv("GOOGLE_API_KEY")
+
+
+# -------------------------
+# google.generativeai (legacy SDK)
+# -------------------------
+def configure_genai(api_key: str | None = None):
+    """
+    genai.configure() once per process. Reconfiguring on every Streamlit
+    rerun would drop the SDK's channel and its open connections.
+    """
+    global _configured_key
+    api_key = _api_key(api_key)
+    with _lock:
+        if api_key != _configured_key:
+            legacy_genai.configure(api_key=api_key)
+            _configured_key = api_key
+            _models.clear()
+
+
+def generative_model(name: str) -> MeteredModel:
+    """
+    Shared GenerativeModel handle; built on first use, then reused.
+    Its generate_content() calls are recorded in the usage ledger.
+    """
+    with _lock:
+        if _configured_key is None:
+            configure_genai()
+        if name not in _models:
+            _models[name] = MeteredModel(legacy_genai.GenerativeModel(name), name)
+        return _models[name]
+
+
+# -------------------------
+# google.genai
+# -------------------------
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+def genai_client(api_key: str | None = None) -> genai.Client:
+    """
+    Shared google.genai Client per API key, backed by pooled keep-alive
+    httpx clients (sync and async) sized by the GENAI_POOL_* settings.
+    """
+    api_key = _api_key(api_key)
+    with _lock:
+        if api_key not in _clients:
+            timeout = httpx.Timeout(HTTP_TIMEOUT, connect=10.0)
+            _clients[api_key] = genai.Client(
+                api_key=api_key,
+                http_options=types.HttpOptions(
+                    httpx_client=httpx.Client(limits=_limits(), timeout=timeout),
+                    httpx_async_client=httpx.AsyncClient(limits=_limits(), timeout=timeout),
+                ),
+            )
+        return _clients[api_key]
@@ -0,0 +1,356 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from io import BytesIO
+
+from PIL import Image
+
+from image_output import decode, extension
+from result_cache import CACHE_DIR
+
+# -------------------------
+# Settings
+# -------------------------
+HISTORY_DB = os.getenv("HISTORY_DB", os.path.join(CACHE_DIR, "history.db"))
+HISTORY_DIR = os.getenv("HISTORY_DIR", os.path.join(CACHE_DIR, "history"))
+HISTORY_BUSY_TIMEOUT_MS = 10000
+THUMBNAIL_SIZE = int(os.getenv("HISTORY_THUMBNAIL_SIZE", "320"))
+THUMBNAIL_QUALITY = 80
+# Seconds a gallery total stays cached before COUNT(*) runs again
+HISTORY_COUNT_TTL = float(os.getenv("HISTORY_COUNT_TTL", "30"))
+# Jobs still 'running' this long after they started were cut off by a crash
+# or restart; they are marked failed when a store opens the database
+HISTORY_STALE_SECONDS = float(os.getenv("HISTORY_STALE_SECONDS", "900"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            TEXT PRIMARY KEY,
+    created_at    REAL NOT NULL,
+    finished_at   REAL,
+    status        TEXT NOT NULL,
+    source        TEXT,
+    garment_id    TEXT,
+    cache_key     TEXT NOT NULL,
+    lehenga_digest TEXT,
+    input_hashes  TEXT,
+    prompt        TEXT,
+    model         TEXT,
+    config        TEXT,
+    input_tokens  INTEGER,
+    output_tokens INTEGER,
+    duration      REAL,
+    error         TEXT,
+    image_path    TEXT,
+    mime          TEXT,
+    image_bytes   INTEGER
+);
+"""
+# Applied in order to databases whose PRAGMA user_version is below their index
+_MIGRATIONS = [
+    # 1: input_hash held the result cache key; the lehenga's own digest gets a column
+    """
+    ALTER TABLE jobs RENAME COLUMN input_hash TO cache_key;
+    ALTER TABLE jobs ADD COLUMN lehenga_digest TEXT;
+    UPDATE jobs SET lehenga_digest = json_extract(input_hashes, '$[0]') WHERE input_hashes IS NOT NULL;
+    DROP INDEX IF EXISTS jobs_input_hash;
+    """,
+]
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key, status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_lehenga ON jobs (lehenga_digest, created_at);
+-- Keyset pages order by (created_at, id), so these replace the older indexes without id
+DROP INDEX IF EXISTS jobs_garment;
+DROP INDEX IF EXISTS jobs_created;
+CREATE INDEX IF NOT EXISTS jobs_garment_page ON jobs (garment_id, created_at, id);
+CREATE INDEX IF NOT EXISTS jobs_created_page ON jobs (created_at, id);
+"""
+# Columns a gallery page needs; never the prompt or config text
+_LISTING = "id, created_at, status, garment_id, model, duration, image_path, mime, image_bytes"
+
+
+def make_thumbnail(image: bytes, size: int = THUMBNAIL_SIZE) -> bytes:
+    """
+    Small WebP of a generated image for gallery grids.
+    """
+    img = decode(image)
+    img.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    buf = BytesIO()
+    img.save(buf, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+    return buf.getvalue()
+
+
+class HistoryStore:
+    """
+    Durable record of every generation: cache key, input digests, prompt, model, config,
+    status, timings and token usage in SQLite, with the image bytes stored
+    as plain files under image_dir (the database only holds their path)
+    next to a pre-generated WebP thumbnail.
+
+    The database runs in WAL mode with one connection per thread, so readers
+    never block the writer, and every write is a single short statement:
+    image files are written before the row is updated, never inside a
+    transaction, so concurrent Streamlit sessions don't queue on the lock.
+    """
+
+    def __init__(self, path: str = HISTORY_DB, image_dir: str = HISTORY_DIR):
+        self.path = path
+        self.image_dir = image_dir
+        self._local = threading.local()
+        self._counts: dict[str | None, tuple[float, int]] = {}
+        self._counts_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        os.makedirs(image_dir, exist_ok=True)
+        self._migrate()
+        self._fail_stale()
+
+    def _migrate(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            if not columns:
+                # New database: the table already has the current columns
+                conn.execute(_SCHEMA)
+                version = len(_MIGRATIONS)
+            for script in _MIGRATIONS[version:]:
+                for statement in filter(str.strip, script.split(";")):
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+            for statement in filter(str.strip, _INDEXES.split(";")):
+                conn.execute(statement)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _fail_stale(self):
+        """
+        Marks jobs left 'running' by a crashed or restarted process as failed.
+        Only ones older than HISTORY_STALE_SECONDS, since other processes
+        (batch runs, other servers) may share the database.
+        """
+        now = time.time()
+        self._conn().execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?, error = 'interrupted (process exited)'"
+            " WHERE status = 'running' AND created_at < ?",
+            (now, now - HISTORY_STALE_SECONDS),
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=HISTORY_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={HISTORY_BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+        return conn
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def start(
+        self,
+        cache_key: str,
+        model: str,
+        prompt: str | None = None,
+        config=None,
+        input_hashes: list[str | None] | None = None,
+        garment_id: str | None = None,
+        source: str | None = None
+    ) -> str:
+        """
+        Records a generation as running and returns its job id. input_hashes
+        are the image digests, lehenga first.
+        """
+        job_id = uuid.uuid4().hex
+        if hasattr(config, "model_dump"):
+            config = config.model_dump(exclude_none=True)
+        self._conn().execute(
+            "INSERT INTO jobs (id, created_at, status, source, garment_id, cache_key, lehenga_digest, input_hashes,"
+            " prompt, model, config) VALUES (?, ?, 'running', ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                job_id, time.time(), source, garment_id, cache_key, input_hashes[0] if input_hashes else None,
+                json.dumps(input_hashes) if input_hashes is not None else None,
+                prompt, model,
+                json.dumps(config, sort_keys=True, default=str) if config is not None else None,
+            ),
+        )
+        return job_id
+
+    def finish(
+        self,
+        job_id: str,
+        image: bytes,
+        mime: str,
+        input_tokens: int | None = None,
+        output_tokens: int | None = None,
+        model: str | None = None
+    ):
+        """
+        Stores the image and marks the job done. model is the one that
+        actually rendered it, when a fallback stood in for the requested one.
+        """
+        now = time.time()
+        relative = os.path.join(time.strftime("%Y/%m", time.localtime(now)), f"{job_id}.{extension(mime)}")
+        path = os.path.join(self.image_dir, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(image)
+        os.replace(tmp, path)
+        self._write_thumbnail(relative, image)
+        self._conn().execute(
+            "UPDATE jobs SET status = 'done', finished_at = ?, duration = ? - created_at, input_tokens = ?,"
+            " output_tokens = ?, image_path = ?, mime = ?, image_bytes = ?, model = COALESCE(?, model) WHERE id = ?",
+            (now, now, input_tokens, output_tokens, relative, mime, len(image), model, job_id),
+        )
+        with self._counts_lock:
+            self._counts.clear()
+
+    def _thumbnail_path(self, image_path: str) -> str:
+        return os.path.join(self.image_dir, os.path.splitext(image_path)[0] + ".thumb.webp")
+
+    def _write_thumbnail(self, image_path: str, image: bytes) -> bytes | None:
+        try:
+            thumb = make_thumbnail(image)
+        except OSError:
+            return None
+        path = self._thumbnail_path(image_path)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(thumb)
+        os.replace(tmp, path)
+        return thumb
+
+    def fail(self, job_id: str, error: str):
+        now = time.time()
+        self._conn().execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?, duration = ? - created_at, error = ? WHERE id = ?",
+            (now, now, error, job_id),
+        )
+
+    # -------------------------
+    # Lookups
+    # -------------------------
+    def get(self, job_id: str) -> dict | None:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def lookup(self, cache_key: str, model: str | None = None) -> dict | None:
+        """
+        Latest finished generation for exactly these inputs, prompt, model and
+        config; with model, only one that model rendered (not a fallback).
+        """
+        row = self._conn().execute(
+            "SELECT * FROM jobs WHERE cache_key = ? AND status = 'done' AND (? IS NULL OR model = ?)"
+            " ORDER BY created_at DESC LIMIT 1",
+            (cache_key, model, model),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def for_garment(self, garment_id: str, limit: int = 50) -> list[dict]:
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE garment_id = ? ORDER BY created_at DESC LIMIT ?",
+            (garment_id, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def for_lehenga(self, lehenga_digest: str, limit: int = 50) -> list[dict]:
+        """
+        Every generation from this lehenga image, whatever the references,
+        prompt or model.
+        """
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE lehenga_digest = ? ORDER BY created_at DESC LIMIT ?",
+            (lehenga_digest, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def between(self, since: float, until: float | None = None, limit: int = 500) -> list[dict]:
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE created_at >= ? AND created_at < ? ORDER BY created_at DESC LIMIT ?",
+            (since, until or time.time() + 1, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def page(self, limit: int = 24, before: tuple[float, str] | None = None, garment_id: str | None = None) -> list[dict]:
+        """
+        One page of finished generations, newest first. Keyset pagination:
+        pass the (created_at, id) of the last row as `before` for the next
+        page, so deep pages cost the same as the first.
+        """
+        where, args = ["status = 'done'"], []
+        if garment_id:
+            where.append("garment_id = ?")
+            args.append(garment_id)
+        if before:
+            where.append("(created_at, id) < (?, ?)")
+            args += list(before)
+        rows = self._conn().execute(
+            f"SELECT {_LISTING} FROM jobs WHERE {' AND '.join(where)} ORDER BY created_at DESC, id DESC LIMIT ?",
+            (*args, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def count(self, garment_id: str | None = None) -> int:
+        """
+        Finished generations (of one garment). Cached for HISTORY_COUNT_TTL
+        seconds so gallery reruns don't scan the table each time; a finish()
+        in this process refreshes it sooner.
+        """
+        garment_id = garment_id or None
+        with self._counts_lock:
+            cached = self._counts.get(garment_id)
+        if cached and time.monotonic() - cached[0] < HISTORY_COUNT_TTL:
+            return cached[1]
+        if garment_id:
+            sql, args = "SELECT COUNT(*) FROM jobs WHERE status = 'done' AND garment_id = ?", (garment_id,)
+        else:
+            sql, args = "SELECT COUNT(*) FROM jobs WHERE status = 'done'", ()
+        total = self._conn().execute(sql, args).fetchone()[0]
+        with self._counts_lock:
+            self._counts[garment_id] = (time.monotonic(), total)
+        return total
+
+    def read_thumbnail(self, job: dict | None) -> bytes | None:
+        """
+        The job's WebP thumbnail; built from the full image (once) if missing.
+        """
+        if not job or not job.get("image_path"):
+            return None
+        try:
+            with open(self._thumbnail_path(job["image_path"]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            image = self.read_image(job)
+            return self._write_thumbnail(job["image_path"], image) if image else None
+
+    def read_image(self, job: dict | None) -> bytes | None:
+        if not job or not job.get("image_path"):
+            return None
+        try:
+            with open(os.path.join(self.image_dir, job["image_path"]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+_default_store: HistoryStore | None = None
+_default_lock = threading.Lock()
+
+
+def default_store() -> HistoryStore:
+    """
+    Process-wide store; every session, job worker and batch thread shares it.
+    """
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = HistoryStore()
+        return _default_store
@@ -0,0 +1,33 @@
+import math
+import os
+
+from PIL import Image
+
+from tracing import span
+
+# -------------------------
+# Settings
+# -------------------------
+# Largest long edge any reference policy in image_prep can send (3 tiles x 768 px)
+INPUT_DECODE_MAX_SIDE = int(os.getenv("INPUT_DECODE_MAX_SIDE", "2304"))
+
+
+def load_image(source, target_side: int | None = INPUT_DECODE_MAX_SIDE) -> Image.Image:
+    """
+    Opens an image as RGB, decoded only as large as target_side needs.
+
+    JPEGs at least twice target_side on the long edge are decoded with
+    libjpeg's DCT scaling (1/2, 1/4 or 1/8) via Image.draft: the result is
+    the smallest scale whose long edge is still >= target_side, so a 45 MP
+    upload never materializes at full resolution. Other formats, or JPEGs
+    close to the target, fall back to a full decode. No resampling happens
+    here; callers resize to their exact size once (image_prep, thumbnails).
+    target_side=None always decodes at full size.
+    """
+    with span("decode") as s:
+        img = Image.open(source)
+        s.set(format=img.format, source_size=img.size)
+        if target_side and img.format == "JPEG" and max(img.size) >= 2 * target_side:
+            scale = target_side / max(img.size)
+            img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        return img.convert("RGB")
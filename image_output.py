@@ -0,0 +1,62 @@
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+
+
+def sniff_mime(data: bytes) -> str:
+    """
+    Image MIME type from the leading magic bytes (defaults to JPEG).
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime in _SIGNATURES:
+        if data.startswith(magic):
+            return mime
+    return "image/jpeg"
+
+
+def extension(mime: str) -> str:
+    return _EXTENSIONS.get(mime, "jpg")
+
+
+def _parts(response) -> list:
+    parts = getattr(response, "parts", None)
+    if parts:
+        return list(parts)
+    for candidate in getattr(response, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        if content and content.parts:
+            return list(content.parts)
+    return []
+
+
+def extract_image(response) -> tuple[bytes, str] | None:
+    """
+    First image in a model response as (encoded bytes, mime type), exactly as
+    the model sent it: no decode, no re-encode. Works for google.genai and
+    google.generativeai responses; base64 strings are decoded.
+    """
+    for part in _parts(response):
+        inline = getattr(part, "inline_data", None)
+        data = getattr(inline, "data", None) if inline else None
+        if not data:
+            continue
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        return data, getattr(inline, "mime_type", None) or sniff_mime(data)
+    return None
+
+
+def decode(data: bytes) -> Image.Image:
+    """
+    Decode only when a transform (crop, resize, scoring) really needs pixels.
+    """
+    return Image.open(BytesIO(data)).convert("RGB")
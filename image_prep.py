@@ -0,0 +1,80 @@
+import math
+from io import BytesIO
+
+from PIL import Image
+
+from rate_limiter import IMAGE_TILE_SIZE, image_tokens
+
+# -------------------------
+# Resize policies
+# -------------------------
+# max_tiles:     hard cap on 768x768 tiles billed for the reference
+# min_long_edge: smallest long edge that still keeps the detail we need;
+#                the smallest tile layout reaching it wins
+POLICIES = {
+    "full": {"max_tiles": 4, "min_long_edge": 1280, "quality": 90, "subsampling": "4:2:0"},
+    "closeup": {"max_tiles": 9, "min_long_edge": 2048, "quality": 92, "subsampling": "4:4:4"},
+}
+
+
+def fit_to_tiles(width: int, height: int, max_tiles: int, min_long_edge: int) -> tuple[int, int]:
+    """
+    Target size for an image: the layout with the fewest 768 px tiles whose
+    long edge is at least min_long_edge (or the full image, if smaller).
+    Never upscales.
+    """
+    target = min(min_long_edge, max(width, height))
+    best = None
+    for cols in range(1, max_tiles + 1):
+        for rows in range(1, max_tiles // cols + 1):
+            scale = min(1.0, cols * IMAGE_TILE_SIZE / width, rows * IMAGE_TILE_SIZE / height)
+            w, h = max(1, int(width * scale)), max(1, int(height * scale))
+            tiles = math.ceil(w / IMAGE_TILE_SIZE) * math.ceil(h / IMAGE_TILE_SIZE)
+            reaches = max(w, h) >= target
+            rank = (not reaches, tiles if reaches else -max(w, h))
+            if best is None or rank < best[0]:
+                best = (rank, (w, h))
+    return best[1]
+
+
+def prepare_image(img: Image.Image, role: str = "full", source_bytes: int | None = None) -> tuple[bytes, dict]:
+    """
+    Resizes a reference to its policy's tile layout and re-encodes it as JPEG.
+    Returns (jpeg bytes, stats) where stats carries sizes, bytes and token estimates.
+    """
+    policy = POLICIES[role]
+    size = fit_to_tiles(img.width, img.height, policy["max_tiles"], policy["min_long_edge"])
+    out = img.convert("RGB") if img.mode != "RGB" else img
+    if size != (img.width, img.height):
+        out = out.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    buf = BytesIO()
+    out.save(buf, "JPEG", quality=policy["quality"], subsampling=policy["subsampling"], optimize=True)
+    data = buf.getvalue()
+
+    stats = {
+        "role": role,
+        "source_size": (img.width, img.height),
+        "size": size,
+        "source_tokens": image_tokens(img),
+        "tokens": image_tokens(out),
+        "source_bytes": source_bytes,
+        "bytes": len(data),
+    }
+    return data, stats
+
+
+def summarize(stats: list[dict]) -> str:
+    """
+    One-line report of what preprocessing saved for a request.
+    """
+    tokens = sum(s["tokens"] for s in stats)
+    source_tokens = sum(s["source_tokens"] for s in stats)
+    sent = sum(s["bytes"] for s in stats)
+    line = f"Uploaded {len(stats)} reference(s): {sent / 1e6:.2f} MB, ~{tokens} input tokens"
+    line += f" (saved ~{source_tokens - tokens} tokens"
+    known = [s for s in stats if s["source_bytes"]]
+    if known:
+        saved = sum(s["source_bytes"] - s["bytes"] for s in known)
+        line += f", {saved / 1e6:.2f} MB"
+    return line + ")"
@@ -0,0 +1,156 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import current_span, record_span, span
+
+log = logging.getLogger(__name__)
+
+# -------------------------
+# Settings
+# -------------------------
+# JOB_MODEL_CAPS="gemini-3-pro-image-preview=4,gemini-2.5-flash-image=8"
+JOB_MODEL_CAP = int(os.getenv("JOB_MODEL_CAP", "4"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+
+
+def _model_key(model: str) -> str:
+    return model.strip().removeprefix("models/")
+
+
+def _parse_caps(spec: str) -> dict[str, int]:
+    caps = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, limit = item.partition("=")
+        caps[_model_key(name)] = max(1, int(limit or JOB_MODEL_CAP))
+    return caps
+
+
+JOB_MODEL_CAPS = _parse_caps(os.getenv("JOB_MODEL_CAPS", ""))
+
+
+class Job:
+    """
+    One queued generation. status moves queued -> running -> done | failed;
+    result holds the function's return value, error the failure message.
+    """
+
+    def __init__(self, job_id: str, model: str, key: str | None):
+        self.id = job_id
+        self.model = model
+        self.key = key
+        # Trace of the submitting request when tracing is on, else None
+        self.trace_id = (current_span() or (None,))[0]
+        self.status = "queued"
+        self.result = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self._done = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.time()) - self.created_at
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+
+class JobQueue:
+    """
+    Runs generations on worker threads outside the Streamlit script run, so
+    a refresh or tab switch doesn't abandon a paid call: the page keeps the
+    job id and attaches to the result later. Each model gets its own pool of
+    JOB_MODEL_CAPS / JOB_MODEL_CAP workers, so a busy model can't starve
+    the others. Finished jobs are kept for JOB_RETENTION_SECONDS.
+    """
+
+    def __init__(self, model_caps: dict[str, int] | None = None, retention: float = JOB_RETENTION_SECONDS):
+        self.model_caps = JOB_MODEL_CAPS if model_caps is None else model_caps
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+        self._pools: dict[str, ThreadPoolExecutor] = {}
+
+    def _pool(self, model: str) -> ThreadPoolExecutor:
+        key = _model_key(model)
+        if key not in self._pools:
+            self._pools[key] = ThreadPoolExecutor(
+                max_workers=self.model_caps.get(key, JOB_MODEL_CAP),
+                thread_name_prefix=f"job-{key}",
+            )
+        return self._pools[key]
+
+    def submit(self, fn, *args, model: str, key: str | None = None, **kwargs) -> str:
+        """
+        Queues fn(*args, **kwargs) and returns the job id. A job with the same
+        key that is still queued or running is reused instead of paying twice.
+        """
+        with self._lock:
+            self._prune()
+            if key is not None:
+                for job in self._jobs.values():
+                    if job.key == key and not job.finished:
+                        return job.id
+            job = Job(uuid.uuid4().hex, model, key)
+            self._jobs[job.id] = job
+            # Workers run in the submitter's context (usage tags and the like)
+            self._pool(model).submit(contextvars.copy_context().run, self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job: Job, fn, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        record_span("queued", job.started_at - job.created_at, job=job.id)
+        try:
+            with span("job", job=job.id, model=job.model):
+                job.result = fn(*args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            log.exception("Job %s failed", job.id)
+            job.error = str(e) or type(e).__name__
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            job._done.set()
+
+    def get(self, job_id: str | None) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id) if job_id else None
+
+    def pending(self, model: str | None = None) -> int:
+        with self._lock:
+            return sum(
+                1 for job in self._jobs.values()
+                if not job.finished and (model is None or _model_key(job.model) == _model_key(model))
+            )
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+
+_default_queue: JobQueue | None = None
+_default_lock = threading.Lock()
+
+
+def default_queue() -> JobQueue:
+    """
+    Process-wide queue shared by every session, so jobs outlive the session
+    (and the browser tab) that submitted them.
+    """
+    global _default_queue
+    with _default_lock:
+        if _default_queue is None:
+            _default_queue = JobQueue()
+        return _default_queue
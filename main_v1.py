@@ -1,11 +1,19 @@
-<<<<<<< HEAD
 import streamlit as st
 from PIL import Image
-from io import BytesIO
-import base64
+from image_loader import load_image
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
+from clients import configure_genai, generative_model
+from rate_limiter import IMAGE_OUTPUT_TOKENS, acquire, estimate_tokens
+from image_prep import prepare_image, summarize
+from image_output import extension, extract_image, sniff_mime
+from job_queue import default_queue
+from result_cache import image_digest
+from fidelity import FIDELITY_THRESHOLD, colour_fidelity, gated
+from call_policy import call_with_policy
+from usage_panel import track_usage, usage_sidebar
+from tracing import span, traced
+from trace_panel import trace_expander
 
 # accuracy ~80%
 load_dotenv()
@@ -16,14 +24,13 @@ if not GEMINI_API_KEY:
     st.info("Please add GOOGLE_API_KEY to your .env file")
     st.stop()
 
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 # Your working model name
 MODEL_NAME = "gemini-3-pro-image-preview"
-model = genai.GenerativeModel(MODEL_NAME)
 
 VIRTUAL_TRYON_PROMPT = """Generate a photorealistic image of a professional fashion model wearing this EXACT lehenga outfit.
-Preserve every detail of the original lehenga design exactly as it appears pattern, color, embroidery, waist shape, style, and skirt flow.
+Preserve every detail of the original lehenga design exactly as it appears—pattern, color, embroidery, waist shape, style, and skirt flow.
 Maintain proper body alignment, realistic fitting, and correct cloth tension around the waist, chest, cleavage area, and lower abdominal region.
 Make sure the blouse and lehenga sit naturally and continuously without gaps or separation at the belly area.
 Ensure the chest and cleavage area appear natural and match the reference garment’s coverage level.
@@ -215,11 +222,92 @@ COLOR PRESERVATION (CRITICAL):
 The output must look like a professional fashion catalog photo with the model wearing THIS EXACT lehenga design and the image should be in 2k quality."""
 
 
+# ----------------- Background generation -----------------
+jobs = default_queue()
+
+
+@traced("generate_model_image")
+def generate_model_image(input_image: Image.Image, source_size: int | None = None) -> dict:
+    """
+    Runs one try-on on a job worker (no Streamlit calls here).
+    Returns {"image": bytes | None, "mime", "description", "prep", "fidelity",
+    "attempts"}, fidelity being the output's colour match to input_image (None
+    without image). Outputs below FIDELITY_THRESHOLD are regenerated up to
+    FIDELITY_RETRIES times; the best is kept and flagged if none passed.
+    """
+    # Prepare content for the model (tile-sized JPEG instead of the full photo)
+    with span("prepare") as s:
+        input_jpeg, input_prep = prepare_image(input_image, "full", source_size)
+        s.set(bytes=input_prep["bytes"])
+    contents = [
+        VIRTUAL_TRYON_PROMPT,
+        {"mime_type": "image/jpeg", "data": input_jpeg}
+    ]
+
+    # Wait for room in the shared RPM/TPM budget, then generate
+    def generate(name: str):
+        with span("rate_limit"):
+            acquire(name, estimate_tokens(VIRTUAL_TRYON_PROMPT, IMAGE_OUTPUT_TOKENS) + input_prep["tokens"])
+        return generative_model(name).generate_content(contents)
+
+    def render(attempt: int):
+        # Retries 429/503s with backoff (and hedges slow calls when enabled)
+        response = call_with_policy(MODEL_NAME, generate)
+
+        with span("parse"):
+            description_text = "".join(
+                part.text
+                for candidate in response.candidates or []
+                for part in (candidate.content.parts if candidate.content else [])
+                if getattr(part, "text", None)
+            )
+            image = extract_image(response)
+        with span("score", attempt=attempt):
+            fidelity = colour_fidelity(input_image, image[0]) if image else None
+        return (description_text, image), fidelity
+
+    # Off-colour outputs are regenerated before anyone has to eyeball them
+    (description_text, image), fidelity, attempts = gated(render)
+    return {
+        "image": image[0] if image else None,
+        "mime": sniff_mime(image[0]) if image else None,
+        "description": description_text,
+        "prep": input_prep,
+        "fidelity": fidelity,
+        "attempts": attempts,
+    }
+
+
+@st.fragment(run_every=2)
+def job_progress(job_ids: list[str], finished: int):
+    """
+    Polls the jobs without rerunning the page; reruns it whenever another
+    candidate finishes, so results show up as they arrive.
+    """
+    running = [j for j in map(jobs.get, job_ids) if j is not None]
+    if sum(j.finished for j in running) != finished or all(j.finished for j in running):
+        st.rerun()
+    oldest = max(j.elapsed for j in running)
+    st.info(f"🎨 Generating model image in the background ({finished} of {len(running)} done, {oldest:.0f}s)... "
+            "You can refresh or switch tabs; this page reattaches to the result.")
+
+
 st.set_page_config(page_title="Virtual Lehenga Try-On", page_icon="👗", layout="wide")
 
 st.title("👗 Virtual Lehenga Try-On")
+track_usage("main_v1")
 st.markdown("Upload your lehenga image and generate a professional model try-on image")
 
+# Candidates run side by side on the model's job workers (JOB_MODEL_CAP)
+MAX_CANDIDATES = 4
+
+# The job ids live in the URL (?job=id,id,...), so a refresh or tab switch reattaches to them
+job_list = [j for j in map(jobs.get, filter(None, st.query_params.get("job", "").split(","))) if j is not None]
+if not job_list and "job" in st.query_params:
+    del st.query_params["job"]  # expired, or started by an earlier server process
+job = job_list[0] if job_list else None
+pending = any(not j.finished for j in job_list)
+
 
 col1, col2 = st.columns([1, 1])
 
@@ -235,15 +323,20 @@ with col1:
     
     # Display uploaded image
     if uploaded_file:
-        input_image = Image.open(uploaded_file).convert("RGB")
+        input_image = load_image(uploaded_file)
         st.image(input_image, caption="Input Lehenga", use_container_width=True)
         
         # Optional: Show the prompt being used
         with st.expander("📝 View Generation Prompt"):
             st.text_area("Prompt", VIRTUAL_TRYON_PROMPT, height=300, disabled=True)
     
+    count = st.slider(
+        "Candidates", 1, MAX_CANDIDATES, 1,
+        help="Generated in parallel; the one whose colours best match your upload is shown first."
+    )
+
     # Generate button
-    generate_btn = st.button("🎨 Generate Model Image", type="primary", use_container_width=True)
+    generate_btn = st.button("🎨 Generate Model Image", type="primary", use_container_width=True, disabled=pending)
 
 with col2:
     st.subheader("✨ Generated Result")
@@ -251,7 +344,7 @@ with col2:
     # Placeholder for output
     output_placeholder = st.empty()
     
-    if not uploaded_file:
+    if not uploaded_file and job is None:
         output_placeholder.info("👈 Upload a lehenga image to get started")
 
 # ----------------- Generation Logic -----------------
@@ -259,489 +352,96 @@ if generate_btn:
     if not uploaded_file:
         st.error("Please upload a lehenga image first!")
     else:
-        with st.spinner("🎨 Generating model image... This may take a moment..."):
-            try:
-                # Prepare content for the model
-                contents = [
-                    VIRTUAL_TRYON_PROMPT,
-                    input_image
-                ]
-                
-                # Generate content
-                response = model.generate_content(contents)
-                # Debug - Add temporarily
-                st.write("**Checking response parts:**")
-                if response.candidates:
-                    for i, candidate in enumerate(response.candidates):
-                      st.write(f"Candidate {i}:")
-                if candidate.content and candidate.content.parts:
-                 for j, part in enumerate(candidate.content.parts):
-                    st.write(f"  Part {j} type: {type(part)}")
-                    st.write(f"  Part {j} attributes: {[attr for attr in dir(part) if not attr.startswith('_')]}")
-                
-                # Extract generated image and description
-                description_text = ""
-                output_image_data = None
-                
-                # Try to get text first
-                try:
-                    if hasattr(response, 'text'):
-                        description_text = response.text
-                except:
-                    pass
-                
-                # Check candidates for parts
-                if hasattr(response, 'candidates') and response.candidates:
-                    for candidate in response.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            content = candidate.content
-                            if hasattr(content, 'parts') and content.parts:
-                                for part in content.parts:
-                                    # Try to get text from part
-                                    try:
-                                        if hasattr(part, 'text'):
-                                            part_text = part.text
-                                            if part_text:
-                                                description_text += part_text
-                                    except:
-                                        pass
-                                    
-                                    # Try to get image data from inline_data
-                                    try:
-                                        if hasattr(part, 'inline_data'):
-                                            inline = part.inline_data
-                                            if hasattr(inline, 'data'):
-                                                img_data = inline.data
-                                                # Handle both bytes and base64 string
-                                                if isinstance(img_data, bytes):
-                                                    output_image_data = img_data
-                                                elif isinstance(img_data, str):
-                                                    output_image_data = base64.b64decode(img_data)
-                                    except Exception as e:
-                                        st.write(f"Could not extract inline_data: {e}")
-                                    
-                                    # Try blob as fallback
-                                    try:
-                                        if not output_image_data and hasattr(part, 'blob'):
-                                            blob = part.blob
-                                            if hasattr(blob, 'data'):
-                                                output_image_data = blob.data
-                                    except:
-                                        pass
-                
-                # Display results
-                with col2:
-                    if output_image_data:
-                        # Show generated image
-                        img_bytes = BytesIO(output_image_data)
-                        generated_image = Image.open(img_bytes)
-                        
-                        output_placeholder.image(
-                            generated_image,
-                            caption="Generated Model Image",
-                            use_container_width=True
-                        )
-                        
-                        # Download button
+        # Root span of this request; the jobs' stages nest under it. The key is
+        # the image content, so the same lehenga uploaded in several sessions
+        # attaches to the jobs already running instead of paying again
+        digest = image_digest(input_image)
+        with span("request", page="main_v1", candidates=count):
+            st.query_params["job"] = ",".join(
+                jobs.submit(
+                    generate_model_image, input_image, uploaded_file.size,
+                    model=MODEL_NAME, key=f"{digest}:{MODEL_NAME}" + (f":{i}" if i else "")
+                )
+                for i in range(count)
+            )
+        st.rerun()
+
+# Display results
+with col2:
+    if pending:
+        job_progress([j.id for j in job_list], sum(j.finished for j in job_list))
+
+    failed = [j for j in job_list if j.status == "failed"]
+    for failed_job in failed:
+        st.error(f"❌ Error generating image: {failed_job.error}")
+    if failed and len(failed) == len(job_list):
+        st.info("Please check your API key and model access.")
+
+    # Finished candidates, best colour match first
+    done = sorted(
+        (j.result for j in job_list if j.status == "done"),
+        key=lambda r: (r["image"] is not None, (r["fidelity"] or {}).get("score", 0)), reverse=True
+    )
+    if done:
+        result = done[0]
+        if result["image"]:
+            # Show and serve the model's own encoded bytes; no decode / re-encode
+            st.caption(summarize([result["prep"]]))
+            if len(job_list) > 1:
+                st.caption(f"🎨 Colour fidelity {result['fidelity']['score']:.2f} — best of {len(done)} "
+                           f"finished candidate{'s' if len(done) != 1 else ''}")
+            if not result["fidelity"]["passed"]:
+                st.warning(
+                    f"⚠️ The colours drift from your upload (fidelity {result['fidelity']['score']:.2f}, "
+                    f"below {FIDELITY_THRESHOLD:.2f} after {result['attempts']} attempt(s)). "
+                    "Check the image before using it."
+                )
+            output_placeholder.image(
+                result["image"],
+                caption="Generated Model Image",
+                use_container_width=True
+            )
+            
+            # Download button
+            st.download_button(
+                label="📥 Download Image",
+                data=result["image"],
+                file_name=f"lehenga_model_tryon.{extension(result['mime'])}",
+                mime=result["mime"],
+                use_container_width=True
+            )
+            
+            # Show description if available
+            if result["description"]:
+                with st.expander("📄 Generation Details"):
+                    st.write(result["description"])
+
+            # The other finished candidates, still ranked by colour fidelity
+            others = [r for r in done[1:] if r["image"]]
+            if others:
+                st.markdown("**Other candidates**")
+                for i, (col, other) in enumerate(zip(st.columns(len(others)), others), start=2):
+                    with col:
+                        st.image(other["image"], caption=f"#{i} · fidelity {other['fidelity']['score']:.2f}"
+                                 + ("" if other["fidelity"]["passed"] else " ⚠️"))
                         st.download_button(
-                            label="📥 Download Image",
-                            data=output_image_data,
-                            file_name="lehenga_model_tryon.jpg",
-                            mime="image/jpeg",
-                            use_container_width=True
+                            "📥 Download",
+                            data=other["image"],
+                            file_name=f"lehenga_model_tryon_{i}.{extension(other['mime'])}",
+                            mime=other["mime"],
+                            key=f"download_candidate_{i}"
                         )
-                        
-                        # Show description if available
-                        if description_text:
-                            with st.expander("📄 Generation Details"):
-                                st.write(description_text)
-                        
-                        st.success("✅ Image generated successfully!")
-                    
-                    else:
-                        output_placeholder.error("❌ No image was generated. Please try again.")
-                        if description_text:
-                            st.write("Response received:", description_text)
-                
-            except Exception as e:
-                st.error(f"❌ Error generating image: {str(e)}")
-                st.info("Please check your API key and model access.")
-
-# ----------------- Footer -----------------
-st.markdown("---")
-st.markdown("""
-<div style='text-align: center; color: #666;'>
-    <p>💡 <b>Tip:</b> Use high-quality, well-lit images of lehengas for best results</p>
-    <p>🔧 Using model: <code>gemini-3-pro-image-preview</code></p>
-</div>
-=======
-import streamlit as st
-from PIL import Image
-from io import BytesIO
-import base64
-import os
-from dotenv import load_dotenv
-import google.generativeai as genai
-
-# accuracy ~80%
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-if not GEMINI_API_KEY:
-    st.error("⚠️ Google API key not found in .env file")
-    st.info("Please add GOOGLE_API_KEY to your .env file")
-    st.stop()
-
-genai.configure(api_key=GEMINI_API_KEY)
-
-# Your working model name
-MODEL_NAME = "gemini-3-pro-image-preview"
-model = genai.GenerativeModel(MODEL_NAME)
-
-VIRTUAL_TRYON_PROMPT = """Generate a photorealistic image of a professional fashion model wearing this EXACT lehenga outfit.
-Preserve every detail of the original lehenga design exactly as it appears—pattern, color, embroidery, waist shape, style, and skirt flow.
-Maintain proper body alignment, realistic fitting, and correct cloth tension around the waist, chest, cleavage area, and lower abdominal region.
-Make sure the blouse and lehenga sit naturally and continuously without gaps or separation at the belly area.
-Ensure the chest and cleavage area appear natural and match the reference garment’s coverage level.
-The waist region must stay fully connected and not look detached.
-Preserve the original fabric texture, shine, and drape exactly as shown.
-Do not redesign or modify any part of the dress.
-Only adjust lighting slightly to improve clarity while keeping the original style.
-The output must look like a natural photograph, not a generated illustration
-Analyze the original outfit extremely carefully and recreate the design with maximum anatomical accuracy. 
-Focus especially on:
-FOCUS AREA: SHOULDER + BAJU + BOOTA + BLOUSE BORDER
-
-Recreate the outfit with ultra-high accuracy, giving the highest priority to the SHOULDER REGION and everything connected to it. The generated image must preserve:
-
-1. SHOULDER ACCURACY (TOP PRIORITY)
-   • Replicate the exact shoulder structure, slope, width, and angle from the reference.
-   • Maintain perfect continuity between shoulder, neckline, and upper torso.
-   • Preserve the exact way the blouse/choli sits on the shoulder without any redesign.
-   • No distortion, stretching, lifting, or shifting of shoulder fabric.
-
-2. BAJU (SLEEVE) PRECISION
-   • Match the exact sleeve length: cap, short, 3/4, full, etc. as in the original.
-   • Reproduce the exact sleeve cut, fit, and drape.
-   • Maintain the correct sleeve tightness/looseness exactly.
-   • Keep the sleeve geometry identical—no stylization, no alteration.
-
-3. BOOTA / EMBROIDERY ON SHOULDER & SLEEVES
-   • PERFECT replication of all motifs, booti work, floral work, and patterns on:
-       - the shoulder
-       - sleeve top
-       - entire baju surface
-   • Exact size, density, spacing, alignment, and thread direction.
-   • Match zari, resham, mirror work, sequins, stonework or any embellishment with microscopic precision.
-   • DO NOT change any motif shape or placement.
-
-4. BLOUSE / CHOLI BORDER ACCURACY
-   • Replicate the exact border design on:
-       - neckline border
-       - shoulder border (if present)
-       - sleeve hem border
-       - blouse/choli lower border
-   • Match border width, colors, metallic tones, and embroidery EXACTLY.
-   • Preserve border spacing and alignment around the shoulder and sleeves.
-
-5. FABRIC & COLOR CONSISTENCY
-   • Match the exact fabric type and texture on shoulder + sleeves.
-   • Maintain original color shade, saturation, and brightness perfectly.
-   • No color shift, no tone mismatch, no incorrect gradients.
-   • Keep fabric drape and fall naturally continuous.
-
-6. UPPER BODY STRUCTURAL INTEGRITY
-   • Maintain correct connection between shoulder → neckline → chest → upper waist.
-   • Avoid belly/chest separation or unrealistic joints.
-   • Keep blouse/choli shape identical to the reference.
-
-GOAL:
-Produce a photorealistic try-on image where the SHOULDER AREA, BAJU, BOOTA, and BLOUSE/CHOLI BORDER are reproduced with PERFECT fidelity. No redesign, no simplification, no missing details. The output must match the original outfit’s upper structure with 100% accuracy.
-
-
-COLOR PRESERVATION (CRITICAL):
-✓ Match the EXACT base color and all secondary colors with perfect accuracy
-✓ Preserve the exact shade, tone, saturation, and brightness of every color
-✓ Maintain the exact color gradients, ombre effects, or color transitions
-✓ Keep metallic colors (gold, silver, copper) with the same metallic finish and sheen
-✓ Replicate the exact color of threads, sequins, stones, and embellishments
-✓ Match border colors precisely
-✓ Preserve the exact color contrast between different elements
-
-🧵 EMBROIDERY & EMBELLISHMENTS (MICROSCOPIC DETAIL):
-✓ Replicate EVERY embroidery pattern with exact placement and density
-✓ Copy the exact type of embroidery work: zari, zardozi, gota patti, resham, dabka, kundan, etc.
-✓ Maintain the exact size, shape, and arrangement of sequins, beads, and stones
-✓ Preserve mirror work (aari work) placement and patterns exactly
-✓ Keep the exact thread work direction and stitching style
-✓ Replicate pearl, crystal, or stone embellishments with same size and placement
-✓ Match the density and coverage of embellishment work precisely
-✓ Preserve cutwork, applique, or patchwork exactly as shown
-✓ Maintain lace work, tassel work, or fringe details identically
-
-📐 PATTERN & MOTIF ACCURACY:
-✓ Replicate geometric patterns (diamonds, squares, chevrons) with exact proportions
-✓ Copy floral motifs with the same flower types, sizes, and arrangements
-✓ Maintain paisley designs with identical shapes and orientations
-✓ Preserve traditional motifs (peacock, lotus, mango, vine) exactly
-✓ Keep the exact spacing between pattern repeats
-✓ Replicate border patterns with precise width and design
-✓ Match the symmetry or asymmetry of patterns exactly
-✓ Preserve print patterns if any, with exact colors and clarity
-
-🎀 LEHENGA SKIRT DETAILS:
-✓ Match the exact silhouette: A-line, flared, mermaid, circular, or umbrella cut
-✓ Replicate the exact flare volume and how it falls
-✓ Preserve the exact number and placement of kalis (panels)
-✓ Match the exact length and hemline style
-✓ Keep the exact waistband design and width
-✓ Replicate can-can or lining visibility if any
-✓ Preserve pleating, gathering, or draping style exactly
-✓ Match the exact flow and movement of the fabric
 
-👚 BLOUSE/CHOLI PRECISION:
-✓ Replicate the EXACT neckline: round, V-neck, sweetheart, boat, square, halter, etc.
-✓ Match the exact sleeve style: sleeveless, cap, short, 3/4, full, bell, puff, etc.
-✓ Preserve the exact sleeve length and fit
-✓ Copy the exact back design: open back, keyhole, zip, button, tie-up, hook
-✓ Maintain the exact blouse length and fit (crop, fitted, loose)
-✓ Replicate collar details if any
-✓ Match the exact embroidery and embellishment on the blouse
-✓ Preserve blouse fabric texture and color exactly
-
-🧣 DUPATTA ACCURACY:
-✓ Match the exact dupatta draping style: one-shoulder, both-shoulder, lehenga style, cape style
-✓ Replicate the exact fabric transparency/opacity level
-✓ Preserve border width, design, and embellishment exactly
-✓ Match the exact length and how it falls
-✓ Keep corner tassels, latkan, or gota patti work identical
-✓ Replicate body embellishments or booti work exactly
-✓ Maintain the exact placement and pinning style
-
-🧶 FABRIC & TEXTURE REPLICATION:
-✓ Match the exact fabric type: silk, velvet, georgette, net, tulle, organza, brocade, satin, raw silk, chanderi, banarasi, etc.
-✓ Replicate the exact fabric texture: smooth, matte, glossy, embossed, crushed, etc.
-✓ Preserve the exact fabric sheen and light reflection
-✓ Match the fabric weight appearance (heavy vs light)
-✓ Replicate any visible weave patterns in the fabric
-✓ Maintain the exact fabric drape and fall
-✓ Preserve layering effects if multiple fabric layers are visible
-
-💎 BORDER & FINISHING DETAILS:
-✓ Replicate ALL border designs with exact width and pattern
-✓ Match the exact border embellishment type and density
-✓ Preserve corner designs and how borders meet
-✓ Keep piping, lace, or trim details identical
-✓ Replicate gota patti border work exactly
-✓ Match the border color contrast precisely
-
-📏 STRUCTURAL ACCURACY:
-✓ Maintain the exact garment proportions and fit
-✓ Replicate how the outfit sits on the body
-✓ Preserve the exact length ratios between blouse, skirt, and dupatta
-✓ Match the exact volume and fullness of the lehenga
-✓ Keep the waistline position exact
-✓ Replicate any visible stitching lines or seams
-
-🌟 SPECIAL EFFECTS & DETAILS:
-✓ Preserve any shimmer, shine, or sparkle effects
-✓ Replicate metallic accents with same metallic tone
-✓ Match any gradient or ombre effects precisely
-✓ Keep shadow effects from layering identical
-✓ Preserve any 3D embellishments (flowers, appliques)
-✓ Replicate any contrast panels or color blocking exactly
-
-👤 MODEL & PRESENTATION:
-• Professional Indian fashion model with elegant features
-• Graceful standing pose in traditional lehenga style
-• Hands positioned naturally: one hand holding dupatta or resting gracefully
-• Neutral, clean studio background (soft grey or white backdrop)
-• Professional studio lighting: soft, even lighting showing all details clearly
-• Model facing forward or at a slight 20-30 degree angle
-• Full-length shot showing the entire outfit from head to toe
-• Focus on the outfit, not the model's face
-• Natural, elegant posture with good body language
-• Clear visibility of all three components: lehenga, blouse, and dupatta
-
-📸 IMAGE QUALITY REQUIREMENTS:
-• High-resolution, crystal-clear, professional fashion photography quality
-• Perfect lighting to showcase all embroidery and embellishment details
-• Sharp focus on fabric texture and design elements
-• Professional color grading and white balance
-• No blur, no distortion, no artifacts
-• Magazine-quality fashion catalog photograph
-
-🚫 STRICT PROHIBITIONS - DO NOT:
-✗ Change ANY color or shade whatsoever
-✗ Modify, simplify, or omit ANY pattern or design element
-✗ Alter embroidery placement, type, or density
-✗ Change fabric type, texture, or sheen
-✗ Modify the silhouette or cut of any garment piece
-✗ Add new design elements not present in the original
-✗ Change border designs or widths
-✗ Alter the draping style of the dupatta
-✗ Simplify complex embellishment work
-✗ Change the neckline, sleeve style, or blouse design
-✗ Modify the length or proportions of any component
-✗ Use different metallic tones (gold vs silver)
-✗ Change the background to anything distracting
-✗ Add accessories not present in original (jewelry, props)
-
-
-The output must look like a professional fashion catalog photo with the model wearing THIS EXACT lehenga design and the image should be in 2k quality."""
-
-
-st.set_page_config(page_title="Virtual Lehenga Try-On", page_icon="👗", layout="wide")
-
-st.title("👗 Virtual Lehenga Try-On")
-st.markdown("Upload your lehenga image and generate a professional model try-on image")
-
-
-col1, col2 = st.columns([1, 1])
-
-with col1:
-    st.subheader("📤 Upload Lehenga Image")
-    
-    # File uploader
-    uploaded_file = st.file_uploader(
-        "Choose a lehenga image",
-        type=["jpg", "jpeg", "png"],
-        help="Upload a clear image of the lehenga outfit"
-    )
-    
-    # Display uploaded image
-    if uploaded_file:
-        input_image = Image.open(uploaded_file).convert("RGB")
-        st.image(input_image, caption="Input Lehenga", use_container_width=True)
+            if not pending:
+                st.success("✅ Image generated successfully!")
         
-        # Optional: Show the prompt being used
-        with st.expander("📝 View Generation Prompt"):
-            st.text_area("Prompt", VIRTUAL_TRYON_PROMPT, height=300, disabled=True)
-    
-    # Generate button
-    generate_btn = st.button("🎨 Generate Model Image", type="primary", use_container_width=True)
-
-with col2:
-    st.subheader("✨ Generated Result")
-    
-    # Placeholder for output
-    output_placeholder = st.empty()
-    
-    if not uploaded_file:
-        output_placeholder.info("👈 Upload a lehenga image to get started")
+        else:
+            output_placeholder.error("❌ No image was generated. Please try again.")
+            if result["description"]:
+                st.write("Response received:", result["description"])
 
-# ----------------- Generation Logic -----------------
-if generate_btn:
-    if not uploaded_file:
-        st.error("Please upload a lehenga image first!")
-    else:
-        with st.spinner("🎨 Generating model image... This may take a moment..."):
-            try:
-                # Prepare content for the model
-                contents = [
-                    VIRTUAL_TRYON_PROMPT,
-                    input_image
-                ]
-                
-                # Generate content
-                response = model.generate_content(contents)
-                # Debug - Add temporarily
-                st.write("**Checking response parts:**")
-                if response.candidates:
-                    for i, candidate in enumerate(response.candidates):
-                      st.write(f"Candidate {i}:")
-                if candidate.content and candidate.content.parts:
-                 for j, part in enumerate(candidate.content.parts):
-                    st.write(f"  Part {j} type: {type(part)}")
-                    st.write(f"  Part {j} attributes: {[attr for attr in dir(part) if not attr.startswith('_')]}")
-                
-                # Extract generated image and description
-                description_text = ""
-                output_image_data = None
-                
-                # Try to get text first
-                try:
-                    if hasattr(response, 'text'):
-                        description_text = response.text
-                except:
-                    pass
-                
-                # Check candidates for parts
-                if hasattr(response, 'candidates') and response.candidates:
-                    for candidate in response.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            content = candidate.content
-                            if hasattr(content, 'parts') and content.parts:
-                                for part in content.parts:
-                                    # Try to get text from part
-                                    try:
-                                        if hasattr(part, 'text'):
-                                            part_text = part.text
-                                            if part_text:
-                                                description_text += part_text
-                                    except:
-                                        pass
-                                    
-                                    # Try to get image data from inline_data
-                                    try:
-                                        if hasattr(part, 'inline_data'):
-                                            inline = part.inline_data
-                                            if hasattr(inline, 'data'):
-                                                img_data = inline.data
-                                                # Handle both bytes and base64 string
-                                                if isinstance(img_data, bytes):
-                                                    output_image_data = img_data
-                                                elif isinstance(img_data, str):
-                                                    output_image_data = base64.b64decode(img_data)
-                                    except Exception as e:
-                                        st.write(f"Could not extract inline_data: {e}")
-                                    
-                                    # Try blob as fallback
-                                    try:
-                                        if not output_image_data and hasattr(part, 'blob'):
-                                            blob = part.blob
-                                            if hasattr(blob, 'data'):
-                                                output_image_data = blob.data
-                                    except:
-                                        pass
-                
-                # Display results
-                with col2:
-                    if output_image_data:
-                        # Show generated image
-                        img_bytes = BytesIO(output_image_data)
-                        generated_image = Image.open(img_bytes)
-                        
-                        output_placeholder.image(
-                            generated_image,
-                            caption="Generated Model Image",
-                            use_container_width=True
-                        )
-                        
-                        # Download button
-                        st.download_button(
-                            label="📥 Download Image",
-                            data=output_image_data,
-                            file_name="lehenga_model_tryon.jpg",
-                            mime="image/jpeg",
-                            use_container_width=True
-                        )
-                        
-                        # Show description if available
-                        if description_text:
-                            with st.expander("📄 Generation Details"):
-                                st.write(description_text)
-                        
-                        st.success("✅ Image generated successfully!")
-                    
-                    else:
-                        output_placeholder.error("❌ No image was generated. Please try again.")
-                        if description_text:
-                            st.write("Response received:", description_text)
-                
-            except Exception as e:
-                st.error(f"❌ Error generating image: {str(e)}")
-                st.info("Please check your API key and model access.")
+    if job:
+        trace_expander(job.trace_id)
 
 # ----------------- Footer -----------------
 st.markdown("---")
@@ -750,5 +450,6 @@ st.markdown("""
     <p>💡 <b>Tip:</b> Use high-quality, well-lit images of lehengas for best results</p>
     <p>🔧 Using model: <code>gemini-3-pro-image-preview</code></p>
 </div>
->>>>>>> 9217dbfecd1481fe15cfd16e477af5221a77a594
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+
+usage_sidebar()
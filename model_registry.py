@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+
+from google.genai import errors, types
+from PIL import Image
+
+from clients import genai_client
+from image_output import extract_image
+from rate_limiter import acquire
+from result_cache import CACHE_DIR
+from usage_ledger import metered, tagged
+
+log = logging.getLogger(__name__)
+
+# -------------------------
+# Settings
+# -------------------------
+REGISTRY_PATH = os.path.join(CACHE_DIR, "model_registry.json")
+MODEL_REGISTRY_TTL = float(os.getenv("MODEL_REGISTRY_TTL", str(24 * 3600)))
+MODEL_PROBE_TTL = float(os.getenv("MODEL_PROBE_TTL", str(7 * 24 * 3600)))
+MODEL_PROBE_LIMIT = int(os.getenv("MODEL_PROBE_LIMIT", "20"))
+REFRESH_RETRY_SECONDS = 300
+
+
+def _tiny_png() -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (8, 8), (200, 30, 30)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _unsupported(e: errors.APIError) -> bool:
+    # 400 / 404 mean "this model can't do that"; quota or server errors mean "ask again later"
+    return e.code in (400, 404)
+
+
+# -------------------------
+# Capabilities
+# -------------------------
+def classify_model(name: str, actions: list[str]) -> dict:
+    """
+    Capabilities guessed from the listing alone (name and supported
+    actions). The listing carries no modality fields, so this is a
+    deliberate name heuristic: a fallback that keeps background discovery
+    free of generation calls, overridden by probe_model() results once
+    `api_name.py --refresh` has run. Gemini models take images; image
+    models (…-image, …-image-generation, nano-banana) return images next to
+    text, TTS models return audio.
+    """
+    lowered = name.lower()
+    caps = {"input": ["text"], "output": []}
+    if "tts" in lowered:
+        caps["output"].append("audio")
+    elif "generateContent" in actions:
+        if "gemini" in lowered or "banana" in lowered:
+            caps["input"].append("image")
+        caps["output"].append("text")
+        if "image" in lowered or "banana" in lowered:
+            caps["output"].append("image")
+    return caps
+
+
+def probe_model(client, name: str) -> dict | None:
+    """
+    Classifies a model by what it actually accepts and returns:
+    one tiny image+text -> text call and one text -> image call. These are
+    real, billed calls; only `api_name.py --refresh` runs them.
+    Returns {"input": [...], "output": [...]} or None if a probe hit a
+    transient error (quota, server) and should be retried later.
+    """
+    caps = {"input": ["text"], "output": []}
+    try:
+        acquire(name, 300)
+        response = metered(name, lambda: client.models.generate_content(
+            model=name,
+            contents=[types.Part.from_bytes(data=_tiny_png(), mime_type="image/png"), "Reply with OK."],
+            config=types.GenerateContentConfig(max_output_tokens=16),
+        ), image_output=False)
+        caps["input"].append("image")
+        if response.text:
+            caps["output"].append("text")
+    except errors.APIError as e:
+        if not _unsupported(e):
+            return None
+
+    try:
+        acquire(name, 1300)
+        response = metered(name, lambda: client.models.generate_content(
+            model=name,
+            contents="A plain red square.",
+            config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
+        ), image_output=True)
+        if extract_image(response):
+            caps["output"].append("image")
+    except errors.APIError as e:
+        if not _unsupported(e):
+            return None
+    return caps
+
+
+# -------------------------
+# Registry
+# -------------------------
+class ModelRegistry:
+    """
+    Models available to this API key, classified by input/output modality
+    (guessed from the listing, or probed on request) and persisted to disk.
+    Reads never touch the network: a stale or missing registry is refreshed
+    on a background thread while callers keep using what is on disk (or
+    their fallback).
+    """
+
+    def __init__(self, path: str = REGISTRY_PATH, ttl: float = MODEL_REGISTRY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._attempted_at = 0.0
+        self._data = {"listed_at": 0, "models": {}}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                pass
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def models(self) -> dict[str, dict]:
+        self.refresh_in_background()
+        with self._lock:
+            return dict(self._data["models"])
+
+    def pick(self, inputs: str, outputs: str, prefer: tuple[str, ...] = ()) -> str | None:
+        """
+        A model whose classified capabilities include the requested input and
+        output modality. Names starting with a `prefer` prefix win, in order.
+        """
+        matches = sorted(
+            name for name, info in self.models().items()
+            if inputs in info.get("input", []) and outputs in info.get("output", [])
+        )
+        for prefix in prefer:
+            for name in matches:
+                if name.startswith(prefix):
+                    return name
+        return matches[0] if matches else None
+
+    def is_stale(self) -> bool:
+        return time.time() - self._data.get("listed_at", 0) > self.ttl
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or not self.is_stale():
+                return
+            if time.time() - self._attempted_at < REFRESH_RETRY_SECONDS:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="model-registry", daemon=True).start()
+
+    def refresh(self, probe: bool = False):
+        """
+        Lists models and classifies them from the listing. With probe=True
+        also probes up to MODEL_PROBE_LIMIT unprobed or expired ones with live
+        calls. Blocking; normally run via refresh_in_background(), which never
+        probes.
+        """
+        with self._lock:
+            self._refreshing = True
+            self._attempted_at = time.time()
+        try:
+            with tagged(page="model_registry"):
+                self._refresh(probe)
+        except Exception:
+            log.exception("Model registry refresh failed")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh(self, probe: bool):
+        client = genai_client()
+        listed = {}
+        for m in client.models.list():
+            actions = list(m.supported_actions or [])
+            if "generateContent" in actions:
+                listed[m.name] = {"display_name": m.display_name, "actions": actions}
+
+        with self._lock:
+            known = self._data["models"]
+        due = [
+            name for name in listed
+            if time.time() - known.get(name, {}).get("probed_at", 0) > MODEL_PROBE_TTL
+        ][:MODEL_PROBE_LIMIT] if probe else []
+
+        models = {name: {**known.get(name, {}), **info} for name, info in listed.items()}
+        for name, info in models.items():
+            # Probed capabilities win over the listing's until they expire
+            if time.time() - info.get("probed_at", 0) > MODEL_PROBE_TTL:
+                info.update(classify_model(name, info["actions"]))
+                info.pop("probed_at", None)
+        for name in due:
+            caps = probe_model(client, name)
+            if caps is not None:
+                models[name].update(caps, probed_at=time.time())
+
+        with self._lock:
+            self._data = {"listed_at": time.time(), "models": models}
+            self._save()
+
+
+_default_registry: ModelRegistry | None = None
+_default_lock = threading.Lock()
+
+
+def default_registry() -> ModelRegistry:
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            _default_registry = ModelRegistry()
+        return _default_registry
@@ -0,0 +1,82 @@
+import time
+from datetime import datetime
+
+import streamlit as st
+from history_store import default_store
+from image_output import extension
+
+# -------------------------
+# History gallery (listed next to v3cpy.py as a Streamlit page)
+# -------------------------
+COLUMNS = 6
+PAGE_SIZES = (24, 48, 96)
+
+started = time.perf_counter()
+history = default_store()
+
+st.title("🖼️ Try-On History")
+
+garment_filter = st.sidebar.text_input("Garment id", help="Lehenga file name or batch piece id").strip() or None
+page_size = st.sidebar.selectbox("Per page", PAGE_SIZES)
+
+# Keyset cursors: one (created_at, id) per page already visited, reset when the filter changes
+view = (garment_filter, page_size)
+if st.session_state.get("gallery_view") != view:
+    st.session_state.gallery_view = view
+    st.session_state.gallery_cursors = [None]
+    st.session_state.gallery_selected = None
+cursors = st.session_state.gallery_cursors
+
+rows = history.page(page_size, cursors[-1], garment_filter)
+total = history.count(garment_filter)
+st.caption(f"{total} generations · page {len(cursors)} of {max(1, -(-total // page_size))}")
+
+# Selected image: the only full-resolution bytes this page ever loads
+selected = history.get(st.session_state.gallery_selected) if st.session_state.gallery_selected else None
+if selected:
+    image = history.read_image(selected)
+    if image:
+        with st.container(border=True):
+            st.image(image, use_container_width=True)
+            st.caption(
+                f"{selected['garment_id'] or 'untitled'} · {selected['model']} · "
+                f"{datetime.fromtimestamp(selected['created_at']):%Y-%m-%d %H:%M} · "
+                f"{(selected['duration'] or 0):.0f}s"
+            )
+            left, right = st.columns(2)
+            left.download_button(
+                "📥 Download",
+                data=image,
+                file_name=f"{selected['garment_id'] or selected['id']}.{extension(selected['mime'])}",
+                mime=selected["mime"],
+                use_container_width=True
+            )
+            if right.button("Close", use_container_width=True):
+                st.session_state.gallery_selected = None
+                st.rerun()
+    else:
+        st.warning("The image file for this generation is missing.")
+
+# Thumbnail grid (pre-generated WebP, a few KB each)
+if not rows:
+    st.info("No generations recorded yet.")
+for start in range(0, len(rows), COLUMNS):
+    for col, row in zip(st.columns(COLUMNS), rows[start:start + COLUMNS]):
+        thumb = history.read_thumbnail(row)
+        if thumb:
+            col.image(thumb, use_container_width=True)
+        col.caption(f"{row['garment_id'] or 'untitled'} · {datetime.fromtimestamp(row['created_at']):%m-%d %H:%M}")
+        if col.button("View", key=f"view_{row['id']}", use_container_width=True):
+            st.session_state.gallery_selected = row["id"]
+            st.rerun()
+
+# Pager
+prev_col, next_col = st.columns(2)
+if prev_col.button("← Newer", disabled=len(cursors) == 1, use_container_width=True):
+    cursors.pop()
+    st.rerun()
+if next_col.button("Older →", disabled=len(rows) < page_size, use_container_width=True):
+    cursors.append((rows[-1]["created_at"], rows[-1]["id"]))
+    st.rerun()
+
+st.caption(f"Rendered in {(time.perf_counter() - started) * 1000:.0f} ms")
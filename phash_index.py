@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from result_cache import CACHE_DIR
+
+# -------------------------
+# Settings
+# -------------------------
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", "8"))
+
+_DCT_SIZE = 32
+_HASH_SIDE = 8
+_n = np.arange(_DCT_SIZE)
+_DCT = np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * _DCT_SIZE))
+
+
+# -------------------------
+# Perceptual hashes (64-bit)
+# -------------------------
+def _gray(img: Image.Image, size: tuple[int, int]) -> np.ndarray:
+    small = img.resize(size, Image.Resampling.BOX, reducing_gap=2.0)
+    return np.asarray(small.convert("L"), dtype=np.float32)
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(img: Image.Image) -> int:
+    """
+    Difference hash: sign of horizontal gradients on a 9x8 thumbnail.
+    Insensitive to global brightness changes (re-lit shots).
+    """
+    px = _gray(img, (_HASH_SIDE + 1, _HASH_SIDE))
+    return _pack(px[:, 1:] > px[:, :-1])
+
+
+def phash(img: Image.Image) -> int:
+    """
+    DCT hash: low-frequency 8x8 DCT coefficients of a 32x32 thumbnail,
+    thresholded at their median. Survives re-compression and mild crops.
+    """
+    px = _gray(img, (_DCT_SIZE, _DCT_SIZE))
+    coeffs = (_DCT @ px @ _DCT.T)[:_HASH_SIDE, :_HASH_SIDE].ravel()
+    return _pack(coeffs > np.median(coeffs[1:]))
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(x)
+else:
+    _BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        return _BYTE_BITS[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+# -------------------------
+# Near-duplicate index
+# -------------------------
+class NearDuplicateIndex:
+    """
+    Append-only index of 64-bit perceptual hashes with a payload per entry.
+
+    Hashes live in one contiguous uint64 array, so a lookup is a single
+    vectorized XOR + popcount over every entry (a few ms at 500k images).
+    Entries are persisted as JSON lines and reloaded on start-up.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._payloads: list[dict] = []
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._append(int(entry.pop("hash"), 16), entry)
+
+    def _append(self, h: int, payload: dict):
+        n = len(self._payloads)
+        if n == len(self._hashes):
+            self._hashes = np.resize(self._hashes, 2 * n)
+        self._hashes[n] = h
+        self._payloads.append(payload)
+
+    def add(self, h: int, payload: dict):
+        with self._lock:
+            self._append(h, payload)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"hash": f"{h:016x}", **payload}) + "\n")
+
+    def nearest(
+        self, h: int, max_distance: int = NEAR_DUPLICATE_DISTANCE, where: dict | None = None
+    ) -> tuple[int, dict] | None:
+        """
+        Closest indexed entry within max_distance bits, newest wins on ties.
+        With where, only entries whose payload has those values are
+        considered. Returns (distance, payload) or None.
+        """
+        with self._lock:
+            n = len(self._payloads)
+            if n == 0:
+                return None
+            dist = _popcount(self._hashes[:n] ^ np.uint64(h))
+            if where is None:
+                best = n - 1 - int(np.argmin(dist[::-1]))
+                if dist[best] > max_distance:
+                    return None
+                return int(dist[best]), self._payloads[best]
+            # Only the few near duplicates are checked against where, closest then newest first
+            near = np.flatnonzero(dist <= max_distance)
+            for i in sorted(near, key=lambda i: (dist[i], -i)):
+                payload = self._payloads[i]
+                if all(payload.get(k) == v for k, v in where.items()):
+                    return int(dist[i]), payload
+            return None
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+
+_indexes: dict[str, NearDuplicateIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def default_index(name: str) -> NearDuplicateIndex:
+    """
+    Process-wide index stored as <cache dir>/phash_<name>.jsonl.
+    """
+    with _indexes_lock:
+        if name not in _indexes:
+            _indexes[name] = NearDuplicateIndex(os.path.join(CACHE_DIR, f"phash_{name}.jsonl"))
+        return _indexes[name]
@@ -0,0 +1,228 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from PIL import Image
+
+from call_policy import call_with_policy
+from clients import generative_model
+from image_output import extract_image
+from image_prep import prepare_image
+from prompt_stream import TextStream
+from rate_limiter import IMAGE_OUTPUT_TOKENS, acquire, estimate_tokens
+from single_flight import default_flight
+
+log = logging.getLogger(__name__)
+
+# -------------------------
+# Settings
+# -------------------------
+PIPELINE_MODES = ("two-stage", "fused")
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "two-stage")
+if PIPELINE_MODE not in PIPELINE_MODES:
+    log.warning("Unknown PIPELINE_MODE %r; using two-stage", PIPELINE_MODE)
+    PIPELINE_MODE = "two-stage"
+PIPELINE_LABELS = {
+    "two-stage": "Two-stage (instruction → image, 2 calls)",
+    "fused": "Fused (single call with the references)",
+}
+
+# Single-call prompt: the image model sees the references itself
+FUSED_PROMPT = (
+    "Generate a 2048x2048 photorealistic image of a model wearing the exact same lehenga as the reference images. "
+    "Preserve embroidery, stonework, motifs, borders, colour, fabric texture, pleats/flare, blouse cut and dupatta drape exactly; "
+    "no redesign. Head-to-knee framing focused on the lehenga, natural studio lighting, plain background, no text or props."
+)
+# Reference slots in order: full view, close-up, blouse
+REFERENCE_ROLES = ("full", "closeup", "full")
+REFERENCE_NOTES = (
+    "Reference: full view of the lehenga (silhouette, colour distribution).",
+    "Reference: close-up (embroidery, stones, borders, fabric texture).",
+    "Reference: blouse (cut, neckline, sleeve, stitch design).",
+)
+
+
+def _usage(usage) -> tuple[int, int]:
+    return (
+        getattr(usage, "prompt_token_count", 0) or 0,
+        getattr(usage, "candidates_token_count", 0) or 0,
+    )
+
+
+def _contents_key(model: str, contents) -> str:
+    h = hashlib.blake2b(model.encode(), digest_size=20)
+    for part in contents if isinstance(contents, list) else [contents]:
+        h.update(b"\0")
+        h.update(part["data"] if isinstance(part, dict) else str(part).encode())
+    return h.hexdigest()
+
+
+def fused_contents(references: list[Image.Image | None], prompt: str = FUSED_PROMPT) -> tuple[list, int]:
+    """
+    Prompt plus each reference as a tile-sized JPEG with its note.
+    Returns (contents, estimated image tokens).
+    """
+    contents, tokens = [prompt], 0
+    for img, role, note in zip(references, REFERENCE_ROLES, REFERENCE_NOTES):
+        if img is None:
+            continue
+        data, prep = prepare_image(img, role)
+        contents += [{"mime_type": "image/jpeg", "data": data}, note]
+        tokens += prep["tokens"]
+    return contents, tokens
+
+
+# -------------------------
+# Entry point
+# -------------------------
+def run_pipeline(
+    mode: str,
+    references: list[Image.Image | None],
+    image_model: str,
+    instruction=None,
+    show_instruction=None,
+    fused_prompt: str = FUSED_PROMPT
+) -> dict:
+    """
+    One try-on through either flow:
+
+    - "two-stage": instruction(*references) returns a TextStream (the vision
+      call); image_model then renders its text. show_instruction(stream),
+      e.g. st.write_stream, renders it as it arrives.
+    - "fused": a single image_model call with the references and fused_prompt.
+
+    Returns {"mode", "image", "mime", "instruction", "model", "shared",
+    "calls", "input_tokens", "output_tokens", "seconds"}, where model is the
+    one that rendered the image (a fallback while image_model's circuit is
+    open) and shared is True when an identical image call already in flight
+    was joined; every run is added to default_ledger().
+    """
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode {mode!r}, expected one of {PIPELINE_MODES}")
+    started = time.perf_counter()
+    run = {"mode": mode, "image": None, "mime": None, "instruction": None, "model": image_model,
+           "shared": False, "calls": 0, "input_tokens": 0, "output_tokens": 0, "seconds": 0.0}
+
+    if mode == "two-stage":
+        stream: TextStream = instruction(*references)
+        if show_instruction:
+            show_instruction(stream)
+        else:
+            for _ in stream:
+                pass
+        if not stream.cached:
+            run["calls"] += 1
+            tokens_in, tokens_out = _usage(stream.usage)
+            run["input_tokens"] += tokens_in
+            run["output_tokens"] += tokens_out
+        run["instruction"] = stream.text
+        contents, estimate = stream.text, estimate_tokens(stream.text, IMAGE_OUTPUT_TOKENS)
+    else:
+        contents, image_tokens = fused_contents(references, fused_prompt)
+        estimate = estimate_tokens([c for c in contents if isinstance(c, str)], IMAGE_OUTPUT_TOKENS) + image_tokens
+
+    # Returns the serving model with the response, so callers that joined
+    # the call also learn whether a fallback rendered it
+    def generate(model: str):
+        acquire(model, estimate)
+        run["calls"] += 1
+        return model, generative_model(model).generate_content(contents)
+
+    try:
+        # Retried with backoff, so a 429 doesn't throw away the instruction stage;
+        # an identical image call already in flight is joined, not repeated
+        (run["model"], response), run["shared"] = default_flight().do(
+            _contents_key(image_model, contents), lambda: call_with_policy(image_model, generate)
+        )
+        if not run["shared"]:
+            tokens_in, tokens_out = _usage(getattr(response, "usage_metadata", None))
+            run["input_tokens"] += tokens_in
+            run["output_tokens"] += tokens_out
+        image = extract_image(response)
+        if image:
+            run["image"], run["mime"] = image
+    finally:
+        run["seconds"] = time.perf_counter() - started
+        default_ledger().record(run)
+    return run
+
+
+def describe(run: dict) -> str:
+    """
+    One-line cost report of a run for st.caption.
+    """
+    return (
+        f"{run['mode']}: {run['calls']} API call{'s' if run['calls'] != 1 else ''} · "
+        f"{run['input_tokens']:,} in / {run['output_tokens']:,} out tokens · {run['seconds']:.1f} s · {run['model']}"
+        + (" · joined an identical request in flight" if run.get("shared") else "")
+    )
+
+
+# -------------------------
+# Per-mode accounting
+# -------------------------
+class PipelineLedger:
+    """
+    Running totals per pipeline mode (runs, API calls, tokens, wall-clock),
+    so the two flows can be compared on real traffic.
+    """
+
+    FIELDS = ("calls", "input_tokens", "output_tokens", "seconds")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: dict[str, dict] = {}
+
+    def record(self, run: dict):
+        with self._lock:
+            totals = self._totals.setdefault(run["mode"], {"runs": 0, "images": 0, **dict.fromkeys(self.FIELDS, 0)})
+            totals["runs"] += 1
+            totals["images"] += 1 if run["image"] else 0
+            for field in self.FIELDS:
+                totals[field] += run[field]
+
+    def summary(self) -> dict[str, dict]:
+        """
+        Per mode: runs, images, and per-run averages of each field.
+        """
+        with self._lock:
+            return {
+                mode: {
+                    "runs": t["runs"],
+                    "images": t["images"],
+                    **{f"{field}_per_run": t[field] / t["runs"] for field in self.FIELDS},
+                }
+                for mode, t in self._totals.items()
+            }
+
+
+def ledger_rows() -> list[dict]:
+    """
+    default_ledger().summary() as table rows, one per mode.
+    """
+    return [
+        {
+            "pipeline": mode,
+            "runs": s["runs"],
+            "images": s["images"],
+            "calls / run": round(s["calls_per_run"], 2),
+            "tokens in / run": round(s["input_tokens_per_run"]),
+            "tokens out / run": round(s["output_tokens_per_run"]),
+            "seconds / run": round(s["seconds_per_run"], 1),
+        }
+        for mode, s in default_ledger().summary().items()
+    ]
+
+
+_default_ledger: PipelineLedger | None = None
+_default_lock = threading.Lock()
+
+
+def default_ledger() -> PipelineLedger:
+    global _default_ledger
+    with _default_lock:
+        if _default_ledger is None:
+            _default_ledger = PipelineLedger()
+        return _default_ledger
@@ -1,40 +1,43 @@
 
 import streamlit as st
-from PIL import Image
-import google.generativeai as genai
+from image_loader import load_image
+from clients import configure_genai, generative_model
 import base64
 from dotenv import load_dotenv
 import os
-import io
+from image_prep import prepare_image, summarize
+from prompt_stream import TextStream
+from pipeline import PIPELINE_LABELS, PIPELINE_MODE, PIPELINE_MODES, describe, ledger_rows, run_pipeline
+from image_output import extension
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY= os.getenv("GOOGLE_API_KEY")
 
 
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 MODEL = "gemini-2.0-flash-exp"  
 
 
 # ---------------------------
-# Utility: Convert PIL → base64 → inlineData
+# Utility: Convert PIL → tile-sized JPEG → base64 → inlineData
 # ---------------------------
-def image_to_inline_data(pil_img):
-    buffered = io.BytesIO()
-    pil_img.save(buffered, format="JPEG")
+def image_to_inline_data(pil_img, role="full"):
+    data, stats = prepare_image(pil_img, role)
     return {
         "inline_data": {
             "mime_type": "image/jpeg",
-            "data": base64.b64encode(buffered.getvalue()).decode()
+            "data": base64.b64encode(data).decode()
         }
-    }
+    }, stats
 
 
 # ---------------------------
 # Step 1 — Generate Instruction Prompt
 # ---------------------------
-def generate_instruction_prompt(lehenga_img, closeup_img):
+def generate_instruction_prompt(lehenga_img, closeup_img) -> TextStream:
     prompt = """
 Analyze the two provided images:
 
@@ -56,74 +59,76 @@ OUTPUT FORMAT:
 Return ONLY the final instruction. No description, no explanation.
 """
 
-    model = genai.GenerativeModel(MODEL)
+    lehenga_part, lehenga_prep = image_to_inline_data(lehenga_img, "full")
+    closeup_part, closeup_prep = image_to_inline_data(closeup_img, "closeup")
+    st.caption(summarize([lehenga_prep, closeup_prep]))
 
-    response = model.generate_content(
+    model = generative_model(MODEL)
+
+    # Streamed: render with st.write_stream(), then read .text
+    return TextStream(lambda: model.generate_content(
         [
             {"text": prompt},
-            image_to_inline_data(lehenga_img),
-            image_to_inline_data(closeup_img)
+            lehenga_part,
+            closeup_part
         ],
-        stream=False
-    )
-
-    return response.text
+        stream=True
+    ))
 
 
 # ---------------------------
-# Step 2 — Generate final TRY-ON image
+# Step 2 — Generate final TRY-ON image (pipeline.run_pipeline: two-stage or fused)
 # ---------------------------
-def generate_final_image(instruction):
-    model = genai.GenerativeModel(MODEL)
-
-    response = model.generate_content(
-        [{"text": instruction}],
-        generation_config={
-            "response_mime_type": "image/jpeg",
-            "temperature": 0.2,
-            "top_p": 0.9,
-            "top_k": 40,
-            "max_output_tokens": 8192
-        },
-        stream=False
-    )
-
-    # Extract base64 image
-    img_base64 = response.candidates[0].content.parts[0].inline_data.data
-    return base64.b64decode(img_base64)
+def show_instruction(stream: TextStream):
+    st.subheader("Generated Instruction Prompt")
+    st.write_stream(stream)
+    st.caption(stream.summary())
 
 
 # ---------------------------
 # STREAMLIT UI
 # ---------------------------
 st.title("👗 Ultra Accurate Lehenga Try-On Generator (Gemini 2.0 Flash EXP)")
+track_usage("pro")
 
 lehenga_file = st.file_uploader("Upload Lehenga Full Image", type=["jpg", "jpeg", "png"])
 closeup_file = st.file_uploader("Upload Close-up / Embroidery Image", type=["jpg", "jpeg", "png"])
 
 if lehenga_file and closeup_file:
-    lehenga_img = Image.open(lehenga_file)
-    closeup_img = Image.open(closeup_file)
+    lehenga_img = load_image(lehenga_file)
+    closeup_img = load_image(closeup_file)
 
     st.image(lehenga_img, caption="Lehenga Image", width=300)
     st.image(closeup_img, caption="Close-up Image", width=300)
 
-    if st.button("Generate Try-On Image"):
-        with st.spinner("Generating hyper-accurate instruction prompt..."):
-            instruction = generate_instruction_prompt(lehenga_img, closeup_img)
-
-        st.subheader("Generated Instruction Prompt")
-        st.code(instruction)
+    pipeline_mode = st.radio(
+        "Pipeline", PIPELINE_MODES, index=PIPELINE_MODES.index(PIPELINE_MODE), format_func=PIPELINE_LABELS.get
+    )
 
+    if st.button("Generate Try-On Image"):
         with st.spinner("Generating 2K Try-On Image..."):
-            output_bytes = generate_final_image(instruction)
-
-        st.subheader("Final Generated Try-On")
-        st.image(output_bytes, use_column_width=True)
-
-        st.download_button(
-            label="📥 Download 2K Image",
-            data=output_bytes,
-            file_name="lehenga_model_2k.jpg",
-            mime="image/jpeg"
-        )
+            run = run_pipeline(
+                pipeline_mode, [lehenga_img, closeup_img], MODEL,
+                instruction=generate_instruction_prompt,
+                show_instruction=show_instruction
+            )
+        st.caption(describe(run))
+
+        output_bytes = run["image"]
+        if output_bytes:
+            st.subheader("Final Generated Try-On")
+            st.image(output_bytes, use_column_width=True)
+
+            st.download_button(
+                label="📥 Download 2K Image",
+                data=output_bytes,
+                file_name=f"lehenga_model_2k.{extension(run['mime'])}",
+                mime=run["mime"]
+            )
+        else:
+            st.error("The model returned no image.")
+
+with st.expander("📊 Pipeline comparison (this server process)"):
+    st.table(ledger_rows())
+
+usage_sidebar()
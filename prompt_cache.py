@@ -0,0 +1,86 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from result_cache import image_digest
+
+# -------------------------
+# Settings
+# -------------------------
+PROMPT_MEMO_TTL = float(os.getenv("PROMPT_MEMO_TTL", str(6 * 3600)))
+PROMPT_MEMO_MAX_ENTRIES = int(os.getenv("PROMPT_MEMO_MAX_ENTRIES", "512"))
+
+
+def template_version(template: str) -> str:
+    """
+    Short hash of the prompt template, so editing the template
+    invalidates every instruction produced from the old text.
+    """
+    return hashlib.blake2b(template.encode(), digest_size=6).hexdigest()
+
+
+def prompt_key(images, template: str, model: str) -> str:
+    """
+    Memo key for a vision-stage instruction: reference image hashes
+    (None entries keep their slot), template version and model name.
+    """
+    parts = [image_digest(img) if img is not None else "-" for img in images]
+    parts += [template_version(template), model]
+    return hashlib.blake2b("\0".join(parts).encode(), digest_size=20).hexdigest()
+
+
+# -------------------------
+# TTL + size-bounded memo
+# -------------------------
+class PromptMemo:
+    """
+    In-process memo of instruction text. Entries expire after ttl seconds
+    and the least recently used entry is dropped past max_entries.
+    """
+
+    def __init__(self, max_entries: int = PROMPT_MEMO_MAX_ENTRIES, ttl: float = PROMPT_MEMO_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, text = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return text
+
+    def put(self, key: str, text: str):
+        if not text:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_memo: PromptMemo | None = None
+_default_lock = threading.Lock()
+
+
+def default_memo() -> PromptMemo:
+    """
+    Process-wide memo, shared by every Streamlit session and rerun.
+    """
+    global _default_memo
+    with _default_lock:
+        if _default_memo is None:
+            _default_memo = PromptMemo()
+        return _default_memo
@@ -0,0 +1,72 @@
+import time
+
+
+def _chunk_text(chunk) -> str:
+    # google.generativeai raises ValueError on chunks without text parts
+    # (e.g. the final finish-reason chunk); google.genai returns None
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
+
+
+class TextStream:
+    """
+    Text chunks of a streamed model response, for st.write_stream().
+
+    The request is sent when iteration starts; ttft (first text chunk) and
+    total are measured from then. The text is accumulated while streaming,
+    so .text is ready for the image stage the moment the stream ends, and
+    on_complete(text) runs once with the finished text (memo writes etc.).
+    """
+
+    def __init__(self, request, on_complete=None):
+        self._request = request
+        self._on_complete = on_complete
+        self._parts: list[str] = []
+        self.ttft: float | None = None
+        self.total: float | None = None
+        self.cached = False
+        # usage_metadata arrives on the last chunk
+        self.usage = None
+
+    @classmethod
+    def of(cls, text: str) -> "TextStream":
+        """
+        A stream that replays already known text (memo hit, reused instruction).
+        """
+        stream = cls(lambda: [text])
+        stream.cached = True
+        return stream
+
+    def __iter__(self):
+        started = time.perf_counter()
+        for chunk in self._request():
+            if isinstance(chunk, str):
+                text = chunk
+            else:
+                text = _chunk_text(chunk)
+                self.usage = getattr(chunk, "usage_metadata", None) or self.usage
+            if not text:
+                continue
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - started
+            self._parts.append(text)
+            yield text
+        self.total = time.perf_counter() - started
+        if self._on_complete and not self.cached:
+            self._on_complete(self.text)
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts).strip()
+
+    def stats(self) -> dict:
+        return {"ttft": self.ttft, "total": self.total, "chars": len(self.text), "cached": self.cached}
+
+    def summary(self) -> str:
+        if self.cached:
+            return "⚡ Instruction reused, no vision call"
+        if self.total is None:
+            return "Instruction not finished"
+        return f"First token after {self.ttft or 0:.2f} s · full instruction in {self.total:.2f} s"
@@ -0,0 +1,255 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from PIL import Image
+
+# -------------------------
+# Settings
+# -------------------------
+# Per-model budgets as "model=rpm:tpm,model=rpm:tpm", e.g.
+# MODEL_RATE_LIMITS="gemini-3-pro-image-preview=10:200000"
+DEFAULT_RPM = float(os.getenv("DEFAULT_RPM", "10"))
+DEFAULT_TPM = float(os.getenv("DEFAULT_TPM", "250000"))
+
+TOKENS_PER_IMAGE_TILE = 258
+IMAGE_TILE_SIZE = 768
+IMAGE_OUTPUT_TOKENS = 1290
+# How often an event-loop waiter behind others re-checks its place in the queue
+ASYNC_POLL_SECONDS = 0.05
+
+
+def _parse_limits(spec: str) -> dict[str, tuple[float, float]]:
+    limits = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, budget = item.partition("=")
+        rpm, _, tpm = budget.partition(":")
+        limits[_model_key(name)] = (float(rpm or DEFAULT_RPM), float(tpm or DEFAULT_TPM))
+    return limits
+
+
+def _model_key(model: str) -> str:
+    return model.strip().removeprefix("models/")
+
+
+MODEL_RATE_LIMITS = _parse_limits(os.getenv("MODEL_RATE_LIMITS", ""))
+
+
+# -------------------------
+# Token estimates
+# -------------------------
+def image_tokens(img: Image.Image) -> int:
+    """
+    Gemini bills a small image (both sides <= 384 px) as one tile and
+    larger images as 768x768 tiles.
+    """
+    if img.width <= 384 and img.height <= 384:
+        return TOKENS_PER_IMAGE_TILE
+    tiles = math.ceil(img.width / IMAGE_TILE_SIZE) * math.ceil(img.height / IMAGE_TILE_SIZE)
+    return tiles * TOKENS_PER_IMAGE_TILE
+
+
+def estimate_tokens(contents, output_tokens: int = 0) -> int:
+    """
+    Rough token count for a request: ~4 characters per text token plus
+    the tile cost of each image. Unknown parts count as one image tile.
+    """
+    if isinstance(contents, (str, Image.Image, dict)):
+        contents = [contents]
+    total = output_tokens
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part) // 4 + 1
+        elif isinstance(part, Image.Image):
+            total += image_tokens(part)
+        elif isinstance(part, dict) and "text" in part:
+            total += len(part["text"]) // 4 + 1
+        else:
+            total += TOKENS_PER_IMAGE_TILE
+    return total
+
+
+# -------------------------
+# Token buckets
+# -------------------------
+class RateLimitTimeout(TimeoutError):
+    """
+    The local rate limiter, not the model, ran out of time.
+    """
+
+
+class ModelLimiter:
+    """
+    Two token buckets for one model: requests per minute and tokens per
+    minute. acquire() queues callers in arrival order until both buckets
+    can cover the request, then takes from both at once.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = rpm
+        self._tokens = tpm
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._queue: deque = deque()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens: float) -> float:
+        self._refill()
+        short_requests = max(0.0, 1 - self._requests) * 60 / self.rpm
+        short_tokens = max(0.0, tokens - self._tokens) * 60 / self.tpm
+        return max(short_requests, short_tokens)
+
+    def acquire(self, tokens: int = 0, timeout: float | None = None) -> float:
+        """
+        Blocks until the request fits the budget and returns the seconds waited.
+        Raises TimeoutError if `timeout` passes first.
+        """
+        tokens = min(tokens, self.tpm)
+        started = time.monotonic()
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    wait = None
+                    if self._queue[0] is ticket:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            self._requests -= 1
+                            self._tokens -= tokens
+                            return time.monotonic() - started
+                    if timeout is not None:
+                        left = timeout - (time.monotonic() - started)
+                        if left <= 0:
+                            raise RateLimitTimeout("Rate limit wait exceeded timeout")
+                        wait = left if wait is None else min(wait, left)
+                    self._cond.wait(wait)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+    async def acquire_async(self, tokens: int = 0, timeout: float | None = None) -> float:
+        """
+        acquire() for an event loop: the same arrival-order queue, but waited
+        out with asyncio.sleep, so no thread is held per waiting call.
+        Cancelling the awaiting task leaves the queue without taking anything.
+        """
+        tokens = min(tokens, self.tpm)
+        started = time.monotonic()
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    # Not at the head: check back shortly, the head may leave any time
+                    wait = ASYNC_POLL_SECONDS
+                    if self._queue[0] is ticket:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            self._requests -= 1
+                            self._tokens -= tokens
+                            return time.monotonic() - started
+                if timeout is not None:
+                    left = timeout - (time.monotonic() - started)
+                    if left <= 0:
+                        raise RateLimitTimeout("Rate limit wait exceeded timeout")
+                    wait = min(wait, left)
+                await asyncio.sleep(wait)
+        finally:
+            with self._cond:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+
+_limiters: dict[str, ModelLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(model: str) -> ModelLimiter:
+    """
+    Process-wide limiter for a model, shared by every session and thread.
+    """
+    key = _model_key(model)
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = ModelLimiter(*MODEL_RATE_LIMITS.get(key, (DEFAULT_RPM, DEFAULT_TPM)))
+        return _limiters[key]
+
+
+# -------------------------
+# Wait accounting
+# -------------------------
+class WaitTally:
+    """
+    Seconds one call attempt has spent waiting for the rate limiter,
+    including a wait still in progress. call_policy subtracts it, so its
+    latency samples, hedge delay and slow-call breaker see only the API call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._total = 0.0
+        self._since: float | None = None
+
+    def begin(self):
+        with self._lock:
+            self._since = time.monotonic()
+
+    def end(self):
+        with self._lock:
+            if self._since is not None:
+                self._total += time.monotonic() - self._since
+                self._since = None
+
+    def seconds(self) -> float:
+        with self._lock:
+            return self._total + (time.monotonic() - self._since if self._since is not None else 0.0)
+
+
+_tally: ContextVar[WaitTally | None] = ContextVar("limiter_waits", default=None)
+
+
+@contextmanager
+def counting_waits(tally: WaitTally | None = None):
+    """
+    Adds the rate limit waits of the calls made inside the block to tally.
+    """
+    tally = tally or WaitTally()
+    token = _tally.set(tally)
+    try:
+        yield tally
+    finally:
+        _tally.reset(token)
+
+
+def current_tally() -> WaitTally | None:
+    """
+    The counting_waits() tally of the current context, to carry onto another
+    event loop or thread.
+    """
+    return _tally.get()
+
+
+def acquire(model: str, tokens: int = 0, timeout: float | None = None) -> float:
+    tally = _tally.get()
+    if tally is not None:
+        tally.begin()
+    try:
+        return limiter_for(model).acquire(tokens, timeout)
+    finally:
+        if tally is not None:
+            tally.end()
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+# -------------------------
+# Settings
+# -------------------------
+CACHE_DIR = os.getenv("TRYON_CACHE_DIR", ".tryon_cache")
+CACHE_MAX_BYTES = int(os.getenv("TRYON_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+
+# -------------------------
+# Keys
+# -------------------------
+def image_digest(img: Image.Image) -> str:
+    """
+    Content hash of a decoded image. Pixels are normalized to RGB so the same
+    picture hashes the same whether it arrived as PNG, RGBA or palette mode.
+    """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{img.width}x{img.height}".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def _config_repr(config) -> str:
+    if config is None:
+        return ""
+    if hasattr(config, "model_dump"):
+        config = config.model_dump(exclude_none=True)
+    return json.dumps(config, sort_keys=True, default=str)
+
+
+def make_key(images, prompt: str, model: str, config=None) -> str:
+    """
+    Cache key for one generation: input images or their image_digest strings
+    (None entries keep their slot), prompt text, model name and image config
+    (size / aspect ratio).
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for img in images:
+        digest = img if isinstance(img, str) else image_digest(img) if img is not None else "-"
+        h.update(digest.encode())
+        h.update(b"\0")
+    h.update(prompt.encode())
+    h.update(b"\0")
+    h.update(model.encode())
+    h.update(b"\0")
+    h.update(_config_repr(config).encode())
+    return h.hexdigest()
+
+
+# -------------------------
+# Disk cache with LRU eviction
+# -------------------------
+class ResultCache:
+    """
+    Content-addressed store of generated image bytes on disk.
+
+    One file per key; the file mtime doubles as the LRU timestamp so the
+    recency order survives restarts. Entries are evicted oldest-first once
+    the total size goes over max_bytes.
+    """
+
+    SUFFIX = ".bin"
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            found.append((st.st_mtime, name[: -len(self.SUFFIX)], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total += size
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        tmp = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+
+_default_cache: ResultCache | None = None
+_default_lock = threading.Lock()
+
+
+def default_cache() -> ResultCache:
+    """
+    Process-wide cache instance, shared by every Streamlit session and rerun.
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# -------------------------
+# Settings
+# -------------------------
+SESSION_RESULTS_MAX_ENTRIES = int(os.getenv("SESSION_RESULTS_MAX_ENTRIES", "8"))
+SESSION_RESULTS_MAX_BYTES = int(os.getenv("SESSION_RESULTS_MAX_BYTES", str(64 * 1024 ** 2)))
+STATE_KEY = "_session_results"
+
+
+def request_key(*parts) -> str:
+    """
+    Key for one generation request: upload digests / file ids, options and
+    model. None entries keep their slot so optional references stay distinct.
+    """
+    text = "\0".join("-" if p is None else str(p) for p in parts)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class SessionResults:
+    """
+    Generated images, prompts and metadata for one browser session, kept in
+    st.session_state so download clicks and other reruns redisplay them
+    instead of paying for the call again. Bounded by entry count and bytes;
+    the least recently shown result is dropped first.
+    """
+
+    def __init__(self, max_entries: int = SESSION_RESULTS_MAX_ENTRIES, max_bytes: int = SESSION_RESULTS_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._in_flight: set[str] = set()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, image: bytes | None, mime: str | None = None, prompt: str | None = None, **meta):
+        with self._lock:
+            self._entries[key] = {
+                "image": image,
+                "mime": mime,
+                "prompt": prompt,
+                "meta": meta,
+                "created_at": time.time(),
+            }
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = sum(len(e["image"] or b"") for e in self._entries.values())
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            total -= len(entry["image"] or b"")
+
+    def in_flight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._in_flight
+
+    @contextmanager
+    def generating(self, key: str):
+        """
+        In-flight guard: yields True for the first caller and False while a
+        generation for the same key is already running in this session.
+        Released on exit, including when Streamlit stops the run.
+        """
+        with self._lock:
+            claimed = key not in self._in_flight
+            self._in_flight.add(key)
+        try:
+            yield claimed
+        finally:
+            if claimed:
+                with self._lock:
+                    self._in_flight.discard(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def session_results(state) -> SessionResults:
+    """
+    The SessionResults held in a Streamlit session_state, created on first use.
+    """
+    if STATE_KEY not in state:
+        state[STATE_KEY] = SessionResults()
+    return state[STATE_KEY]
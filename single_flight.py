@@ -0,0 +1,66 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first caller for a key runs
+    the function, callers arriving while it is in flight wait on the same
+    future and get its result (or its exception). Nothing is kept once the
+    call ends; finished results are the caches' job.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+        self.coalesced = 0
+
+    def do(self, key: str, fn) -> tuple[object, bool]:
+        """
+        Returns (fn() result, shared) where shared is True when the result
+        came from a call another caller already had in flight.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            log.info("Joining in-flight call %s", key[:12])
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+_default_flight: SingleFlight | None = None
+_default_lock = threading.Lock()
+
+
+def default_flight() -> SingleFlight:
+    """
+    Process-wide instance, so identical requests from different sessions share a call.
+    """
+    global _default_flight
+    with _default_lock:
+        if _default_flight is None:
+            _default_flight = SingleFlight()
+        return _default_flight
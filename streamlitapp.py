@@ -1,15 +1,16 @@
 import streamlit as st
-from PIL import Image
-import google.generativeai as genai
+from image_loader import load_image
+from clients import configure_genai, generative_model
 import base64
 from dotenv import load_dotenv
 import os
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY= os.getenv("GOOGLE_API_KEY")
 
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 VISION_MODEL = "models/gemini-1.0-basic"          
 IMAGE_MODEL  = "models/gemini-2.5-flash-image"        
@@ -33,23 +34,24 @@ def generate_prompt(img):
 
     Output should be ONLY the final instruction prompt (no explanation).
     """
-    model = genai.GenerativeModel(VISION_MODEL)
+    model = generative_model(VISION_MODEL)
     result = model.generate_content([PROMPT_TEMPLATE, img])
     return result.text
 
 def generate_image(prompt):
-    model = genai.GenerativeModel(IMAGE_MODEL)
+    model = generative_model(IMAGE_MODEL)
     result = model.generate_content(prompt, stream=False)
     image_base64 = result.candidates[0].content.parts[0].inline_data.data
     return base64.b64decode(image_base64)
 
 
 st.title("👗 Lehenga Try-On Generator (Gemini)")
+track_usage("streamlitapp")
 
 uploaded_file = st.file_uploader("Upload Lehenga Image", type=["jpg", "jpeg", "png"])
 
 if uploaded_file:
-    input_img = Image.open(uploaded_file)
+    input_img = load_image(uploaded_file)
     st.image(input_img, caption="Uploaded Lehenga", width=350)
 
     if st.button("Generate Model Image"):
@@ -71,3 +73,5 @@ if uploaded_file:
             file_name="model_lehenga.jpg",
             mime="image/jpeg"
         )
+
+usage_sidebar()
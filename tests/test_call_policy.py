@@ -0,0 +1,127 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import pytest
+
+import call_policy
+from call_policy import CallPolicy, CircuitBreaker, CircuitOpenError, LatencyWindow, RetryBudget
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(False, breaker.allow())
+    assert breaker.state == "open"
+
+
+def test_failures_open_the_breaker():
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, open_seconds=60)
+    breaker.record(True, breaker.allow())
+    assert breaker.state == "closed"
+    breaker.record(False, breaker.allow())
+    assert breaker.state == "open"
+    assert breaker.allow() is None
+
+
+def test_errors_below_the_rate_keep_it_closed():
+    breaker = CircuitBreaker(window=4, min_calls=4, error_rate=0.5, open_seconds=60)
+    for ok in (True, True, True, False):
+        breaker.record(ok, breaker.allow())
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    open_breaker(breaker)
+    probe = breaker.allow()
+    assert breaker.state == "half-open"
+    assert probe is not None
+    assert breaker.allow() is None
+
+
+def test_probe_success_closes():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    open_breaker(breaker)
+    assert breaker.record(True, breaker.allow()) == "closed"
+    assert breaker.allow() is not None
+
+
+def test_probe_failure_reopens():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    open_breaker(breaker)
+    probe = breaker.allow()
+    breaker.open_seconds = 60
+    assert breaker.record(False, probe) == "open"
+    assert breaker.allow() is None
+
+
+def test_stale_outcomes_do_not_decide_half_open():
+    breaker = CircuitBreaker(min_calls=2, open_seconds=0)
+    stale_ok, stale_failed = breaker.allow(), breaker.allow()
+    open_breaker(breaker)
+    probe = breaker.allow()
+    assert breaker.record(True, stale_ok) == "half-open"
+    assert breaker.record(False, stale_failed) == "half-open"
+    # The probe is still the one in flight
+    assert breaker.allow() is None
+    assert breaker.record(True, probe) == "closed"
+
+
+def test_released_probe_frees_the_slot():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    open_breaker(breaker)
+    probe = breaker.allow()
+    breaker.release(probe)
+    assert breaker.state == "half-open"
+    assert breaker.allow() is not None
+
+
+def test_route_uses_the_fallback_while_open():
+    policy = CallPolicy(fallbacks={"primary": ("backup",)})
+    name, _ = policy.route("primary")
+    assert name == "primary"
+    open_breaker(policy.breaker("primary"))
+    name, _ = policy.route("primary")
+    assert name == "backup"
+
+
+def test_route_raises_when_the_chain_is_open():
+    policy = CallPolicy(fallbacks={"primary": ("backup",)})
+    open_breaker(policy.breaker("primary"))
+    open_breaker(policy.breaker("backup"))
+    with pytest.raises(CircuitOpenError):
+        policy.route("primary")
+
+
+def test_call_goes_to_the_fallback():
+    policy = CallPolicy(max_attempts=1, fallbacks={"primary": ("backup",)})
+    open_breaker(policy.breaker("primary"))
+    assert policy.call("models/primary", lambda name: name) == "backup"
+
+
+def test_hedge_success_wins_when_both_legs_finish_together(monkeypatch):
+    # Both legs come back from the same wait, the failed one listed first
+    def together(futures, timeout=None, return_when=None):
+        if return_when != FIRST_COMPLETED:
+            return wait(futures, timeout)
+        done, _ = wait(futures)
+        return sorted(done, key=lambda future: future.exception() is None), set()
+
+    monkeypatch.setattr(call_policy, "HEDGE_MIN_DELAY", 0)
+    monkeypatch.setattr(call_policy, "wait", together)
+    hedged = threading.Event()
+    calls = []
+
+    def fn(name):
+        calls.append(name)
+        if len(calls) == 1:
+            hedged.wait(5)
+            raise ValueError("first leg failed")
+        hedged.set()
+        return "hedge"
+
+    latencies = LatencyWindow()
+    for _ in range(call_policy.HEDGE_MIN_SAMPLES):
+        latencies.add(0.0)
+    policy = CallPolicy(hedge=True)
+    assert policy._attempt("primary", fn, RetryBudget(), latencies, None) == "hedge"
+    assert len(calls) == 2
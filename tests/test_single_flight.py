@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def run_followers(flight: SingleFlight, key: str, fn, followers: int):
+    """
+    Starts a leader running fn, then `followers` callers for the same key
+    while the leader is still in flight. Returns the futures, leader first.
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def leader_fn():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    pool = ThreadPoolExecutor(max_workers=followers + 1)
+    futures = [pool.submit(flight.do, key, leader_fn)]
+    started.wait(5)
+    futures += [pool.submit(flight.do, key, fn) for _ in range(followers)]
+    while flight.coalesced < followers:
+        time.sleep(0.01)
+    release.set()
+    pool.shutdown(wait=True)
+    return futures
+
+
+def test_followers_share_the_leaders_result():
+    flight = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return "image"
+
+    futures = run_followers(flight, "k", fn, followers=3)
+    assert [f.result() for f in futures] == [("image", False)] + [("image", True)] * 3
+    assert len(calls) == 1
+    assert flight.coalesced == 3
+
+
+def test_followers_get_the_leaders_exception():
+    flight = SingleFlight()
+
+    def fn():
+        raise ValueError("quota")
+
+    futures = run_followers(flight, "k", fn, followers=2)
+    for future in futures:
+        with pytest.raises(ValueError, match="quota"):
+            future.result()
+
+
+def test_key_is_released_after_failure():
+    flight = SingleFlight()
+
+    def fn():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        flight.do("k", fn)
+    assert flight.in_flight() == 0
+    assert flight.do("k", lambda: 42) == (42, False)
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == (1, False)
+    assert flight.do("b", lambda: 2) == (2, False)
+    assert flight.coalesced == 0
@@ -0,0 +1,43 @@
+import html
+
+import streamlit as st
+
+from tracing import TRACE_ENABLED, trace_spans, waterfall
+
+BAR_COLORS = {"api": "#e4572e", "rate_limit": "#f3a712", "queued": "#a8c686", "decode": "#669bbc", "prepare": "#669bbc"}
+
+
+def _bar(row: dict, total_ms: float) -> str:
+    left = 100 * row["offset_ms"] / total_ms
+    width = max(0.3, 100 * row["duration_ms"] / total_ms)
+    color = BAR_COLORS.get(row["name"], "#8d99ae")
+    label = html.escape("  " * row["depth"] + row["name"])
+    return (
+        "<div style='display:flex;align-items:center;font-size:0.8rem;margin:1px 0'>"
+        f"<div style='width:30%;white-space:pre;overflow:hidden'>{label}</div>"
+        "<div style='width:55%;position:relative;height:14px;background:#f1f1f1'>"
+        f"<div style='position:absolute;left:{left:.2f}%;width:{width:.2f}%;height:100%;background:{color}'></div></div>"
+        f"<div style='width:15%;text-align:right'>{row['duration_ms']:,.0f} ms</div></div>"
+    )
+
+
+def trace_expander(trace_id: str | None):
+    """
+    Debug expander with the stage waterfall of one request's trace.
+    """
+    with st.expander("🐞 Stage timings (trace)"):
+        if not TRACE_ENABLED:
+            st.caption("Tracing is off. Set TRACE_ENABLED=1 to record stage spans.")
+            return
+        rows = waterfall(trace_spans(trace_id))
+        if not rows:
+            st.caption("No spans recorded for this request yet.")
+            return
+        total_ms = max(r["offset_ms"] + r["duration_ms"] for r in rows) or 1.0
+        st.markdown("".join(_bar(r, total_ms) for r in rows), unsafe_allow_html=True)
+        st.caption(f"Trace {trace_id} · {total_ms / 1000:.2f} s end to end")
+        st.dataframe(
+            [{"stage": r["name"], "start ms": r["offset_ms"], "ms": r["duration_ms"], "thread": r["thread"],
+              **{k: str(v) for k, v in r["attrs"].items()}} for r in rows],
+            hide_index=True,
+        )
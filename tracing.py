@@ -0,0 +1,173 @@
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from result_cache import CACHE_DIR
+
+# -------------------------
+# Settings
+# -------------------------
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"
+TRACE_LOG = os.getenv("TRACE_LOG", os.path.join(CACHE_DIR, "trace.jsonl"))
+# Recent traces kept in memory for the debug waterfall
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "50"))
+
+# (trace id, span id) of the innermost open span; job workers inherit it
+_current: ContextVar[tuple[str, str] | None] = ContextVar("trace_span", default=None)
+_lock = threading.Lock()
+_traces: OrderedDict[str, list[dict]] = OrderedDict()
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def _write(record: dict):
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        _traces.setdefault(record["trace"], []).append(record)
+        _traces.move_to_end(record["trace"])
+        while len(_traces) > TRACE_KEEP:
+            _traces.popitem(last=False)
+        os.makedirs(os.path.dirname(TRACE_LOG) or ".", exist_ok=True)
+        with open(TRACE_LOG, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class Span:
+    """
+    One timed stage. Opened with `with span(...)`; nested spans (also on job
+    workers, which inherit the context) become its children. set() adds
+    attributes known only once the stage has run.
+    """
+
+    def __init__(self, name: str, parent: tuple[str, str] | None, attrs: dict):
+        self.name = name
+        self.trace_id = parent[0] if parent else _new_id()
+        self.parent_id = parent[1] if parent else None
+        self.span_id = _new_id()
+        self.attrs = attrs
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._start = time.time()
+        self._started = time.perf_counter()
+        self._token = _current.set((self.trace_id, self.span_id))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._started
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _write({
+            "trace": self.trace_id, "span": self.span_id, "parent": self.parent_id, "name": self.name,
+            "start": round(self._start, 6), "duration": round(duration, 6),
+            "thread": threading.current_thread().name, **self.attrs,
+        })
+        return False
+
+
+class _NoopSpan:
+    trace_id = None
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, parent: tuple[str, str] | None = None, **attrs):
+    """
+    Times a stage as a child of the current span (or of parent, for code
+    running on another event loop or thread). Starts a new trace when there
+    is no current span. A shared no-op when TRACE_ENABLED is off.
+    """
+    if not TRACE_ENABLED:
+        return _NOOP
+    return Span(name, parent or _current.get(), attrs)
+
+
+def traced(name: str):
+    """
+    Decorator: each call of the function is one span.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_span(name: str, seconds: float, parent: tuple[str, str] | None = None, **attrs):
+    """
+    Records a stage that just finished after `seconds` (a streamed call, a
+    wait measured elsewhere) without opening it as the current span.
+    """
+    if not TRACE_ENABLED:
+        return
+    parent = parent or _current.get()
+    if parent is None:
+        return
+    _write({
+        "trace": parent[0], "span": _new_id(), "parent": parent[1], "name": name,
+        "start": round(time.time() - seconds, 6), "duration": round(seconds, 6),
+        "thread": threading.current_thread().name, **attrs,
+    })
+
+
+def current_span() -> tuple[str, str] | None:
+    """
+    (trace id, span id) to pass as parent= across an event loop boundary.
+    """
+    return _current.get() if TRACE_ENABLED else None
+
+
+def trace_spans(trace_id: str | None) -> list[dict]:
+    """
+    Finished spans of a recent trace, in start order.
+    """
+    with _lock:
+        spans = list(_traces.get(trace_id, [])) if trace_id else []
+    return sorted(spans, key=lambda s: s["start"])
+
+
+def waterfall(spans: list[dict]) -> list[dict]:
+    """
+    Spans as waterfall rows: depth in the span tree, offset from the trace
+    start and duration, both in milliseconds.
+    """
+    if not spans:
+        return []
+    origin = spans[0]["start"]
+    depth = {}
+    rows = []
+    for s in spans:
+        depth[s["span"]] = depth.get(s["parent"], -1) + 1
+        extra = {k: v for k, v in s.items() if k not in ("trace", "span", "parent", "name", "start", "duration", "thread")}
+        rows.append({
+            "name": s["name"],
+            "depth": depth[s["span"]],
+            "offset_ms": round((s["start"] - origin) * 1000, 1),
+            "duration_ms": round(s["duration"] * 1000, 1),
+            "thread": s["thread"],
+            "attrs": extra,
+        })
+    return rows
@@ -0,0 +1,202 @@
+from PIL import Image
+from google.genai import types
+from result_cache import default_cache, image_digest, make_key
+from history_store import default_store
+from phash_index import default_index, phash
+from rate_limiter import IMAGE_OUTPUT_TOKENS, estimate_tokens
+from image_prep import prepare_image
+from image_output import extract_image, sniff_mime
+from async_engine import default_engine
+from call_policy import call_with_policy
+from single_flight import default_flight
+from tracing import span, traced
+
+# -------------------------
+# Nano Banana Pro model
+# -------------------------
+VISION_MODEL = "gemini-3-pro-image-preview"
+
+TRYON_PROMPT = (
+    "Generate a photorealistic image of a model wearing this lehenga. "
+    "Do NOT change color, embroidery, motifs, pleats, or fabric. "
+    "Preserve every design detail exactly. Studio lighting, head-to-knee, 2048x2048."
+)
+CLOSEUP_PROMPT = "Reference close-up: preserve embroidery and fabric texture exactly."
+BLOUSE_PROMPT = "Reference blouse: preserve cut, sleeve, and stitch design exactly."
+
+
+# -------------------------
+# Request building
+# -------------------------
+def prompt_texts(closeup_img: Image.Image | None = None, blouse_img: Image.Image | None = None) -> list[str]:
+    texts = [TRYON_PROMPT]
+    if closeup_img:
+        texts.append(CLOSEUP_PROMPT)
+    if blouse_img:
+        texts.append(BLOUSE_PROMPT)
+    return texts
+
+
+def build_contents(
+    lehenga_img: Image.Image,
+    closeup_img: Image.Image | None = None,
+    blouse_img: Image.Image | None = None,
+    source_bytes: list[int | None] | None = None
+) -> tuple[list, list[dict]]:
+    """
+    Interleaves each reference with its instruction. References are resized to
+    their tile policy (close-ups keep more detail) and sent as JPEG bytes.
+    Returns (contents, preprocessing stats).
+    """
+    source_bytes = source_bytes or [None, None, None]
+    references = [
+        (lehenga_img, "full", TRYON_PROMPT),
+        (closeup_img, "closeup", CLOSEUP_PROMPT),
+        (blouse_img, "full", BLOUSE_PROMPT),
+    ]
+    contents, stats = [], []
+    for (img, role, text), size in zip(references, source_bytes):
+        if not img:
+            continue
+        data, prep = prepare_image(img, role, size)
+        contents.append(types.Part.from_bytes(data=data, mime_type="image/jpeg"))
+        contents.append(text)
+        stats.append(prep)
+    return contents, stats
+
+
+def image_config(model: str = VISION_MODEL) -> types.ImageConfig:
+    # image_size is a Nano Banana Pro option; fallback models only take the ratio
+    if model.removeprefix("models/") != VISION_MODEL:
+        return types.ImageConfig(aspect_ratio="1:1")
+    return types.ImageConfig(
+        image_size="2K",
+        aspect_ratio="1:1"
+    )
+
+
+# -------------------------
+# Generate image function
+# -------------------------
+@traced("try_on")
+def generate_try_on(
+    lehenga_img: Image.Image,
+    closeup_img: Image.Image | None = None,
+    blouse_img: Image.Image | None = None,
+    model: str = VISION_MODEL,
+    source_bytes: list[int | None] | None = None,
+    garment_id: str | None = None,
+    source: str | None = None,
+    candidate: int = 0
+) -> tuple[bytes, dict]:
+    """
+    Generates a 2048x2048 image from the lehenga + optional references.
+    source_bytes are the uploaded file sizes, used only for the savings report.
+    candidate > 0 asks for another take on the same inputs: it gets its own
+    cache key, so parallel candidates are neither cached nor coalesced together.
+    Returns (image bytes, info) where info has "cached", "mime", "prep"
+    (per-reference preprocessing stats), "history_id", "shared" (joined an
+    identical call already in flight) and, for fresh generations, "model"
+    (a fallback while model's circuit is open). The bytes are
+    exactly what the model sent, never re-encoded. API errors are raised to
+    the caller after the failure is recorded in the history store.
+    """
+    texts = prompt_texts(closeup_img, blouse_img)
+    prompt = "\n".join(texts)
+    config = image_config(model)
+
+    cache = default_cache()
+    history = default_store()
+    with span("digest"):
+        digests = [image_digest(img) if img is not None else None for img in (lehenga_img, closeup_img, blouse_img)]
+        cache_key = make_key(digests, prompt if not candidate else f"{prompt}\0candidate {candidate}", model, config)
+    with span("cache_lookup"):
+        cached = cache.get(cache_key)
+    if cached:
+        return cached, {"cached": True, "mime": sniff_mime(cached), "prep": [], "history_id": None, "shared": False}
+
+    # Evicted from the LRU cache but still on record
+    with span("history_lookup"):
+        previous = history.lookup(cache_key, model)
+        cached = history.read_image(previous)
+    if cached:
+        cache.put(cache_key, cached)
+        return cached, {"cached": True, "mime": previous["mime"], "prep": [], "history_id": previous["id"], "shared": False}
+
+    # Identical requests already in flight (another session, a double submit)
+    # wait for that call and share its image instead of paying for their own
+    with span("single_flight") as s:
+        (data, info), shared = default_flight().do(cache_key, lambda: _render(
+            cache_key, digests, texts, config, model,
+            (lehenga_img, closeup_img, blouse_img), source_bytes, garment_id, source
+        ))
+        s.set(shared=shared)
+    return data, {**info, "shared": shared}
+
+
+def _render(
+    cache_key: str,
+    digests: list[str | None],
+    texts: list[str],
+    config: types.ImageConfig,
+    model: str,
+    images: tuple,
+    source_bytes: list[int | None] | None,
+    garment_id: str | None,
+    source: str | None
+) -> tuple[bytes, dict]:
+    """
+    The paid part of generate_try_on: runs once per key in flight.
+    """
+    lehenga_img, closeup_img, blouse_img = images
+    cache = default_cache()
+    history = default_store()
+    # A call for this key may have finished between our cache miss and now
+    cached = cache.get(cache_key)
+    if cached:
+        return cached, {"cached": True, "mime": sniff_mime(cached), "prep": [], "history_id": None}
+    history_id = history.start(cache_key, model, "\n".join(texts), config, digests, garment_id, source)
+    try:
+        with span("prepare") as s:
+            contents, prep = build_contents(lehenga_img, closeup_img, blouse_img, source_bytes)
+            s.set(bytes=sum(p["bytes"] for p in prep))
+        served = [model]
+
+        def generate(name: str):
+            served.append(name)
+            return default_engine().generate(
+                name,
+                contents,
+                types.GenerateContentConfig(
+                    image_config=config if name == model else image_config(name),
+                    response_modalities=["IMAGE"]
+                ),
+                tokens=estimate_tokens(texts, IMAGE_OUTPUT_TOKENS) + sum(s["tokens"] for s in prep)
+            )
+
+        # Transient 429/503s and timeouts are retried (and hedged) by the call
+        # policy; while the model's circuit is open a fallback model renders
+        response = call_with_policy(model, generate)
+
+        with span("parse"):
+            image = extract_image(response)
+        if image is None:
+            raise RuntimeError("Model returned no image")
+    except Exception as e:
+        history.fail(history_id, str(e) or type(e).__name__)
+        raise
+
+    data, mime = image
+    usage = response.usage_metadata
+    with span("save", bytes=len(data)):
+        history.finish(
+            history_id, data, mime,
+            input_tokens=usage.prompt_token_count if usage else None,
+            output_tokens=usage.candidates_token_count if usage else None,
+            model=served[-1],
+        )
+        # A fallback's render isn't what this key asked for; don't serve it again
+        if served[-1] == model:
+            cache.put(cache_key, data)
+            default_index("results").add(phash(lehenga_img), {"cache_key": cache_key})
+    return data, {"cached": False, "mime": mime, "prep": prep, "history_id": history_id, "model": served[-1]}
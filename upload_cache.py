@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+from image_loader import load_image
+from phash_index import phash
+
+# -------------------------
+# Settings
+# -------------------------
+UPLOAD_MEMO_MAX_BYTES = int(os.getenv("UPLOAD_MEMO_MAX_BYTES", str(1024 ** 3)))
+# Thumbnails are rendered at this multiple of the display width for HiDPI screens
+PREVIEW_SCALE = 2
+
+
+class Upload:
+    """
+    One decoded upload plus its server-side preview thumbnails, built once
+    and shared by every rerun that sees the same file.
+    """
+
+    def __init__(self, data: bytes, digest: str):
+        self.digest = digest
+        self.size = len(data)
+        # Reduced-scale decode: large JPEGs come out just big enough for model input
+        self.image = load_image(BytesIO(data))
+        self._previews: dict[int, bytes] = {}
+        self._phash: int | None = None
+        self._lock = threading.Lock()
+
+    def preview(self, width: int) -> bytes:
+        """
+        JPEG thumbnail for st.image(..., width=width): only preview-sized
+        bytes travel to the browser, not the full-resolution upload.
+        """
+        with self._lock:
+            if width not in self._previews:
+                thumb = self.image.copy()
+                thumb.thumbnail((width * PREVIEW_SCALE, width * PREVIEW_SCALE * 4), Image.Resampling.LANCZOS, reducing_gap=2.0)
+                buf = BytesIO()
+                thumb.save(buf, "JPEG", quality=85)
+                self._previews[width] = buf.getvalue()
+            return self._previews[width]
+
+    @property
+    def phash(self) -> int:
+        if self._phash is None:
+            self._phash = phash(self.image)
+        return self._phash
+
+    @property
+    def nbytes(self) -> int:
+        return self.image.width * self.image.height * 3 + sum(map(len, self._previews.values()))
+
+
+class UploadMemo:
+    """
+    LRU of decoded uploads bounded by decoded size. Keyed by the content
+    hash; Streamlit file ids map to it so reruns skip even the hashing.
+    """
+
+    def __init__(self, max_bytes: int = UPLOAD_MEMO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Upload] = OrderedDict()
+        self._file_ids: dict[str, str] = {}
+
+    def load(self, uploaded_file) -> Upload:
+        file_id = getattr(uploaded_file, "file_id", None)
+        with self._lock:
+            digest = self._file_ids.get(file_id) if file_id else None
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                return self._entries[digest]
+
+        data = uploaded_file.getvalue()
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        with self._lock:
+            upload = self._entries.get(digest)
+        if upload is None:
+            upload = Upload(data, digest)
+
+        with self._lock:
+            upload = self._entries.setdefault(digest, upload)
+            self._entries.move_to_end(digest)
+            if file_id:
+                self._file_ids[file_id] = digest
+            self._evict()
+        return upload
+
+    def _evict(self):
+        total = sum(u.nbytes for u in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, upload = self._entries.popitem(last=False)
+            total -= upload.nbytes
+        live = set(self._entries)
+        self._file_ids = {f: d for f, d in self._file_ids.items() if d in live}
+
+
+_default_memo: UploadMemo | None = None
+_default_lock = threading.Lock()
+
+
+def load_upload(uploaded_file) -> Upload | None:
+    """
+    Decoded upload from the process-wide memo, or None when nothing is uploaded.
+    """
+    global _default_memo
+    if uploaded_file is None:
+        return None
+    with _default_lock:
+        if _default_memo is None:
+            _default_memo = UploadMemo()
+    return _default_memo.load(uploaded_file)
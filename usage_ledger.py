@@ -0,0 +1,312 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+
+from result_cache import CACHE_DIR
+from tracing import current_span, record_span
+
+# -------------------------
+# Settings
+# -------------------------
+USAGE_LOG = os.getenv("USAGE_LOG", os.path.join(CACHE_DIR, "usage.jsonl"))
+USAGE_HISTORY_DAYS = int(os.getenv("USAGE_HISTORY_DAYS", "30"))
+# USD per 1M tokens as input:output:image_output, e.g.
+# MODEL_PRICES="gemini-3-pro-image-preview=2:12:120,gemini-2.5-flash=0.3:2.5"
+DEFAULT_PRICES = {
+    "gemini-3-pro-image-preview": (2.0, 12.0, 120.0),
+    "gemini-2.5-flash-image": (0.30, 2.50, 30.0),
+    "gemini-2.5-flash": (0.30, 2.50, 2.50),
+}
+
+
+def _model_key(model: str) -> str:
+    return model.strip().removeprefix("models/")
+
+
+def _parse_prices(spec: str) -> dict[str, tuple[float, float, float]]:
+    prices = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, rates = item.partition("=")
+        values = [float(v) for v in rates.split(":") if v]
+        values += [values[-1] if values else 0.0] * (3 - len(values))
+        prices[_model_key(name)] = tuple(values[:3])
+    return prices
+
+
+MODEL_PRICES = {**DEFAULT_PRICES, **_parse_prices(os.getenv("MODEL_PRICES", ""))}
+
+# Who made the call: set per Streamlit run, carried into engine and job threads
+_tags: ContextVar[dict] = ContextVar("usage_tags", default={})
+
+
+@contextmanager
+def tagged(**tags):
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def set_tags(**tags):
+    """
+    Tags every call made from the current context (a Streamlit script run).
+    """
+    _tags.set({**_tags.get(), **tags})
+
+
+def current_tags() -> dict:
+    return _tags.get()
+
+
+# -------------------------
+# Usage metadata
+# -------------------------
+def asks_for_image(model: str, config=None) -> bool:
+    """
+    Whether a call expects image output: IMAGE among the config's response
+    modalities or, when it sets none (legacy SDK calls rarely do), an image model.
+    """
+    modalities = config.get("response_modalities") if isinstance(config, dict) else getattr(config, "response_modalities", None)
+    if modalities:
+        return any("IMAGE" in str(m).upper() for m in modalities)
+    return "image" in _model_key(model).lower()
+
+
+def usage_counts(usage, image_output: bool = False) -> dict:
+    """
+    prompt / candidates / image / total token counts from a usage_metadata
+    object of either SDK. Image tokens come from the per-modality breakdown
+    when the SDK provides one; without it, all output tokens of an
+    image_output call count as image tokens (the legacy SDK reports none).
+    """
+    counts = {
+        "prompt": getattr(usage, "prompt_token_count", 0) or 0,
+        "candidates": getattr(usage, "candidates_token_count", 0) or 0,
+        "image": 0,
+    }
+    details = getattr(usage, "candidates_tokens_details", None) or []
+    for detail in details:
+        if "IMAGE" in str(getattr(detail, "modality", "")):
+            counts["image"] += getattr(detail, "token_count", 0) or 0
+    if not details and image_output:
+        counts["image"] = counts["candidates"]
+    counts["total"] = getattr(usage, "total_token_count", 0) or counts["prompt"] + counts["candidates"]
+    return counts
+
+
+def call_cost(model: str, counts: dict) -> float:
+    price_in, price_out, price_image = MODEL_PRICES.get(_model_key(model), (0.0, 0.0, 0.0))
+    text_out = counts["candidates"] - counts["image"]
+    return (counts["prompt"] * price_in + text_out * price_out + counts["image"] * price_image) / 1e6
+
+
+def outcome(error: BaseException | None) -> str:
+    if error is None:
+        return "ok"
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    code = getattr(error, "code", None)
+    return f"error {code}" if isinstance(code, int) else type(error).__name__
+
+
+# -------------------------
+# Ledger
+# -------------------------
+class UsageLedger:
+    """
+    Token, cost and latency totals per session, per model and per day.
+
+    Every call is appended to a JSONL log; totals are kept as running sums
+    (rebuilt from the last USAGE_HISTORY_DAYS of the log on start), so
+    reading them never scans past calls. The last minute of calls per model
+    is kept separately to compare against the rate limiter's TPM budget.
+    """
+
+    FIELDS = ("calls", "errors", "prompt", "candidates", "image", "total", "cost", "latency")
+
+    def __init__(self, path: str = USAGE_LOG):
+        self.path = path
+        self._lock = threading.Lock()
+        self._totals: dict[str, dict[str, dict]] = {"session": {}, "model": {}, "day": {}}
+        self._recent: deque = deque()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        cutoff = (date.today() - timedelta(days=USAGE_HISTORY_DAYS)).isoformat()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("day", "") >= cutoff:
+                    self._add(entry)
+
+    def _add(self, entry: dict):
+        keys = {"session": entry.get("session") or "-", "model": entry["model"], "day": entry["day"]}
+        for by, key in keys.items():
+            totals = self._totals[by].setdefault(key, dict.fromkeys(self.FIELDS, 0))
+            totals["calls"] += 1
+            totals["errors"] += entry["outcome"] != "ok"
+            for field in ("prompt", "candidates", "image", "total", "cost", "latency"):
+                totals[field] += entry[field]
+
+    def record(
+        self, model: str, usage, latency: float, error: BaseException | None = None, tags: dict | None = None,
+        image_output: bool | None = None
+    ) -> dict:
+        counts = usage_counts(usage, asks_for_image(model) if image_output is None else image_output)
+        now = time.time()
+        tags = current_tags() if tags is None else tags
+        entry = {
+            "ts": round(now, 3),
+            "day": datetime.fromtimestamp(now).date().isoformat(),
+            "model": _model_key(model),
+            **counts,
+            "cost": round(call_cost(model, counts), 6),
+            "latency": round(latency, 3),
+            "outcome": outcome(error),
+            "session": tags.get("session"),
+            "page": tags.get("page"),
+        }
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._add(entry)
+            self._recent.append((now, entry["model"], counts["total"]))
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+        return entry
+
+    def totals(self, by: str) -> dict[str, dict]:
+        """
+        Running totals keyed by session id, model or ISO day.
+        """
+        with self._lock:
+            return {key: dict(t) for key, t in self._totals[by].items()}
+
+    def minute_tokens(self) -> dict[str, int]:
+        """
+        Tokens used per model in the last 60 seconds, against the TPM budget.
+        """
+        cutoff = time.time() - 60
+        with self._lock:
+            while self._recent and self._recent[0][0] < cutoff:
+                self._recent.popleft()
+            used: dict[str, int] = {}
+            for _, model, tokens in self._recent:
+                used[model] = used.get(model, 0) + tokens
+        return used
+
+    def export_csv(self) -> str:
+        """
+        Per-day, per-model and per-session totals as one CSV table.
+        """
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["group", "key", *self.FIELDS])
+        for by in ("day", "model", "session"):
+            for key, totals in sorted(self.totals(by).items()):
+                writer.writerow([by, key, *(round(totals[f], 6) for f in self.FIELDS)])
+        return buf.getvalue()
+
+
+_default_ledger: UsageLedger | None = None
+_default_lock = threading.Lock()
+
+
+def default_ledger() -> UsageLedger:
+    """
+    Process-wide ledger shared by every session, engine and worker thread.
+    """
+    global _default_ledger
+    with _default_lock:
+        if _default_ledger is None:
+            _default_ledger = UsageLedger()
+        return _default_ledger
+
+
+# -------------------------
+# Metered calls
+# -------------------------
+def record_call(
+    model: str, usage, latency: float, error: BaseException | None = None, tags: dict | None = None, parent=None,
+    image_output: bool | None = None
+) -> dict:
+    """
+    Adds one model call to the ledger and, when tracing, an "api" span under
+    parent (default: the current span). image_output (default: guessed from
+    the model name) says whether the call asked for images.
+    """
+    entry = default_ledger().record(model, usage, latency, error, tags, image_output)
+    record_span("api", latency, parent, model=entry["model"], tokens=entry["total"], outcome=entry["outcome"])
+    return entry
+
+
+def metered(model: str, call, image_output: bool | None = None):
+    """
+    Runs call() and records its response's usage_metadata, or its failure.
+    """
+    started = time.perf_counter()
+    tags = current_tags()
+    try:
+        response = call()
+    except Exception as e:
+        record_call(model, None, time.perf_counter() - started, e, tags, image_output=image_output)
+        raise
+    record_call(
+        model, getattr(response, "usage_metadata", None), time.perf_counter() - started, None, tags,
+        image_output=image_output
+    )
+    return response
+
+
+def _metered_stream(chunks, model: str, started: float, tags: dict, parent, image_output: bool):
+    usage, error = None, None
+    try:
+        for chunk in chunks:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            yield chunk
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        record_call(model, usage, time.perf_counter() - started, error, tags, parent, image_output)
+
+
+class MeteredModel:
+    """
+    google.generativeai GenerativeModel whose generate_content() calls are
+    recorded in the usage ledger. Streamed responses are recorded when the
+    stream ends, with the usage_metadata of the last chunk.
+    """
+
+    def __init__(self, model, name: str):
+        self._model = model
+        self.name = name
+
+    def generate_content(self, *args, stream: bool = False, **kwargs):
+        image_output = asks_for_image(self.name, kwargs.get("generation_config"))
+        if not stream:
+            return metered(self.name, lambda: self._model.generate_content(*args, **kwargs), image_output)
+        started = time.perf_counter()
+        tags, parent = current_tags(), current_span()
+        try:
+            response = self._model.generate_content(*args, stream=True, **kwargs)
+        except Exception as e:
+            record_call(self.name, None, time.perf_counter() - started, e, tags, parent, image_output)
+            raise
+        return _metered_stream(response, self.name, started, tags, parent, image_output)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
@@ -0,0 +1,65 @@
+import uuid
+
+import streamlit as st
+
+from call_policy import default_policy
+from rate_limiter import limiter_for
+from usage_ledger import default_ledger, set_tags
+
+SESSION_KEY = "_usage_session"
+
+
+def track_usage(page: str) -> str:
+    """
+    Tags every model call of this script run with the browser session and
+    page. Call at the top of the app, before any generation.
+    """
+    session = st.session_state.setdefault(SESSION_KEY, uuid.uuid4().hex[:12])
+    set_tags(session=session, page=page)
+    return session
+
+
+def _rows(totals: dict[str, dict], label: str) -> list[dict]:
+    return [
+        {label: key, "calls": t["calls"], "errors": t["errors"], "tokens in": t["prompt"],
+         "tokens out": t["candidates"], "image tokens": t["image"], "cost $": round(t["cost"], 4),
+         "avg s": round(t["latency"] / t["calls"], 2) if t["calls"] else 0.0}
+        for key, t in sorted(totals.items(), reverse=label == "day")
+    ]
+
+
+def usage_sidebar():
+    """
+    Sidebar panel: this session's tokens and cost, each model's last-minute
+    tokens against its TPM budget, per-model and per-day totals, CSV export.
+    Call at the end of the app so this run's calls are included.
+    """
+    ledger = default_ledger()
+    session = st.session_state.get(SESSION_KEY)
+    mine = ledger.totals("session").get(session, {})
+    with st.sidebar.expander("💰 Token usage & cost"):
+        col1, col2 = st.columns(2)
+        col1.metric("Session tokens", f"{mine.get('total', 0):,}")
+        col2.metric("Session cost", f"${mine.get('cost', 0):.4f}")
+
+        for model, used in sorted(ledger.minute_tokens().items()):
+            tpm = limiter_for(model).tpm
+            st.progress(min(1.0, used / tpm), text=f"{model}: {used:,} / {tpm:,.0f} tokens this minute")
+
+        by_model, by_day = ledger.totals("model"), ledger.totals("day")
+        if by_model:
+            st.caption("Per model (all sessions)")
+            st.dataframe(_rows(by_model, "model"), hide_index=True)
+            st.caption("Per day")
+            st.dataframe(_rows(by_day, "day"), hide_index=True)
+            st.download_button("⬇️ Export usage CSV", ledger.export_csv(), file_name="usage.csv", mime="text/csv")
+        else:
+            st.caption("No model calls recorded yet.")
+
+    health = default_policy().health()
+    if health:
+        with st.sidebar.expander("🩺 Model health"):
+            open_models = [h["model"] for h in health if h["breaker"] != "closed"]
+            if open_models:
+                st.warning(f"Circuit open for {', '.join(open_models)}; calls use their fallbacks.")
+            st.dataframe(health, hide_index=True)
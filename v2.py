@@ -1,22 +1,25 @@
 import streamlit as st
-from PIL import Image
-import google.generativeai as genai
-import base64
+from image_loader import load_image
+from clients import configure_genai, generative_model
 from dotenv import load_dotenv
 import os
+from prompt_stream import TextStream
+from pipeline import PIPELINE_LABELS, PIPELINE_MODE, PIPELINE_MODES, describe, ledger_rows, run_pipeline
+from image_output import extension
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY= os.getenv("GOOGLE_API_KEY")
 
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 VISION_MODEL = "models/gemini-1.0-basic"          
 IMAGE_MODEL  = "models/gemini-2.5-flash-image"        
     
 
 
-def generate_prompt(img):
+def generate_prompt(img) -> TextStream:
     PROMPT_TEMPLATE = """
     Analyze the uploaded image and describe the lehenga in maximum detail including:
     • embroidery & stone work
@@ -33,41 +36,51 @@ def generate_prompt(img):
 
     Output should be ONLY the final instruction prompt (no explanation).
     """
-    model = genai.GenerativeModel(VISION_MODEL)
-    result = model.generate_content([PROMPT_TEMPLATE, img])
-    return result.text
+    model = generative_model(VISION_MODEL)
+    return TextStream(lambda: model.generate_content([PROMPT_TEMPLATE, img], stream=True))
 
-def generate_image(prompt):
-    model = genai.GenerativeModel(IMAGE_MODEL)
-    result = model.generate_content(prompt, stream=False)
-    image_base64 = result.candidates[0].content.parts[0].inline_data.data
-    return base64.b64decode(image_base64)
+def show_instruction(stream):
+    st.subheader("Generated Prompt")
+    st.write_stream(stream)
 
 
 st.title("👗 Lehenga Try-On Generator (Gemini)")
+track_usage("v2")
 
 uploaded_file = st.file_uploader("Upload Lehenga Image", type=["jpg", "jpeg", "png"])
 
 if uploaded_file:
-    input_img = Image.open(uploaded_file)
+    input_img = load_image(uploaded_file)
     st.image(input_img, caption="Uploaded Lehenga", width=350)
 
-    if st.button("Generate Model Image"):
-        with st.spinner("Generating prompt from image..."):
-            prompt = generate_prompt(input_img)
-        st.subheader("Generated Prompt")
-        st.write(prompt)
+    pipeline_mode = st.radio(
+        "Pipeline", PIPELINE_MODES, index=PIPELINE_MODES.index(PIPELINE_MODE), format_func=PIPELINE_LABELS.get
+    )
 
+    if st.button("Generate Model Image"):
         with st.spinner("Generating model wearing lehenga..."):
-            output_image_bytes = generate_image(prompt)
-
-        st.subheader("Final Generated Image")
-        st.image(output_image_bytes, use_column_width=True)
-
-        # Download button
-        st.download_button(
-            label="📥 Download Image",
-            data=output_image_bytes,
-            file_name="model_lehenga.jpg",
-            mime="image/jpeg"
-        )
+            run = run_pipeline(
+                pipeline_mode, [input_img], IMAGE_MODEL,
+                instruction=generate_prompt, show_instruction=show_instruction
+            )
+        st.caption(describe(run))
+
+        output_image_bytes = run["image"]
+        if output_image_bytes:
+            st.subheader("Final Generated Image")
+            st.image(output_image_bytes, use_column_width=True)
+
+            # Download button
+            st.download_button(
+                label="📥 Download Image",
+                data=output_image_bytes,
+                file_name=f"model_lehenga.{extension(run['mime'])}",
+                mime=run["mime"]
+            )
+        else:
+            st.error("The model returned no image.")
+
+with st.expander("📊 Pipeline comparison (this server process)"):
+    st.table(ledger_rows())
+
+usage_sidebar()
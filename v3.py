@@ -1,17 +1,19 @@
 import streamlit as st
 from PIL import Image
-from io import BytesIO
-import os
-from dotenv import load_dotenv
-from google import genai
 from google.genai import types
+from prompt_cache import default_memo, prompt_key
+from rate_limiter import IMAGE_OUTPUT_TOKENS, estimate_tokens
+from async_engine import default_engine
+from call_policy import call_with_policy
+from image_output import extension, extract_image, sniff_mime
+from upload_cache import load_upload
+from session_results import request_key, session_results
+from usage_panel import track_usage, usage_sidebar
 
 # -------------------------
-# Load API key  (working)
-# ----------------- --------
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+# Shared async engine (loads GOOGLE_API_KEY once per process)
+# -------------------------
+engine = default_engine()
 
 # -------------------------
 # Nano Banana Pro model
@@ -43,12 +45,21 @@ Rules (MUST follow exactly):
 
 Output only one line: starting with “Generate a 2048x2048 photorealistic image of a model wearing…” and including constraints as above.
     """
+    memo = default_memo()
+    memo_key = prompt_key([lehenga_img, closeup_img, blouse_img], PROMPT_TEMPLATE, VISION_MODEL)
+    cached = memo.get(memo_key)
+    if cached:
+        return cached
+
     # Generate prompt text (Nano Banana Pro will interpret)
-    response = client.models.generate_content(
-        model=VISION_MODEL,
-        contents=[PROMPT_TEMPLATE]
+    response = engine.generate(
+        VISION_MODEL,
+        [PROMPT_TEMPLATE],
+        tokens=estimate_tokens(PROMPT_TEMPLATE)
     )
-    return response.parts[0].text.strip()
+    instruction = response.parts[0].text.strip()
+    memo.put(memo_key, instruction)
+    return instruction
 
 # -------------------------
 # Generate image from prompt
@@ -56,34 +67,27 @@ Output only one line: starting with “Generate a 2048x2048 photorealistic image
 def generate_image_from_prompt(prompt_instruction: str) -> bytes | None:
     """
     Generates a 2048x2048 image from a single-line prompt using Nano Banana Pro.
-    Returns raw bytes suitable for PIL or download.
+    Returns the model's encoded image bytes as-is, ready for display or download.
     """
     try:
-        response = client.models.generate_content(
-            model=VISION_MODEL,
-            contents=[prompt_instruction],
-            config=types.GenerateContentConfig(
+        # Retries 429/503s with backoff instead of failing the whole run
+        response = call_with_policy(VISION_MODEL, lambda model: engine.generate(
+            model,
+            [prompt_instruction],
+            types.GenerateContentConfig(
                 image_config=types.ImageConfig(
-                    image_size="2K",
+                    # Only Nano Banana Pro takes image_size; a fallback model gets the ratio alone
+                    image_size="2K" if model == VISION_MODEL else None,
                     aspect_ratio="1:1"
                 ),
                 response_modalities=["IMAGE"]
-            )
-        )
-
-        # Check if .as_image() returns PIL.Image or bytes
-        part = response.parts[0]
-        try:
-            # Try as PIL Image
-            img = part.as_image()
-            buf = BytesIO()
-            img.save(buf, "JPEG", quality=95)  # Correct usage: no "format=" keyword
-            buf.seek(0)
-            return buf.read()
-        except TypeError:
-            # Already bytes
-            return part.inline_data.data  # or part.as_bytes()
-            
+            ),
+            tokens=estimate_tokens(prompt_instruction, IMAGE_OUTPUT_TOKENS)
+        ))
+
+        image = extract_image(response)
+        return image[0] if image else None
+
     except Exception as e:
         st.error(f"Failed to generate image: {e}")
         return None
@@ -93,41 +97,60 @@ def generate_image_from_prompt(prompt_instruction: str) -> bytes | None:
 # Streamlit UI
 # -------------------------
 st.title("👗 Lehenga Try-On — Nano Banana Pro 2K")
+track_usage("v3")
 
 lehenga_file = st.file_uploader("Upload Lehenga Image (full view)", type=["jpg","jpeg","png"])
 closeup_file = st.file_uploader("Upload Design Close-up (optional)", type=["jpg","jpeg","png"])
 blouse_file  = st.file_uploader("Upload Blouse Reference (optional)", type=["jpg","jpeg","png"])
 
-lehenga_img = Image.open(lehenga_file).convert("RGB") if lehenga_file else None
-closeup_img = Image.open(closeup_file).convert("RGB") if closeup_file else None
-blouse_img  = Image.open(blouse_file).convert("RGB") if blouse_file else None
+# Decoded once per upload and reused across reruns
+lehenga_upload = load_upload(lehenga_file)
+closeup_upload = load_upload(closeup_file)
+blouse_upload  = load_upload(blouse_file)
 
-# Preview uploaded images
-if lehenga_img:
-    st.image(lehenga_img, caption="Lehenga (full view)", width=360)
-if closeup_img:
-    st.image(closeup_img, caption="Design Close-up", width=240)
-if blouse_img:
-    st.image(blouse_img, caption="Blouse Reference", width=240)
+lehenga_img = lehenga_upload.image if lehenga_upload else None
+closeup_img = closeup_upload.image if closeup_upload else None
+blouse_img  = blouse_upload.image if blouse_upload else None
 
-# Generate button
-if st.button("Generate 2K Try-On"):
+# Preview uploaded images (server-side thumbnails, not the full upload)
+if lehenga_upload:
+    st.image(lehenga_upload.preview(360), caption="Lehenga (full view)", width=360)
+if closeup_upload:
+    st.image(closeup_upload.preview(240), caption="Design Close-up", width=240)
+if blouse_upload:
+    st.image(blouse_upload.preview(240), caption="Blouse Reference", width=240)
+
+# Results survive reruns (e.g. the download click) for this session
+results = session_results(st.session_state)
+result_key = request_key(*(u.digest if u else None for u in (lehenga_upload, closeup_upload, blouse_upload)), VISION_MODEL)
+result = results.get(result_key)
+
+# Generate button (relabelled once a result exists, so a queued double-click can't re-fire it)
+if st.button("Generate 2K Try-On" if result is None else "Regenerate", disabled=results.in_flight(result_key)):
     if not lehenga_img:
         st.error("Please upload the full-view lehenga image.")
     else:
-        with st.spinner("Generating prompt..."):
-            prompt = generate_prompt(lehenga_img, closeup_img, blouse_img)
-            st.subheader("Generated Prompt")
-            st.write(prompt)
-        with st.spinner("Generating image..."):
-            img_bytes = generate_image_from_prompt(prompt)
-            if img_bytes:
-                out = Image.open(BytesIO(img_bytes)).convert("RGB")
-                st.subheader("Generated Image (2048×2048)")
-                st.image(out, use_column_width=True)
-                buf = BytesIO()
-                out.save(buf, format="JPEG", quality=95)
-                buf.seek(0)
-                st.download_button("📥 Download", data=buf, file_name="lehenga_tryon.jpg", mime="image/jpeg")
+        with results.generating(result_key) as claimed:
+            if not claimed:
+                st.info("A generation for these uploads is already running.")
             else:
-                st.error("Image generation failed — check model availability or API quota.")
+                with st.spinner("Generating prompt..."):
+                    prompt = generate_prompt(lehenga_img, closeup_img, blouse_img)
+                with st.spinner("Generating image..."):
+                    img_bytes = generate_image_from_prompt(prompt)
+                if img_bytes:
+                    results.put(result_key, img_bytes, sniff_mime(img_bytes), prompt=prompt)
+                    result = results.get(result_key)
+                else:
+                    st.subheader("Generated Prompt")
+                    st.write(prompt)
+                    st.error("Image generation failed — check model availability or API quota.")
+
+if result:
+    st.subheader("Generated Prompt")
+    st.write(result["prompt"])
+    st.subheader("Generated Image (2048×2048)")
+    st.image(result["image"], use_column_width=True)
+    st.download_button("📥 Download", data=result["image"], file_name=f"lehenga_tryon.{extension(result['mime'])}", mime=result["mime"])
+
+usage_sidebar()
@@ -1,113 +1,225 @@
+import os
 import streamlit as st
 from PIL import Image
-from io import BytesIO
-import os
-from dotenv import load_dotenv
-from google import genai
-from google.genai import types
+from result_cache import default_cache
+from phash_index import default_index
+from tryon import VISION_MODEL, generate_try_on
+from image_prep import summarize
+from image_output import extension, sniff_mime
+from upload_cache import load_upload
+from session_results import request_key, session_results
+from job_queue import default_queue
+from fidelity import FIDELITY_THRESHOLD, colour_fidelity, gated
+from usage_panel import track_usage, usage_sidebar
+from tracing import span
+from trace_panel import trace_expander
 
 # -------------------------
-# Load API key
+# Background generation
 # -------------------------
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+jobs = default_queue()
+# Candidates run side by side on the model's job workers (JOB_MODEL_CAP)
+MAX_CANDIDATES = 4
 
-# -------------------------
-# Nano Banana Pro model
-# -------------------------
-VISION_MODEL = "gemini-3-pro-image-preview"
+def generate_scored(lehenga_img: Image.Image, closeup_img, blouse_img, candidate: int = 0, **kwargs) -> tuple[bytes, dict]:
+    """
+    generate_try_on plus the candidate's colour fidelity to the lehenga upload.
+    An output below FIDELITY_THRESHOLD is regenerated as a fresh candidate
+    (up to FIDELITY_RETRIES times) and the best one returned, flagged if
+    none passed.
+    """
+    def render(attempt: int):
+        # Retries use candidate slots past the slider's, so they never collide
+        data, info = generate_try_on(
+            lehenga_img, closeup_img, blouse_img, candidate=candidate + attempt * MAX_CANDIDATES, **kwargs
+        )
+        with span("score", attempt=attempt):
+            return (data, info), colour_fidelity(lehenga_img, data)
 
-# -------------------------
-# Generate image function
-# -------------------------
-def generate_image_with_reference(
+    (data, info), fidelity, attempts = gated(render)
+    return data, {**info, "fidelity": fidelity, "candidate": candidate, "attempts": attempts}
+
+def submit_image_with_reference(
     lehenga_img: Image.Image,
     closeup_img: Image.Image | None = None,
-    blouse_img: Image.Image | None = None
-) -> bytes | None:
+    blouse_img: Image.Image | None = None,
+    source_bytes: list[int | None] | None = None,
+    key: str | None = None,
+    garment_id: str | None = None,
+    candidate: int = 0
+) -> str:
     """
-    Generates a 2048x2048 image from the uploaded lehenga + optional references.
+    Queues a 2048x2048 image from the uploaded lehenga + optional references
+    on the background workers and returns the job id. garment_id (the
+    lehenga file name) files the result under that piece in the history.
+    Results are cached on disk, so re-running the same triple costs no API call.
     """
-    contents = [
-        lehenga_img,
-        "Generate a photorealistic image of a model wearing this lehenga. "
-        "Do NOT change color, embroidery, motifs, pleats, or fabric. "
-        "Preserve every design detail exactly. Studio lighting, head-to-knee, 2048x2048."
-    ]
-
-    if closeup_img:
-        contents.append(closeup_img)
-        contents.append("Reference close-up: preserve embroidery and fabric texture exactly.")
-
-    if blouse_img:
-        contents.append(blouse_img)
-        contents.append("Reference blouse: preserve cut, sleeve, and stitch design exactly.")
-
-    try:
-        response = client.models.generate_content(
-            model=VISION_MODEL,
-            contents=contents,
-            config=types.GenerateContentConfig(
-                image_config=types.ImageConfig(
-                    image_size="2K",
-                    aspect_ratio="1:1"
-                ),
-                response_modalities=["IMAGE"]
-            )
-        )
+    return jobs.submit(
+        generate_scored, lehenga_img, closeup_img, blouse_img,
+        model=VISION_MODEL, key=key, source_bytes=source_bytes,
+        garment_id=garment_id, source="v3cpy", candidate=candidate
+    )
 
-        part = response.parts[0]
-        img = part.as_image()
-        buf = BytesIO()
-        img.save(buf, "JPEG", quality=95)
-        buf.seek(0)
-        return buf.read()
+def candidate_key(result_key: str, candidate: int) -> str:
+    return result_key if candidate == 0 else request_key(result_key, candidate)
 
-    except Exception as e:
-        st.error(f"Failed to generate image: {e}")
-        return None
+@st.fragment(run_every=2)
+def job_progress(job_ids: list[str], finished: int):
+    """
+    Polls the jobs without rerunning the page; reruns it whenever another
+    candidate finishes, so results appear as they arrive.
+    """
+    running = [j for j in map(jobs.get, job_ids) if j is not None]
+    if sum(j.finished for j in running) != finished or all(j.finished for j in running):
+        st.rerun()
+    oldest = max(j.elapsed for j in running)
+    st.info(
+        f"⏳ Generating in the background ({finished} of {len(running)} done, {oldest:.0f}s). "
+        "Refreshing or leaving the page won't cancel it; this link reattaches to the result."
+    )
 
 # -------------------------
 # Streamlit UI
 # -------------------------
 st.title("👗 Lehenga Try-On — Nano Banana Pro 2K (Fixed)")
+track_usage("v3cpy")
 
 lehenga_file = st.file_uploader("Upload Lehenga Image (full view)", type=["jpg","jpeg","png"])
 closeup_file = st.file_uploader("Upload Design Close-up (optional)", type=["jpg","jpeg","png"])
 blouse_file  = st.file_uploader("Upload Blouse Reference (optional)", type=["jpg","jpeg","png"])
 
-lehenga_img = Image.open(lehenga_file).convert("RGB") if lehenga_file else None
-closeup_img = Image.open(closeup_file).convert("RGB") if closeup_file else None
-blouse_img  = Image.open(blouse_file).convert("RGB") if blouse_file else None
+# Decoded once per upload and reused across reruns
+lehenga_upload = load_upload(lehenga_file)
+closeup_upload = load_upload(closeup_file)
+blouse_upload  = load_upload(blouse_file)
 
-# Preview uploaded images
-if lehenga_img:
-    st.image(lehenga_img, caption="Lehenga (full view)", width=360)
-if closeup_img:
-    st.image(closeup_img, caption="Design Close-up", width=240)
-if blouse_img:
-    st.image(blouse_img, caption="Blouse Reference", width=240)
+lehenga_img = lehenga_upload.image if lehenga_upload else None
+closeup_img = closeup_upload.image if closeup_upload else None
+blouse_img  = blouse_upload.image if blouse_upload else None
 
-# Generate button
-if st.button("Generate 2K Try-On"):
+# Preview uploaded images (server-side thumbnails, not the full upload)
+if lehenga_upload:
+    st.image(lehenga_upload.preview(360), caption="Lehenga (full view)", width=360)
+if closeup_upload:
+    st.image(closeup_upload.preview(240), caption="Design Close-up", width=240)
+if blouse_upload:
+    st.image(blouse_upload.preview(240), caption="Blouse Reference", width=240)
+
+# Offer the earlier result when a near-identical lehenga was generated before
+if lehenga_upload:
+    previous = default_index("results").nearest(lehenga_upload.phash)
+    previous_bytes = default_cache().get(previous[1]["cache_key"]) if previous else None
+    if previous_bytes:
+        with st.expander(f"♻️ Near-identical lehenga generated before (distance {previous[0]})"):
+            st.image(previous_bytes, use_column_width=True)
+            st.download_button(
+                "📥 Download previous result",
+                data=previous_bytes,
+                file_name=f"lehenga_tryon_previous.{extension(sniff_mime(previous_bytes))}",
+                mime=sniff_mime(previous_bytes)
+            )
+
+# Results survive reruns (e.g. the download click) for this session
+results = session_results(st.session_state)
+result_key = request_key(*(u.digest if u else None for u in (lehenga_upload, closeup_upload, blouse_upload)), VISION_MODEL)
+
+# The running jobs' ids live in the URL (?job=id,id,...), so a refresh reattaches to them
+job_list = [j for j in map(jobs.get, filter(None, st.query_params.get("job", "").split(","))) if j is not None]
+if not job_list and "job" in st.query_params:
+    del st.query_params["job"]  # expired, or started by an earlier server process
+for job in job_list:
+    if job.status == "done" and results.get(job.key) is None:
+        data, info = job.result
+        results.put(job.key, data, sniff_mime(data), cached=info["cached"], prep=info["prep"], trace=job.trace_id,
+                    model=info.get("model"), shared=info.get("shared"), fidelity=info["fidelity"])
+job = job_list[0] if job_list else None
+
+# The latest run's candidates for these uploads, best colour match first. Its
+# size is kept per uploads, so leftovers of an earlier, larger run don't show
+run_sizes = st.session_state.setdefault("candidate_counts", {})
+if lehenga_upload or not job_list:
+    keys = [candidate_key(result_key, i) for i in range(run_sizes.get(result_key, len(job_list) or 1))]
+else:
+    keys = [j.key for j in job_list]
+candidates = sorted(
+    filter(None, map(results.get, keys)),
+    key=lambda r: r["meta"].get("fidelity", {}).get("score", 0), reverse=True
+)
+result = candidates[0] if candidates else None
+pending = any(not j.finished for j in job_list)
+
+count = st.slider(
+    "Candidates", 1, MAX_CANDIDATES, 1,
+    help="Generated in parallel; the one whose colours best match the upload is shown first."
+)
+# Generate button (relabelled once a result exists, so a queued double-click can't re-fire it)
+if st.button("Generate 2K Try-On" if result is None else "Regenerate", disabled=pending):
     if not lehenga_img:
         st.error("Please upload the full-view lehenga image.")
     else:
-        with st.spinner("Generating image with reference..."):
-            img_bytes = generate_image_with_reference(lehenga_img, closeup_img, blouse_img)
-            if img_bytes:
-                out = Image.open(BytesIO(img_bytes)).convert("RGB")
-                st.subheader("Generated Image (2048×2048)")
-                st.image(out, use_column_width=True)
-                buf = BytesIO()
-                out.save(buf, "JPEG", quality=95)
-                buf.seek(0)
-                st.download_button(
-                    "📥 Download",
-                    data=buf,
-                    file_name="lehenga_tryon.jpg",
-                    mime="image/jpeg"
+        run_sizes[result_key] = count
+        # Root span of this request; the jobs' stages nest under it
+        with span("request", page="v3cpy", candidates=count):
+            st.query_params["job"] = ",".join(
+                submit_image_with_reference(
+                    lehenga_img, closeup_img, blouse_img,
+                    source_bytes=[f.size if f else None for f in (lehenga_file, closeup_file, blouse_file)],
+                    key=candidate_key(result_key, i),
+                    garment_id=os.path.splitext(lehenga_file.name)[0],
+                    candidate=i
                 )
-            else:
-                st.error("Image generation failed — check model availability or API quota.")
+                for i in range(count)
+            )
+        st.rerun()
+
+if pending:
+    job_progress([j.id for j in job_list], sum(j.finished for j in job_list))
+for failed in (j for j in job_list if j.status == "failed"):
+    st.error(f"Failed to generate image: {failed.error}")
+
+if result:
+    if result["meta"].get("cached"):
+        st.caption("⚡ Served from result cache")
+    elif result["meta"].get("shared"):
+        st.caption("🤝 Joined an identical generation already in progress; no extra API call")
+    elif result["meta"].get("prep"):
+        st.caption(summarize(result["meta"]["prep"]))
+    if result["meta"].get("model") not in (None, VISION_MODEL):
+        st.warning(f"{VISION_MODEL} is failing right now; this image was rendered by the fallback {result['meta']['model']}.")
+    # Serve the model's own encoded bytes; no decode / re-encode
+    st.subheader("Generated Image (2048×2048)")
+    if "fidelity" in result["meta"]:
+        st.caption(f"🎨 Colour fidelity {result['meta']['fidelity']['score']:.2f}"
+                   + (f" — best of {len(candidates)} candidates" if len(candidates) > 1 else ""))
+        if not result["meta"]["fidelity"].get("passed", True):
+            st.warning(
+                f"⚠️ The colours drift from the upload (fidelity below {FIDELITY_THRESHOLD:.2f}"
+                f" after {result['meta'].get('attempts', 1)} attempt(s)). Check the image before using it."
+            )
+    st.image(result["image"], use_column_width=True)
+    st.download_button(
+        "📥 Download",
+        data=result["image"],
+        file_name=f"lehenga_tryon.{extension(result['mime'])}",
+        mime=result["mime"]
+    )
+
+# The other candidates, still ranked by colour fidelity
+if len(candidates) > 1:
+    st.subheader("Other candidates")
+    for i, (col, other) in enumerate(zip(st.columns(len(candidates) - 1), candidates[1:]), start=2):
+        with col:
+            st.image(other["image"], caption=f"#{i} · fidelity {other['meta'].get('fidelity', {}).get('score', 0):.2f}"
+                     + ("" if other["meta"].get("fidelity", {}).get("passed", True) else " ⚠️"))
+            st.download_button(
+                "📥 Download",
+                data=other["image"],
+                file_name=f"lehenga_tryon_{i}.{extension(other['mime'])}",
+                mime=other["mime"],
+                key=f"download_candidate_{i}"
+            )
+
+if result or job:
+    trace_expander(job.trace_id if job else result["meta"].get("trace"))
+
+usage_sidebar()
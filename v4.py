@@ -1,15 +1,22 @@
 import streamlit as st
 from PIL import Image
-import google.generativeai as genai
-import base64
+from clients import configure_genai, generative_model
 from dotenv import load_dotenv
 import os
 from io import BytesIO
+from prompt_cache import default_memo, prompt_key
+from prompt_stream import TextStream
+from pipeline import PIPELINE_LABELS, PIPELINE_MODE, PIPELINE_MODES, describe, ledger_rows, run_pipeline
+from phash_index import default_index, phash
+from rate_limiter import acquire, estimate_tokens
+from image_output import extension, sniff_mime
+from upload_cache import load_upload
+from usage_panel import track_usage, usage_sidebar
 
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
+configure_genai(GEMINI_API_KEY)  # once per process, not per rerun
 
 
 VISION_MODEL = "models/gemini-1.0-basic"
@@ -22,10 +29,22 @@ def pil_to_bytes(img: Image.Image, fmt="PNG"):
     buf.seek(0)
     return buf.read()
 
-def generate_prompt(lehenga_img: Image.Image, closeup_img: Image.Image | None, blouse_img: Image.Image | None):
+def references_key(closeup_upload, blouse_upload) -> str:
+    """
+    Upload digests of the optional references (already computed, no pixel
+    hashing); an instruction is only reused for a near-identical lehenga
+    when these match too.
+    """
+    return ":".join(u.digest if u else "-" for u in (closeup_upload, blouse_upload))
+
+def generate_prompt(
+    lehenga_img: Image.Image, closeup_img: Image.Image | None, blouse_img: Image.Image | None, references: str = "-:-"
+) -> TextStream:
     """
     Create a strict, multi-image grounded prompt that instructs Gemini
     to produce a 2K realistic image of a model wearing the exact same lehenga.
+    Streamed: render with st.write_stream(), then read .text.
+    references is the references_key() the instruction is indexed under.
     """
  
     PROMPT_TEMPLATE = """
@@ -61,30 +80,32 @@ Now produce a single concise generation instruction (one line) that a generative
     if blouse_img:
         inputs.append(blouse_img)
 
-    model = genai.GenerativeModel(VISION_MODEL)
+    memo = default_memo()
+    memo_key = prompt_key([lehenga_img, closeup_img, blouse_img], PROMPT_TEMPLATE, VISION_MODEL)
+    cached = memo.get(memo_key)
+    if cached:
+        return TextStream.of(cached)
 
-    result = model.generate_content(inputs)
-  
-    return result.text.strip()
+    def remember(instruction: str):
+        memo.put(memo_key, instruction)
+        default_index("instructions").add(
+            phash(lehenga_img), {"instruction": instruction, "references": references}
+        )
 
-def generate_image_from_prompt(prompt_instruction: str):
-    """
-    Call the image model with the single-line instruction and request 2048x2048 output.
-    """
-    model = genai.GenerativeModel(IMAGE_MODEL)
+    def request():
+        acquire(VISION_MODEL, estimate_tokens(inputs))
+        return generative_model(VISION_MODEL).generate_content(inputs, stream=True)
 
-    result = model.generate_content(prompt_instruction, stream=False)
+    return TextStream(request, on_complete=remember)
 
-    try:
-        image_base64 = result.candidates[0].content.parts[0].inline_data.data
-    except Exception as e:
-        st.error(f"Image generation response parsing failed: {e}")
-        return None
-    image_bytes = base64.b64decode(image_base64)
-    return image_bytes
+def show_instruction(stream: TextStream):
+    st.subheader("Generation Instruction Prompt")
+    st.write_stream(stream)
+    st.caption(stream.summary())
 
 
 st.title("👗 Lehenga Try-On — High-Detail 2K Generator")
+track_usage("v4")
 
 st.markdown(
     """
@@ -99,81 +120,104 @@ lehenga_file = st.file_uploader("Upload Lehenga Image (Full view)", type=["jpg",
 closeup_file = st.file_uploader("Upload Close-up Design (embroidery/stitch) — A", type=["jpg","jpeg","png"])
 blouse_file  = st.file_uploader("Upload Blouse Reference — B", type=["jpg","jpeg","png"])
 
+lehenga_upload = None
 if lehenga_file:
     try:
-        lehenga_img = Image.open(lehenga_file).convert("RGB")
-        st.image(lehenga_img, caption="Lehenga (full view)", width=360)
+        lehenga_upload = load_upload(lehenga_file)
+        st.image(lehenga_upload.preview(360), caption="Lehenga (full view)", width=360)
     except Exception as e:
         st.error(f"Failed to open lehenga image: {e}")
-        lehenga_img = None
-else:
-    lehenga_img = None
+        lehenga_upload = None
+lehenga_img = lehenga_upload.image if lehenga_upload else None
 
+closeup_upload = None
 if closeup_file:
     try:
-        closeup_img = Image.open(closeup_file).convert("RGB")
-        st.image(closeup_img, caption="Design Close-up (A)", width=240)
+        closeup_upload = load_upload(closeup_file)
+        st.image(closeup_upload.preview(240), caption="Design Close-up (A)", width=240)
     except Exception as e:
         st.error(f"Failed to open close-up image: {e}")
-        closeup_img = None
-else:
-    closeup_img = None
+        closeup_upload = None
+closeup_img = closeup_upload.image if closeup_upload else None
 
+blouse_upload = None
 if blouse_file:
     try:
-        blouse_img = Image.open(blouse_file).convert("RGB")
-        st.image(blouse_img, caption="Blouse Reference (B)", width=240)
+        blouse_upload = load_upload(blouse_file)
+        st.image(blouse_upload.preview(240), caption="Blouse Reference (B)", width=240)
     except Exception as e:
         st.error(f"Failed to open blouse image: {e}")
-        blouse_img = None
-else:
-    blouse_img = None
+        blouse_upload = None
+blouse_img = blouse_upload.image if blouse_upload else None
+
+previous_instruction = None
+references = references_key(closeup_upload, blouse_upload)
+if lehenga_upload:
+    # Only instructions written for the same close-up / blouse references
+    previous = default_index("instructions").nearest(lehenga_upload.phash, where={"references": references})
+    if previous and st.checkbox(
+        f"♻️ Reuse instruction from a near-identical lehenga (distance {previous[0]})", value=True
+    ):
+        previous_instruction = previous[1]["instruction"]
 
 col1, col2 = st.columns(2)
 with col1:
     quality_mode = st.radio("Quality mode", ["A — Ultra Accuracy (slower)", "B — Balanced", "C — Fast"], index=0)
 with col2:
     do_upscale = st.checkbox("Apply additional upscale (if available)", value=False)
+    pipeline_mode = st.radio(
+        "Pipeline", PIPELINE_MODES, index=PIPELINE_MODES.index(PIPELINE_MODE), format_func=PIPELINE_LABELS.get
+    )
 
 if st.button("Generate 2K Try-On"):
 
     if not lehenga_img:
         st.error("Please upload the full-view lehenga image (required).")
     else:
-        with st.spinner("Generating strict prompt from provided images..."):
-          
-            try:
-                instruction_prompt = generate_prompt(lehenga_img, closeup_img, blouse_img)
-                st.subheader("Generation Instruction Prompt")
-                st.write(instruction_prompt)
-            except Exception as e:
-                st.error(f"Prompt generation failed: {e}")
-                instruction_prompt = None
-
-        if instruction_prompt:
+        try:
             with st.spinner("Generating 2K model image — this may take a while..."):
-                image_bytes = generate_image_from_prompt(instruction_prompt)
-                if not image_bytes:
-                    st.error("Image generation failed. Check API key, model availability, and quota.")
-                else:
-                    try:
-                        out_img = Image.open(BytesIO(image_bytes)).convert("RGB")
-                        st.subheader("Final Generated Image (2048×2048)")
-                        st.image(out_img, use_column_width=True)
-
-                   
-                        buf = BytesIO()
-                        out_img.save(buf, format="JPEG", quality=95)
-                        buf.seek(0)
-                        st.download_button(
-                            label="📥 Download Image (JPEG)",
-                            data=buf,
-                            file_name="model_lehenga_2k.jpg",
-                            mime="image/jpeg"
-                        )
-                    except Exception as e:
-                        st.error(f"Failed to display or save generated image: {e}")
+                # Two-stage: the instruction is rendered token by token and the image
+                # stage starts as soon as it ends. Fused: one call with the references.
+                run = run_pipeline(
+                    pipeline_mode,
+                    [lehenga_img, closeup_img, blouse_img],
+                    IMAGE_MODEL,
+                    instruction=(
+                        (lambda *refs: TextStream.of(previous_instruction)) if previous_instruction
+                        else (lambda *refs: generate_prompt(*refs, references=references))
+                    ),
+                    show_instruction=show_instruction
+                )
+        except Exception as e:
+            st.error(f"Generation failed: {e}")
+            run = None
+
+        if run:
+            st.caption(describe(run))
+            image_bytes = run["image"]
+            if not image_bytes:
+                st.error("Image generation failed. Check API key, model availability, and quota.")
+            else:
+                try:
+                    # Serve the model's own encoded bytes; no decode / re-encode
+                    mime = sniff_mime(image_bytes)
+                    st.subheader("Final Generated Image (2048×2048)")
+                    st.image(image_bytes, use_column_width=True)
+
+                    st.download_button(
+                        label=f"📥 Download Image ({extension(mime).upper()})",
+                        data=image_bytes,
+                        file_name=f"model_lehenga_2k.{extension(mime)}",
+                        mime=mime
+                    )
+                except Exception as e:
+                    st.error(f"Failed to display or save generated image: {e}")
 
         if do_upscale:
             st.info("Upscale requested. If you have an external upscaler (Real-ESRGAN) or a Gemini upscaler model,"
                     "we can add a secondary upscaling pass. Tell me if you want that integrated.")
+
+with st.expander("📊 Pipeline comparison (this server process)"):
+    st.table(ledger_rows())
+
+usage_sidebar()